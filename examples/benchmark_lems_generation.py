@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+#
+#   Compare the number of LEMS files per second which LEMSSimulation can
+#   generate with each of its backends (airspeed template, with and without the
+#   compiled template being cached, and lxml), and check they give the same LEMS
+#
+
+import argparse
+import time
+
+from lxml import etree
+
+from pyneuroml import pynml
+from pyneuroml.lems.LEMSSimulation import LEMSSimulation
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description="Benchmark generation of LEMS files with the backends of LEMSSimulation")
+
+    parser.add_argument('-files',
+                        type=int,
+                        metavar='<number>',
+                        default=500,
+                        help='Number of LEMS files to generate with each backend')
+
+    parser.add_argument('-cells',
+                        type=int,
+                        metavar='<number>',
+                        default=20,
+                        help='Number of cells recorded (a line & a column each) in each file')
+
+    return parser.parse_args()
+
+
+def generate_lems(index, num_cells, backend):
+
+    sim_id = 'sim%i'%index
+    ls = LEMSSimulation(sim_id, 500, 0.05, 'net1', backend=backend)
+    ls.include_neuroml2_file('NML2_SingleCompHHCell.nml', include_included=False)
+
+    ls.create_display('display0', "Voltages", "-90", "50")
+    ls.create_output_file('of0', "%s.v.dat"%sim_id)
+    for i in range(num_cells):
+        ls.add_line_to_display('display0', "v%i"%i, "hhpop[%i]/v"%i, "1mV", "#%06x"%(i*4999))
+        ls.add_column_to_output_file('of0', "v%i"%i, "hhpop[%i]/v"%i)
+
+    return ls.to_xml()
+
+
+def canonical(xml):
+
+    parser = etree.XMLParser(remove_blank_text=True, remove_comments=True)
+    return etree.tostring(etree.fromstring(xml.encode(), parser))
+
+
+def main():
+
+    args = process_args()
+
+    backends = [('airspeed (template compiled every time)', 'airspeed', True),
+                ('airspeed (compiled template cached)', 'airspeed', False),
+                ('lxml', 'lxml', False)]
+
+    outputs = {}
+    for name, backend, clear_cache in backends:
+        start = time.time()
+        for i in range(args.files):
+            if clear_cache:
+                pynml.airspeed_templates.clear()
+            xml = generate_lems(i, args.cells, backend)
+        taken = time.time() - start
+        outputs[name] = canonical(xml)
+        print("%s: %i files in %.3f s (%.1f files/s)"%(name, args.files, taken, args.files/taken))
+
+    if len(set(outputs.values())) != 1:
+        print("The backends generated different LEMS!")
+        exit(1)
+    print("All backends generated the same LEMS")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+#
+#   Check that the modules of the console_scripts in setup.py (pynml,
+#   pynml-channelanalysis etc.) can be imported quickly, i.e. that they don't
+#   import large packages (matplotlib, libNeuroML, PyLEMS, NEURON...) until
+#   they are needed, so these are not loaded by e.g. pynml -validate
+#
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+SETUP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'setup.py')
+
+# Packages which should only be imported by the functions which use them
+DEFERRED_PACKAGES = ['matplotlib', 'pylab', 'neuroml', 'lems', 'neuron', 'airspeed']
+
+IMPORT_SCRIPT = """
+import sys, time, json
+start = time.time()
+import %s
+import_time = time.time() - start
+loaded = [p for p in %s if p in sys.modules]
+print(json.dumps({'time': import_time, 'loaded': loaded}))
+"""
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description="Check the time to import the modules of each of the console_scripts of pyNeuroML")
+
+    parser.add_argument('-maxTime',
+                        type=float,
+                        metavar='<seconds>',
+                        default=1.0,
+                        help='Maximum time allowed to import each module')
+
+    parser.add_argument('-repeats',
+                        type=int,
+                        metavar='<number>',
+                        default=3,
+                        help='Number of times to import each module (in a new interpreter); the fastest is used')
+
+    return parser.parse_args()
+
+
+def get_entry_points():
+    """
+    List of (script name, module) for the console_scripts in setup.py
+    """
+    with open(SETUP_FILE) as f:
+        contents = f.read()
+    return re.findall(r"'([\w-]+)\s*=\s*([\w.]+):\w+'", contents)
+
+
+def time_import(module):
+    import json
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT%(module, DEFERRED_PACKAGES)])
+    return json.loads(output.decode().strip().split('\n')[-1])
+
+
+def main():
+
+    args = process_args()
+
+    failures = []
+    for script, module in get_entry_points():
+        results = [time_import(module) for i in range(args.repeats)]
+        import_time = min([r['time'] for r in results])
+        loaded = results[0]['loaded']
+
+        print("%s (%s): imported in %.3f s%s"%(script, module, import_time,
+                                                '; also imports: %s'%', '.join(loaded) if loaded else ''))
+        if loaded:
+            failures.append("%s imports %s on startup"%(module, ', '.join(loaded)))
+        if import_time > args.maxTime:
+            failures.append("%s took %.3f s to import (max %s s)"%(module, import_time, args.maxTime))
+
+    if failures:
+        print("\nProblems found:\n  %s"%'\n  '.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
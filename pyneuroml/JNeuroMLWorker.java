@@ -0,0 +1,100 @@
+/*
+ *  Long lived jNeuroML process used by pyneuroml.jnml_worker.
+ *
+ *  Launched with the jNeuroML jar on the classpath (Java 11+ can run this
+ *  source file directly) and reads one request per line on stdin:
+ *
+ *      PING                    -> replies "##PYNEUROML_WORKER## PONG"
+ *      RUN<TAB>arg1<TAB>arg2.. -> calls org.neuroml.JNeuroML.main(args), any
+ *                                 output is passed through, then replies
+ *                                 "##PYNEUROML_WORKER## DONE <status>"
+ *      QUIT                    -> exits
+ *
+ *  If the first argument is > 0, the process exits after being idle for that
+ *  many seconds.
+ */
+
+import java.io.BufferedReader;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.util.Arrays;
+
+public class JNeuroMLWorker
+{
+    static final String MARKER = "##PYNEUROML_WORKER##";
+
+    static volatile long lastActive = System.currentTimeMillis();
+    static volatile boolean busy = false;
+
+    public static void main(String[] args) throws Exception
+    {
+        final long idleTimeout = args.length > 0 ? (long) (Double.parseDouble(args[0]) * 1000) : 0;
+        final PrintStream out = System.out;
+
+        if (idleTimeout > 0)
+        {
+            Thread watchdog = new Thread()
+            {
+                public void run()
+                {
+                    while (true)
+                    {
+                        try
+                        {
+                            Thread.sleep(1000);
+                        }
+                        catch (InterruptedException e)
+                        {
+                            return;
+                        }
+                        if (!busy && System.currentTimeMillis() - lastActive > idleTimeout)
+                        {
+                            System.exit(0);
+                        }
+                    }
+                }
+            };
+            watchdog.setDaemon(true);
+            watchdog.start();
+        }
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        out.println(MARKER + " READY");
+        out.flush();
+
+        String line;
+        while ((line = in.readLine()) != null)
+        {
+            busy = true;
+            if (line.equals("PING"))
+            {
+                out.println(MARKER + " PONG");
+            }
+            else if (line.equals("QUIT"))
+            {
+                break;
+            }
+            else if (line.startsWith("RUN"))
+            {
+                String[] parts = line.split("\t", -1);
+                String[] jnmlArgs = Arrays.copyOfRange(parts, 1, parts.length);
+                int status = 0;
+                try
+                {
+                    org.neuroml.JNeuroML.main(jnmlArgs);
+                }
+                catch (Throwable t)
+                {
+                    t.printStackTrace();
+                    status = 1;
+                }
+                System.out.flush();
+                out.println(MARKER + " DONE " + status);
+            }
+            out.flush();
+            lastActive = System.currentTimeMillis();
+            busy = false;
+        }
+        System.exit(0);
+    }
+}
@@ -9,25 +9,24 @@
 
 import argparse
 
-import neuroml.loaders as loaders
 from pyneuroml import pynml
 
-import airspeed
 import sys
 import os
+import time
 import os.path
 
-import matplotlib.pyplot as pylab
 import pprint
 
 TEMPLATE_FILE = "%s/LEMS_Test_TEMPLATE.xml"%(os.path.dirname(__file__))
 HTML_TEMPLATE_FILE = "%s/ChannelInfo_TEMPLATE.html"%(os.path.dirname(__file__))
+
+# Gates (NeuroML element names) whose inf & tau are recorded by TEMPLATE_FILE
+TEMPLATE_GATE_TYPES = ['gate', 'gateHHrates', 'gateHHtauInf']
      
 MAX_COLOUR = (255, 0, 0)
 MIN_COLOUR = (255, 255, 0)
 
-print("\n") 
-
 
 def process_args():
     """ 
@@ -117,6 +116,17 @@ def process_args():
                         default=False,
                         help="Supress plotting of variables and only save data to file")
                         
+    parser.add_argument('-analytical',
+                        action='store_true',
+                        default=False,
+                        help="Calculate inf/tau directly from the gate definitions for standard HH gates, only simulating channels with other gate types")
+                        
+    parser.add_argument('-processes', 
+                        type=int,
+                        metavar='<number of processes>',
+                        default=1,
+                        help='Number of simulations of channels to run in parallel')
+                        
     parser.add_argument('-html',
                         action='store_true',
                         default=False,
@@ -149,11 +159,21 @@ def get_state_color(s):
 def merge_with_template(model, templfile):
     if not os.path.isfile(templfile):
         templfile = os.path.join(os.path.dirname(sys.argv[0]), templfile)
-    with open(templfile) as f:
-        templ = airspeed.Template(f.read())
+    templ = pynml.get_airspeed_template(templfile)
     return templ.merge(model)
 
 
+def get_template_gates(channel_summary):
+    """
+    Ids of the gates of a channel (from pynml.get_neuroml_summary) which can be
+    recorded by TEMPLATE_FILE, in the order of TEMPLATE_GATE_TYPES
+    """
+    gates = []
+    for gate_type in TEMPLATE_GATE_TYPES:
+        gates += [g for g, name in channel_summary['gates'] if name == gate_type]
+    return gates
+
+
 def generate_lems_channel_analyser(channel_file, channel, min_target_voltage, \
                       step_target_voltage, max_target_voltage, clamp_delay, \
                       clamp_duration, clamp_base_voltage, duration, erev, gates, \
@@ -197,12 +217,12 @@ def generate_lems_channel_analyser(channel_file, channel, min_target_voltage, \
 def main():
 
     args = process_args()
-        
+    
     verbose = args.v
     
     ## Get name of channel mechanism to test
 
-    if verbose: print("Going to test channel from file: "+ args.channelFile)
+    if verbose: print("Going to test channels from file(s): %s"%args.channelFiles)
     
     step_target_voltage = args.stepTargetVoltage
     clamp_delay = args.clampDelay 
@@ -215,27 +235,24 @@ def main():
     chan_list = []
     info["channels"] = chan_list
     
+    ## Generate the LEMS files for all channels first...
+    
+    tests = []
+    
     for channel_file in args.channelFiles:
 
         if not os.path.isfile(channel_file):
             print("File could not be found: %s!\n"%channel_file)
             exit(1)
-        doc = loaders.NeuroMLLoader.load(channel_file)
-
-        channels = []
-        for c in doc.ion_channel_hhs: channels.append(c)
-        for c in doc.ion_channel: channels.append(c)
+        # Only the ids of the channels & gates are needed, unless the rates are calculated directly
+        summary = pynml.get_neuroml_summary(channel_file)
+        doc = None
 
-        for ic in channels:    
-            channel_id = ic.id
-            gates = []
+        channel_ids = [c for c, name in summary['components'] if name in ('ionChannelHH', 'ionChannel')]
 
-            for g in ic.gates:
-                gates.append(g.id)
-            for g in ic.gate_hh_rates:
-                gates.append(g.id)
-            for g in ic.gate_hh_tau_infs:
-                gates.append(g.id)
+        for channel_id in channel_ids:
+            channel_summary = summary['channels'][channel_id]
+            gates = get_template_gates(channel_summary)
 
             if len(gates) == 0:
                 print("No gates found in a channel with ID %s"%channel_id)
@@ -248,9 +265,8 @@ def main():
                     chan_list.append(channel_info)
                     channel_info['id'] = channel_id
                     channel_info['file'] = channel_file
-                    if ic.notes:
-                        #print ic.notes
-                        channel_info['notes'] = ic.notes
+                    if channel_summary['notes']:
+                        channel_info['notes'] = channel_summary['notes']
                         
                 lems_content = generate_lems_channel_analyser(channel_file, channel_id, args.minV, \
                                   step_target_voltage, args.maxV, clamp_delay, \
@@ -265,50 +281,64 @@ def main():
                 lf.close()
 
                 print("Written generated LEMS file to %s\n"%new_lems_file)
-
-                if not args.norun:
-                    results = pynml.run_lems_with_jneuroml(new_lems_file, nogui=True, load_saved_data=True, plot=False)
-
-                    if not args.nogui:
-                        v = "rampCellPop0[0]/v"
-
-                        fig = pylab.figure()
-                        fig.canvas.set_window_title("Time Course(s) of activation variables of %s from %s at %sdegC"%(channel_id, channel_file, args.temperature))
-
-                        pylab.xlabel('Membrane potential (V)')
-                        pylab.ylabel('Time Course - tau (s)')
-                        pylab.grid('on')
-                        for g in gates:
-                            g_tau = "rampCellPop0[0]/test/%s/%s/tau"%(channel_id, g)
-                            col=get_state_color(g)
-                            pylab.plot(results[v], results[g_tau], color=col, linestyle='-', label="%s %s tau"%(channel_id, g))
-                            pylab.gca().autoscale(enable=True, axis='x', tight=True)
-
-                        pylab.legend()
-
-                        if args.html:
-                            pylab.savefig('html/%s.tau.png'%channel_id)
-
-                        fig = pylab.figure()
-                        fig.canvas.set_window_title("Steady state(s) of activation variables of %s from %s at %sdegC"%(channel_id, channel_file, args.temperature))
-                        pylab.xlabel('Membrane potential (V)')
-                        pylab.ylabel('Steady state - inf')
-                        pylab.grid('on')
-                        for g in gates:
-                            g_inf = "rampCellPop0[0]/test/%s/%s/inf"%(channel_id, g)
-                            #print("Plotting %s"%(g_inf))
-                            col=get_state_color(g)
-                            pylab.plot(results[v], results[g_inf], color=col, linestyle='-', label="%s %s inf"%(channel_id, g))
-                            pylab.gca().autoscale(enable=True, axis='x', tight=True)
-                        pylab.legend()
-
-                        if args.html:
-                            pylab.savefig('html/%s.inf.png'%channel_id)
-
+                
+                test = {'channel_id': channel_id, 
+                        'channel_file': channel_file, 
+                        'gates': gates, 
+                        'lems_file': new_lems_file}
+                tests.append(test)
+                
+                if args.analytical:
+                    if doc is None:
+                        # Only the channels are built, not the rest of the file
+                        doc = pynml.read_neuroml2_components(channel_file, channel_ids)
+                    ic = [c for c in list(doc.ion_channel_hhs) + list(doc.ion_channel) if c.id == channel_id][0]
+                    start = time.time()
+                    test['analytical_results'] = get_analytical_results(ic, args.minV, args.maxV, args.temperature)
+                    test['analytical_time'] = time.time() - start
+
+    ## ...then run them all (in parallel if -processes > 1)...
+    
+    failed = []
+    if not args.norun:
+        to_run = [test['lems_file'] for test in tests if test.get('analytical_results') is None]
+        batch_results = pynml.run_lems_batch(to_run, 
+                                             max_workers=args.processes, 
+                                             load_saved_data=True,
+                                             verbose=verbose or not args.nogui)
+        
+        run_info = {}
+        for job_result in batch_results:
+            run_info[job_result['lems_file']] = job_result
+        for test in tests:
+            if test.get('analytical_results') is not None:
+                run_info[test['lems_file']] = {'success': True, 
+                                               'results': test['analytical_results'], 
+                                               'wall_time': test['analytical_time']}
+            
+        print("\nTime taken to run (and reload data for) each channel:")
+        for test in tests:
+            job_result = run_info[test['lems_file']]
+            print("  %s (%s): %.3f s%s%s"%(test['channel_id'], test['channel_file'], job_result['wall_time'], 
+                                          ' (calculated directly)' if test.get('analytical_results') is not None else '',
+                                          '' if job_result['success'] else ', failed: %s'%job_result['error']))
+            if not job_result['success']:
+                failed.append(test['channel_id'])
+        print("")
+
+        ## ...and plot the results
+                
+        for test in tests:
+            job_result = run_info[test['lems_file']]
+            if job_result['success'] and not args.nogui:
+                plot_channel_results(test['channel_id'], test['channel_file'], test['gates'], 
+                                     job_result['results'], args.temperature, args.html)
 
         
     if not args.html:
-        pylab.show()
+        if not args.nogui:
+            import matplotlib.pyplot as pylab
+            pylab.show()
     else:
         pp = pprint.PrettyPrinter(depth=4)
         pp.pprint(info)
@@ -319,6 +349,75 @@ def main():
         lf.write(merged)
         lf.close()
         print('Written HTML info to: %s'%new_html_file)
+        
+    if failed:
+        print("Failed to run the LEMS files for %i channel(s): %s"%(len(failed), ', '.join(failed)))
+        exit(1)
+
+
+def get_analytical_results(ion_channel, min_v, max_v, temperature, num_points=1000):
+    """
+    Calculate inf & tau for all gates of the channel directly (see hh_rates.py),
+    in the same format as the results of the LEMS file for the channel. Returns
+    None if any of the gates can't be evaluated this way, so it needs to be 
+    simulated.
+    """
+    import numpy as np
+    from pyneuroml.analysis.hh_rates import evaluate_channel_gates, UnsupportedGateError
+    
+    v = np.linspace(min_v, max_v, num_points) / 1000.0
+    try:
+        values = evaluate_channel_gates(ion_channel, v, temperature)
+    except UnsupportedGateError as e:
+        print("Cannot calculate rates of %s directly (%s), it will be simulated"%(ion_channel.id, e))
+        return None
+    
+    results = {"rampCellPop0[0]/v": v}
+    for g in values:
+        results["rampCellPop0[0]/test/%s/%s/inf"%(ion_channel.id, g)] = values[g]['inf']
+        results["rampCellPop0[0]/test/%s/%s/tau"%(ion_channel.id, g)] = values[g]['tau']
+        
+    return results
+
+
+def plot_channel_results(channel_id, channel_file, gates, results, temperature, html=False):
+    
+    import matplotlib.pyplot as pylab
+    
+    v = "rampCellPop0[0]/v"
+
+    fig = pylab.figure()
+    fig.canvas.set_window_title("Time Course(s) of activation variables of %s from %s at %sdegC"%(channel_id, channel_file, temperature))
+
+    pylab.xlabel('Membrane potential (V)')
+    pylab.ylabel('Time Course - tau (s)')
+    pylab.grid('on')
+    for g in gates:
+        g_tau = "rampCellPop0[0]/test/%s/%s/tau"%(channel_id, g)
+        col=get_state_color(g)
+        pylab.plot(results[v], results[g_tau], color=col, linestyle='-', label="%s %s tau"%(channel_id, g))
+        pylab.gca().autoscale(enable=True, axis='x', tight=True)
+
+    pylab.legend()
+
+    if html:
+        pylab.savefig('html/%s.tau.png'%channel_id)
+
+    fig = pylab.figure()
+    fig.canvas.set_window_title("Steady state(s) of activation variables of %s from %s at %sdegC"%(channel_id, channel_file, temperature))
+    pylab.xlabel('Membrane potential (V)')
+    pylab.ylabel('Steady state - inf')
+    pylab.grid('on')
+    for g in gates:
+        g_inf = "rampCellPop0[0]/test/%s/%s/inf"%(channel_id, g)
+        #print("Plotting %s"%(g_inf))
+        col=get_state_color(g)
+        pylab.plot(results[v], results[g_inf], color=col, linestyle='-', label="%s %s inf"%(channel_id, g))
+        pylab.gca().autoscale(enable=True, axis='x', tight=True)
+    pylab.legend()
+
+    if html:
+        pylab.savefig('html/%s.inf.png'%channel_id)
 
 
 if __name__ == '__main__':
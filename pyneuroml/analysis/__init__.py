@@ -1,6 +1,6 @@
 from pyneuroml import pynml
-from pyneuroml.lems.LEMSSimulation import LEMSSimulation
-import neuroml as nml
+
+import math
 
 
 def generate_current_vs_frequency_curve(nml2_file, 
@@ -14,25 +14,144 @@ def generate_current_vs_frequency_curve(nml2_file,
                                         temperature = "32degC",
                                         plot_voltage_traces=False,
                                         plot_if=True,
-                                        simulator="jNeuroML"):
-                                            
-                                            
-    from pyelectro.analysis import max_min
-    from pyelectro.analysis import mean_spike_frequency
-    import numpy as np
+                                        simulator="jNeuroML",
+                                        num_processors=1,
+                                        max_cells_per_simulation=None,
+                                        refine_tolerance_nA=None,
+                                        refine_freq_jump=None,
+                                        max_refinements=10,
+                                        verbose=True):
+    """
+    Generate the firing frequency of a cell for a range of input currents.
     
-    sim_id = 'iv_%s'%cell_id
-    duration = analysis_duration+analysis_delay
-    ls = LEMSSimulation(sim_id, duration, dt)
-    
-    ls.include_neuroml2_file(nml2_file)
+    The amplitudes are split over up to num_processors simulations which run 
+    in parallel (each with at most max_cells_per_simulation cells, if given), 
+    and the results of each are analysed as soon as it finishes.
     
+    If refine_tolerance_nA is given, further simulations are run for currents
+    half way between neighbouring amplitudes where the cell starts firing (or 
+    where the frequency changes by more than refine_freq_jump Hz, if given), 
+    until these are no more than refine_tolerance_nA apart (with the progress
+    of each refinement printed if verbose).
+    """
+                                            
     stims = []
     amp = start_amp_nA
     while amp<=end_amp_nA : 
         stims.append(amp)
         amp+=step_nA
         
+    if_results = {}
+    
+    run_if_simulations(nml2_file, cell_id, stims, 'iv_%s'%cell_id, if_results, analysis_duration, 
+                       analysis_delay, dt, temperature, plot_voltage_traces, simulator, 
+                       num_processors, max_cells_per_simulation)
+    
+    refinement = 0
+    while refine_tolerance_nA is not None and refinement < max_refinements:
+        amps = sorted(if_results.keys())
+        new_stims = []
+        for a0, a1 in zip(amps[:-1], amps[1:]):
+            f0 = if_results[a0]
+            f1 = if_results[a1]
+            if a1 - a0 > refine_tolerance_nA:
+                if (f0 == 0) != (f1 == 0) or (refine_freq_jump is not None and abs(f1-f0) > refine_freq_jump):
+                    new_stims.append((a0+a1)/2.0)
+        if len(new_stims) == 0:
+            break
+        refinement += 1
+        pynml.print_comment("Refinement %i: adding %i amplitudes: %s"%(refinement, len(new_stims), new_stims), verbose)
+        run_if_simulations(nml2_file, cell_id, new_stims, 'iv_%s_r%i'%(cell_id, refinement), if_results, 
+                           analysis_duration, analysis_delay, dt, temperature, plot_voltage_traces, 
+                           simulator, num_processors, max_cells_per_simulation)
+        
+    if plot_if:
+        
+        from matplotlib import pyplot as plt
+        
+        plt.xlabel('Input current (nA)')
+        plt.ylabel('Firing frequency (Hz)')
+        plt.grid('on')
+        stims = sorted(if_results.keys())
+        freqs = []
+        for s in stims:
+            freqs.append(if_results[s])
+        plt.plot(stims, freqs, 'o')
+         
+        plt.show()
+        
+    return if_results
+
+
+def run_if_simulations(nml2_file, cell_id, stims, sim_id, if_results, analysis_duration, analysis_delay,
+                       dt, temperature, plot_voltage_traces, simulator, num_processors=1, max_cells_per_simulation=None):
+    """
+    Simulate the cell with each of the input currents in stims and add the 
+    firing frequencies to if_results. The currents are split into (up to)
+    num_processors simulations (each with at most max_cells_per_simulation 
+    cells) which are run in parallel.
+    """
+    
+    shard_size = len(stims)
+    if num_processors > 1:
+        shard_size = int(math.ceil(len(stims)/float(num_processors)))
+    if max_cells_per_simulation is not None:
+        shard_size = min(shard_size, max_cells_per_simulation)
+        
+    shards = [stims[i:i+shard_size] for i in range(0, len(stims), shard_size)]
+    
+    if len(shards) == 1:
+        lems_file_name, pop_id = generate_if_simulation(nml2_file, cell_id, stims, sim_id, 
+                                                        analysis_duration+analysis_delay, dt, temperature)
+        if simulator == "jNeuroML":
+            results = pynml.run_lems_with_jneuroml(lems_file_name, 
+                                                    nogui=True, 
+                                                    load_saved_data=True, 
+                                                    plot=plot_voltage_traces)
+        elif simulator == "jNeuroML_NEURON":
+            results = pynml.run_lems_with_jneuroml_neuron(lems_file_name, 
+                                                    nogui=True, 
+                                                    load_saved_data=True, 
+                                                    plot=plot_voltage_traces)
+        
+        if_results.update(analyse_if_traces(results, pop_id, stims, analysis_duration, analysis_delay))
+        return
+    
+    shard_info = {}
+    for i in range(len(shards)):
+        lems_file_name, pop_id = generate_if_simulation(nml2_file, cell_id, shards[i], '%s_%i'%(sim_id, i), 
+                                                        analysis_duration+analysis_delay, dt, temperature)
+        shard_info[lems_file_name] = (pop_id, shards[i])
+        
+    def analyse_shard(job_result):
+        if not job_result['success']:
+            raise Exception("Error running %s: %s"%(job_result['lems_file'], job_result['error']))
+        pop_id, shard_stims = shard_info[job_result['lems_file']]
+        if_results.update(analyse_if_traces(job_result['results'], pop_id, shard_stims, analysis_duration, analysis_delay))
+        
+    pynml.run_lems_batch(sorted(shard_info.keys()), 
+                         simulator=simulator, 
+                         max_workers=num_processors, 
+                         load_saved_data=True, 
+                         callback=analyse_shard)
+    
+    if plot_voltage_traces:
+        for lems_file_name in sorted(shard_info.keys()):
+            pynml.reload_saved_data(lems_file_name, plot=True, simulator=simulator)
+            
+            
+def generate_if_simulation(nml2_file, cell_id, stims, sim_id, duration, dt, temperature):
+    """
+    Generate a network with a cell for each of the input currents in stims,
+    and a LEMS file to simulate it. Returns the LEMS file name and the id of the
+    population of cells.
+    """
+    import neuroml as nml
+    from pyneuroml.lems.LEMSSimulation import LEMSSimulation
+    
+    ls = LEMSSimulation(sim_id, duration, dt)
+    
+    ls.include_neuroml2_file(nml2_file)
     
     number_cells = len(stims)
     pop = nml.Population(id="population_of_%s"%cell_id,
@@ -50,7 +169,7 @@ def generate_current_vs_frequency_curve(nml2_file,
     
     for i in range(number_cells):
         stim_amp = "%snA"%stims[i]
-        input_id = ("input_%s"%stim_amp).replace('.','_')
+        input_id = ("input_%s"%stim_amp).replace('.','_').replace('-','min')
         pg = nml.PulseGenerator(id=input_id,
                                     delay="0ms",
                                     duration="%sms"%duration,
@@ -77,60 +196,35 @@ def generate_current_vs_frequency_curve(nml2_file,
     of0 = 'Volts_file'
     ls.create_output_file(of0, "%s.v.dat"%sim_id)
     
-    for i in range(number_cells):
-        ref = "v_cell%i"%i
-        quantity = "%s[%i]/v"%(pop.id, i)
-        ls.add_line_to_display(disp0, ref, quantity, "1mV", pynml.get_next_hex_color())
-    
-        ls.add_column_to_output_file(of0, ref, quantity)
+    refs = ["v_cell%i"%i for i in range(number_cells)]
+    quantities = ["%s[%i]/v"%(pop.id, i) for i in range(number_cells)]
+    ls.add_lines_to_display(disp0, quantities, "1mV", line_ids=refs)
+    ls.add_columns_to_output_file(of0, quantities, refs)
     
     lems_file_name = ls.save_to_file()
     
-    if simulator == "jNeuroML":
-        results = pynml.run_lems_with_jneuroml(lems_file_name, 
-                                                nogui=True, 
-                                                load_saved_data=True, 
-                                                plot=plot_voltage_traces)
-    elif simulator == "jNeuroML_NEURON":
-        results = pynml.run_lems_with_jneuroml_neuron(lems_file_name, 
-                                                nogui=True, 
-                                                load_saved_data=True, 
-                                                plot=plot_voltage_traces)
-                                                
+    return lems_file_name, pop.id
+    
+    
+def analyse_if_traces(results, pop_id, stims, analysis_duration, analysis_delay):
+    """
+    Get the firing frequency of each cell in the population (given the input 
+    currents in stims) from the reloaded results of a simulation
+    """
+    
+    import numpy as np
+    from pyneuroml.analysis.spikes import get_spike_counts
     
     #print(results.keys())
+    t = np.asarray(results['t'])*1000
+    v = np.column_stack([results["%s[%i]/v"%(pop_id, i)] for i in range(len(stims))])*1000
+    
+    total_counts = get_spike_counts(t, v, threshold=0)
+    counts = get_spike_counts(t, v, threshold=0, start=analysis_delay, end=analysis_duration+analysis_delay)
+    freqs = np.where(total_counts > 2, 1000 * counts/float(analysis_duration), 0)
+    
     if_results = {}
-    for i in range(number_cells):
-        t = np.array(results['t'])*1000
-        v = np.array(results["%s[%i]/v"%(pop.id, i)])*1000
-        
-        mm = max_min(v, t, delta=0, peak_threshold=0)
-        spike_times = mm['maxima_times']
-        freq = 0
-        if len(spike_times) > 2:
-            count = 0
-            for s in spike_times:
-                if s >= analysis_delay and s < (analysis_duration+analysis_delay):
-                    count+=1
-            freq = 1000 * count/float(analysis_duration)
-                    
-        mean_freq = mean_spike_frequency(spike_times) 
-        # print("--- %s nA, spike times: %s, mean_spike_frequency: %f, freq (%fms -> %fms): %f"%(stims[i],spike_times, mean_freq, analysis_delay, analysis_duration+analysis_delay, freq))
-        if_results[stims[i]] = freq
-        
-    if plot_if:
-        
-        from matplotlib import pyplot as plt
-        
-        plt.xlabel('Input current (nA)')
-        plt.ylabel('Firing frequency (Hz)')
-        plt.grid('on')
-        stims = sorted(if_results.keys())
-        freqs = []
-        for s in stims:
-            freqs.append(if_results[s])
-        plt.plot(stims, freqs, 'o')
-         
-        plt.show()
+    for i in range(len(stims)):
+        if_results[stims[i]] = float(freqs[i])
         
-    return if_results
\ No newline at end of file
+    return if_results
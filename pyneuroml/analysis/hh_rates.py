@@ -0,0 +1,193 @@
+"""
+
+Direct evaluation of the steady state (inf) and time course (tau) of the gates
+of a NeuroML 2 ion channel (as read by libNeuroML) over a range of voltages,
+for the standard HH rate/variable/time course forms, without running a
+simulation.
+
+All values are in SI units, as in the output of the LEMS simulations generated
+by NML2ChannelAnalysis: voltages in V, tau in s.
+
+"""
+
+import re
+
+import numpy as np
+
+
+class UnsupportedGateError(Exception):
+    pass
+
+
+UNITS = {'V': 1, 'mV': 1e-3,
+         's': 1, 'ms': 1e-3,
+         'per_s': 1, 'per_ms': 1e3, 'Hz': 1,
+         'K': 1, 'degC': 1,
+         '': 1}
+
+
+def get_si_value(quantity):
+    """
+    Convert a NeuroML quantity with one of the units used in gates (e.g. -40mV,
+    0.1per_ms) into SI units
+    """
+    match = re.match(r'^\s*([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)\s*(\w*)\s*$', str(quantity))
+    if match is None or match.group(2) not in UNITS:
+        raise UnsupportedGateError("Cannot convert quantity: %s"%quantity)
+
+    value = float(match.group(1))
+    unit = match.group(2)
+    if unit == 'degC':
+        return value + 273.15
+    return value * UNITS[unit]
+
+
+def evaluate_rate(rate, v):
+    """
+    Evaluate an HHRate (forwardRate/reverseRate) at voltages v
+    """
+    if rate is None:
+        raise UnsupportedGateError("Missing rate in gate")
+
+    r = get_si_value(rate.rate)
+    midpoint = get_si_value(rate.midpoint)
+    scale = get_si_value(rate.scale)
+    x = (v - midpoint) / scale
+
+    if rate.type == 'HHExpRate':
+        return r * np.exp(x)
+    if rate.type == 'HHSigmoidRate':
+        return r / (1 + np.exp(-x))
+    if rate.type == 'HHExpLinearRate':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(x != 0, r * x / (1 - np.exp(-x)), r)
+
+    raise UnsupportedGateError("Unsupported rate type: %s"%rate.type)
+
+
+def evaluate_variable(variable, v):
+    """
+    Evaluate an HHVariable (steadyState) at voltages v
+    """
+    if variable is None:
+        raise UnsupportedGateError("Missing variable in gate")
+
+    r = float(variable.rate)
+    midpoint = get_si_value(variable.midpoint)
+    scale = get_si_value(variable.scale)
+    x = (v - midpoint) / scale
+
+    if variable.type == 'HHExpVariable':
+        return r * np.exp(x)
+    if variable.type == 'HHSigmoidVariable':
+        return r / (1 + np.exp(-x))
+    if variable.type == 'HHExpLinearVariable':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(x != 0, r * x / (1 - np.exp(-x)), r)
+
+    raise UnsupportedGateError("Unsupported steady state type: %s"%variable.type)
+
+
+def evaluate_time_course(time_course, v):
+    """
+    Evaluate an HHTime (timeCourse) at voltages v
+    """
+    if time_course is None:
+        raise UnsupportedGateError("Missing time course in gate")
+
+    if time_course.type == 'fixedTimeCourse':
+        return np.ones_like(v) * get_si_value(time_course.tau)
+
+    raise UnsupportedGateError("Unsupported time course type: %s"%time_course.type)
+
+
+def get_rate_scale(gate, temperature):
+    """
+    Factor by which the rates of a gate are scaled at temperature (degC)
+    """
+    q10_settings = getattr(gate, 'q10_settings', None)
+    if q10_settings is None:
+        return 1.0
+    if q10_settings.type == 'q10Fixed':
+        return float(q10_settings.fixed_q10)
+    if q10_settings.type == 'q10ExpTemp':
+        experimental_temp = get_si_value(q10_settings.experimental_temp)
+        return float(q10_settings.q10_factor) ** ((temperature + 273.15 - experimental_temp) / 10.0)
+
+    raise UnsupportedGateError("Unsupported q10 settings type: %s"%q10_settings.type)
+
+
+def evaluate_gate(gate, gate_type, v, temperature):
+    """
+    Evaluate inf and tau of a gate of type gate_type (e.g. gateHHrates) at
+    voltages v (V) and temperature (degC). Returns a tuple of numpy arrays.
+    """
+    if getattr(gate, 'sub_gates', None):
+        raise UnsupportedGateError("Gates with sub gates are not supported")
+
+    rate_scale = get_rate_scale(gate, temperature)
+
+    if gate_type in ('gateHHrates', 'gateHHratesTau', 'gateHHratesInf', 'gateHHratesTauInf'):
+        alpha = evaluate_rate(gate.forward_rate, v)
+        beta = evaluate_rate(gate.reverse_rate, v)
+
+    if gate_type in ('gateHHrates', 'gateHHratesTau'):
+        inf = alpha / (alpha + beta)
+    elif gate_type in ('gateHHtauInf', 'gateHHratesInf', 'gateHHratesTauInf', 'gateHHInstantaneous'):
+        inf = evaluate_variable(gate.steady_state, v)
+    else:
+        raise UnsupportedGateError("Unsupported gate type: %s"%gate_type)
+
+    if gate_type in ('gateHHrates', 'gateHHratesInf'):
+        tau = 1 / ((alpha + beta) * rate_scale)
+    elif gate_type in ('gateHHtauInf', 'gateHHratesTau', 'gateHHratesTauInf'):
+        tau = evaluate_time_course(gate.time_course, v) / rate_scale
+    else:
+        tau = np.zeros_like(v)
+
+    return inf, tau
+
+
+GATE_LISTS = [('gate_hh_rates', 'gateHHrates'),
+              ('gate_hh_tau_infs', 'gateHHtauInf'),
+              ('gate_h_hrates_taus', 'gateHHratesTau'),
+              ('gate_h_hrates_infs', 'gateHHratesInf'),
+              ('gate_h_hrates_tau_infs', 'gateHHratesTauInf'),
+              ('gate_hh_instantaneouses', 'gateHHInstantaneous')]
+
+
+def get_gates(ion_channel):
+    """
+    List of (gate, gate type) for all of the gates in an ion channel. Raises
+    UnsupportedGateError if the channel has gates of any other type (e.g.
+    gateKS, gateFractional), so that these are not silently left out.
+    """
+    known = ['gates'] + [gate_list for gate_list, gate_type in GATE_LISTS]
+    for name, value in sorted(vars(ion_channel).items()):
+        if name.startswith('gate') and name not in known and isinstance(value, list) and len(value) > 0:
+            raise UnsupportedGateError("Unsupported gates in channel %s: %s"%(ion_channel.id, name))
+
+    gates = []
+    for g in ion_channel.gates:
+        gates.append((g, g.type))
+    for gate_list, gate_type in GATE_LISTS:
+        for g in getattr(ion_channel, gate_list, []):
+            gates.append((g, gate_type))
+    return gates
+
+
+def evaluate_channel_gates(ion_channel, v, temperature):
+    """
+    Evaluate inf and tau of all gates of ion_channel at voltages v (V) and
+    temperature (degC). Returns a dict with gate id as key and a dict with
+    numpy arrays for inf & tau as value.
+
+    Raises UnsupportedGateError if any of the gates (e.g. concentration
+    dependent ones, or ones using custom ComponentTypes) cannot be evaluated.
+    """
+    v = np.asarray(v, dtype=float)
+    values = {}
+    for gate, gate_type in get_gates(ion_channel):
+        inf, tau = evaluate_gate(gate, gate_type, v, temperature)
+        values[gate.id] = {'inf': inf, 'tau': tau}
+    return values
@@ -0,0 +1,697 @@
+"""
+
+Parameter sweeps: run variants of a LEMS simulation in which attributes of
+components (e.g. condDensity of a channelDensity, temperature of a network,
+amplitude of a pulseGenerator) in the LEMS file or the NeuroML/LEMS files it
+includes are set to different values.
+
+For each variant, copies of the files containing the changed components (and
+of the files which include those, up to the LEMS file) are written to a
+directory named from the values of the parameters, with the other includes
+pointing at the original files. Variants with the same values are only run
+once, the simulations are run in parallel with pynml.run_lems_batch (using
+the result cache if requested), and the results are collected in a
+SweepResults table.
+
+As starting the JVM and loading the model can take longer than a short
+simulation, variants can instead be packed into one simulation (see
+ParameterSweep.run): each variant gets copies of the components it changes
+(and of those which refer to them, e.g. the cell containing a changed
+channelDensity) and of the populations, projections and inputs of the
+network, with ids suffixed by _v0, _v1..., and the columns of all variants
+are saved in one OutputFile, which is unpacked into the data of each variant.
+
+Example:
+
+    sweep = ParameterSweep('LEMS_HH.xml')
+    sweep.add_grid({('naChans', 'condDensity'): [100, 120, 140],
+                    ('net1', 'temperature'): [6.3, 20]})
+    results = sweep.run(max_workers=4, analysis=get_spike_count)
+    results.save('HH_sweep.dat')
+
+"""
+
+from __future__ import absolute_import
+import hashlib
+import itertools
+import os
+import re
+
+from lxml import etree
+
+from pyneuroml.includes import INCLUDE_ATTRIBUTES, resolve_include
+from pyneuroml import pynml
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+NUMBER_WITH_UNITS = re.compile(r'^\s*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?(.*)$')
+
+# Names in attribute values (ids, or parts of paths like hhpop[0]/v) which may refer to components
+REFERENCE = re.compile(r'(?<!\w)[A-Za-z_]\w*')
+
+TIME_UNITS = {'s': 1000.0, 'ms': 1.0, 'us': 1e-3}
+
+# Used to choose the number of variants packed in one simulation: jNeuroML
+# keeps all of the recorded values (as boxed Doubles in lists) in memory until
+# the end of the simulation, and each variant adds an instance of its cells
+PACK_MEMORY_FRACTION = 0.5
+BYTES_PER_RECORDED_VALUE = 32
+BYTES_PER_PACKED_VARIANT = 1024*1024
+MAX_PACK_SIZE = 200
+
+
+def format_value(original, value):
+    """
+    The value of an attribute, which was original, to set for value. Strings
+    are used as given; numbers are given the units of the original value
+    (e.g. 120 for "100mS_per_cm2" gives "120mS_per_cm2"), and written the same
+    way whatever their type (so e.g. 120 and 120.0 give the same variant).
+    """
+    if isinstance(value, string_types):
+        return value
+    number = repr(float(value))
+    if number.endswith('.0'):
+        number = number[:-2]
+    match = NUMBER_WITH_UNITS.match(original)
+    units = match.group(1) if match else ''
+    return "%s%s"%(number, units)
+
+
+def get_parameter_name(parameter):
+
+    return "%s.%s"%parameter
+
+
+def get_time_in_ms(time):
+    """
+    Convert a LEMS time (e.g. 300ms, 0.3s) to ms
+    """
+    match = NUMBER_WITH_UNITS.match(time)
+    if match is None or match.group(1).strip() not in TIME_UNITS:
+        raise ValueError("Could not read %s as a time"%time)
+    units = match.group(1)
+    return float(time[:len(time)-len(units)]) * TIME_UNITS[units.strip()]
+
+
+def rename_references(value, renames):
+    """
+    Replace any names in value (an attribute value) which are keys of renames
+    """
+    return REFERENCE.sub(lambda match: renames.get(match.group(0), match.group(0)), value)
+
+
+def rename_all_references(element, renames):
+    """
+    Rename the references in all attributes of element and its descendants
+    """
+    for descendant in element.iter():
+        if isinstance(descendant.tag, str):
+            for attribute, value in descendant.attrib.items():
+                descendant.set(attribute, rename_references(value, renames))
+
+
+def unpack_results(results, quantities):
+    """
+    The data of one variant from the results of a packed simulation, with
+    quantities a dict of the quantities saved for the variant (e.g.
+    hhpop_v3[0]/v) to the quantities in the unpacked simulation (hhpop[0]/v)
+    """
+    unpacked = {'t': results['t']}
+    for packed_quantity, quantity in quantities.items():
+        unpacked[quantity] = results[packed_quantity]
+    return unpacked
+
+
+class SweepResults(object):
+    """
+    Table of the results of a sweep, with a row for each variant: the values of
+    the parameters (columns named component_id.attribute), variant_id,
+    lems_file, success, error, wall_time and any values returned by the
+    analysis function.
+    """
+
+    def __init__(self, columns, rows):
+
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+
+        return len(self.rows)
+
+    def get_column(self, name):
+
+        return [row.get(name) for row in self.rows]
+
+    def get_successful_rows(self):
+
+        return [row for row in self.rows if row['success']]
+
+    def get_data(self, index, quantities=None):
+        """
+        Reload the saved data of the variant in row index
+        """
+        row = self.rows[index]
+        packed_quantities = row.get('packed_quantities')
+        if packed_quantities is None:
+            return pynml.reload_saved_data(row['lems_file'], quantities=quantities)
+
+        if quantities is not None:
+            packed_quantities = dict([(p, q) for p, q in packed_quantities.items() if q in quantities])
+        results = pynml.reload_saved_data(row['lems_file'], quantities=list(packed_quantities.keys()))
+        return unpack_results(results, packed_quantities)
+
+    def save(self, file_name):
+        """
+        Save as a tab separated table
+        """
+        table = open(file_name, 'w')
+        table.write("# %s\n"%'\t'.join(self.columns))
+        for row in self.rows:
+            table.write('\t'.join([str(row.get(column, '')) for column in self.columns])+'\n')
+        table.close()
+        print("Written results of %i variants to: %s"%(len(self.rows), file_name))
+
+
+class ParameterSweep(object):
+
+    def __init__(self, lems_file, sweep_dir=None, simulator="jNeuroML"):
+
+        self.lems_file = os.path.abspath(lems_file)
+        if sweep_dir is None:
+            sweep_dir = "%s_sweep"%os.path.splitext(os.path.basename(lems_file))[0]
+        self.sweep_dir = os.path.abspath(sweep_dir)
+        self.simulator = simulator
+
+        self.parameters = []
+        self.variants = []
+
+        self.files = None
+
+    def add_variant(self, values):
+        """
+        Add a variant, with values a dict of (component_id, attribute) to value
+        """
+        for parameter in values:
+            if parameter not in self.parameters:
+                self.parameters.append(parameter)
+        self.variants.append(dict(values))
+
+    def add_grid(self, grid):
+        """
+        Add a variant for every combination of the values in grid, a dict of
+        (component_id, attribute) to a list of values
+        """
+        parameters = list(grid.keys())
+        for combination in itertools.product(*[grid[p] for p in parameters]):
+            self.add_variant(dict(zip(parameters, combination)))
+
+    def add_random_samples(self, ranges, number, seed=None):
+        """
+        Add number variants with values drawn uniformly from ranges, a dict of
+        (component_id, attribute) to (min, max)
+        """
+        import numpy as np
+
+        random_state = np.random.RandomState(seed)
+        parameters = list(ranges.keys())
+        for i in range(number):
+            self.add_variant(dict([(p, float(random_state.uniform(*ranges[p]))) for p in parameters]))
+
+    def add_latin_hypercube_samples(self, ranges, number, seed=None):
+        """
+        Add number variants forming a Latin hypercube sample of ranges, a dict
+        of (component_id, attribute) to (min, max): the range of each parameter
+        is split into number equal intervals, each of which is sampled once
+        """
+        import numpy as np
+
+        random_state = np.random.RandomState(seed)
+        parameters = list(ranges.keys())
+        samples = {}
+        for p in parameters:
+            low, high = ranges[p]
+            fractions = (random_state.permutation(number) + random_state.uniform(size=number)) / number
+            samples[p] = low + fractions * (high - low)
+        for i in range(number):
+            self.add_variant(dict([(p, float(samples[p][i])) for p in parameters]))
+
+    def _load_files(self):
+        """
+        Parse the LEMS file and the files it includes (recursively)
+        """
+        self.files = {}
+        # Top level components (children of the root elements) by id, and
+        # other elements with ids, which may well be repeated (e.g. segment 0)
+        self.components = {}
+        self.nested_components = {}
+        to_load = [self.lems_file]
+        while to_load:
+            path = to_load.pop()
+            if path in self.files:
+                continue
+            tree = etree.parse(path)
+            includes = []
+            for element in tree.getroot().iter():
+                if not isinstance(element.tag, str):
+                    continue
+                name = etree.QName(element).localname
+                attribute = INCLUDE_ATTRIBUTES.get(name)
+                if attribute and element.get(attribute):
+                    included = resolve_include(path, element.get(attribute))
+                    # Only those found relative to path (which is absolute); 
+                    # others, e.g. Cells.xml, are resolved by jNeuroML
+                    if os.path.isabs(included) and os.path.isfile(included):
+                        includes.append((element, attribute, included))
+                        to_load.append(included)
+                if element.get('id') is not None:
+                    if element.getparent() is tree.getroot():
+                        self.components.setdefault(element.get('id'), []).append((path, element))
+                    elif element is not tree.getroot():
+                        self.nested_components.setdefault(element.get('id'), []).append((path, element))
+            self.files[path] = {'tree': tree, 'includes': includes}
+
+        # Names of copies in the variant directories, unique even if files in different directories have the same name
+        used = set()
+        for path in sorted(self.files.keys(), key=lambda p: p != self.lems_file):
+            name = os.path.basename(path)
+            index = 1
+            while name in used:
+                name = "%i_%s"%(index, os.path.basename(path))
+                index += 1
+            used.add(name)
+            self.files[path]['copy_name'] = name
+
+    def get_component(self, component_id):
+        """
+        The (path, element) of a component: a top level one with id 
+        component_id, otherwise the only element with this id anywhere. 
+        Elements inside a component can also be given by a path of ids from 
+        the top level one, e.g. hhcell/naChans, if their ids are not unique.
+        """
+        if self.files is None:
+            self._load_files()
+
+        parts = component_id.split('/')
+        found = self.components.get(parts[0], [])
+        if len(parts) == 1 and len(found) == 0:
+            found = self.nested_components.get(component_id, [])
+        if len(found) == 0:
+            raise ValueError("No component with id %s in %s or the files it includes"%(parts[0], self.lems_file))
+        if len(found) > 1:
+            raise ValueError("More than one component with id %s, in: %s (give the path from a top level component, "
+                             "e.g. cell_id/%s)"%(parts[0], ', '.join([f for f, e in found]), parts[0]))
+
+        path, element = found[0]
+        for part in parts[1:]:
+            matches = [e for e in element.iter() if e is not element and isinstance(e.tag, str) and e.get('id') == part]
+            if len(matches) != 1:
+                raise ValueError("%s elements with id %s in %s"%('No' if len(matches) == 0 else 'Several', part, component_id))
+            element = matches[0]
+        return path, element
+
+    def get_variant_values(self, variant):
+        """
+        The values to set for the attributes of a variant, as strings
+        """
+        values = {}
+        for (component_id, attribute), value in variant.items():
+            path, element = self.get_component(component_id)
+            original = element.get(attribute)
+            if original is None:
+                raise ValueError("Component %s in %s has no attribute %s"%(component_id, path, attribute))
+            values[(component_id, attribute)] = format_value(original, value)
+        return values
+
+    def get_variant_id(self, values):
+
+        key = ';'.join(["%s.%s=%s"%(c, a, values[(c, a)]) for c, a in sorted(values.keys())])
+        return "v_%s"%hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+    def write_variant(self, values, variant_dir):
+        """
+        Write the files for a variant with the given attribute values to
+        variant_dir, returning the name of its LEMS file
+        """
+        modified = {}
+        for (component_id, attribute), value in values.items():
+            path, element = self.get_component(component_id)
+            modified.setdefault(path, []).append((element, attribute, value))
+
+        return self._write_copies(modified, variant_dir)
+
+    def _write_copies(self, modified, variant_dir):
+        """
+        Write copies of the files in modified, a dict of path to a list of
+        (element, attribute, value) to change, and of the files which include
+        them (and the LEMS file) to variant_dir, returning the name of the LEMS file
+        """
+        copied = {}
+
+        def needs_copy(path):
+            if path not in copied:
+                copied[path] = False
+                includes_copy = [needs_copy(included) for element, attribute, included in self.files[path]['includes']]
+                copied[path] = path == self.lems_file or path in modified or any(includes_copy)
+            return copied[path]
+
+        needs_copy(self.lems_file)
+
+        if not os.path.isdir(variant_dir):
+            os.makedirs(variant_dir)
+
+        for path in [p for p in copied if copied[p]]:
+            file_info = self.files[path]
+            changes = list(modified.get(path, []))
+            for element, attribute, included in file_info['includes']:
+                if copied[included]:
+                    changes.append((element, attribute, self.files[included]['copy_name']))
+                else:
+                    changes.append((element, attribute, os.path.relpath(included, variant_dir)))
+            if path == self.lems_file:
+                # Each variant saves its results in its own directory
+                for element in file_info['tree'].getroot().iter('{*}OutputFile'):
+                    changes.append((element, 'fileName', os.path.join(variant_dir, os.path.basename(element.get('fileName')))))
+
+            originals = [(element, attribute, element.get(attribute)) for element, attribute, value in changes]
+            try:
+                for element, attribute, value in changes:
+                    element.set(attribute, value)
+                file_info['tree'].write(os.path.join(variant_dir, file_info['copy_name']))
+            finally:
+                for element, attribute, original in originals:
+                    element.set(attribute, original)
+
+        return os.path.join(variant_dir, self.files[self.lems_file]['copy_name'])
+
+    def get_top_level_component(self, element):
+        """
+        The child of the root element of its file which contains element
+        """
+        while element.getparent() is not None and element.getparent().getparent() is not None:
+            element = element.getparent()
+        return element
+
+    def get_simulation(self):
+        """
+        The (path, element) of the Simulation in the LEMS file and of the network it targets
+        """
+        sim_info = pynml.get_lems_simulation_info(self.lems_file)
+        return self.get_component(sim_info['id']), self.get_component(sim_info['target'])
+
+    def get_packed_components(self, parameters):
+        """
+        The ids of the components (outside the network) which need a copy for
+        each variant in a packed simulation, in which the given parameters
+        change: the components containing the parameters, and those referring
+        to them (recursively). Raises a ValueError if the variants can't be
+        packed.
+        """
+        (sim_path, sim), (network_path, network) = self.get_simulation()
+
+        if len(list(sim.iter('{*}EventOutputFile'))) > 0:
+            raise ValueError("Cannot pack variants into one simulation, as the events saved by the EventOutputFiles "
+                             "in %s are not unpacked; run with pack_size=1"%self.lems_file)
+
+        packed = set()
+        for component_id, attribute in parameters:
+            path, element = self.get_component(component_id)
+            top_level = self.get_top_level_component(element)
+            if element is network or top_level is sim:
+                raise ValueError("Cannot pack variants of %s.%s into one simulation, as this is not a property of a "
+                                 "cell, input or population; run with pack_size=1"%(component_id, attribute))
+            if top_level is not network:
+                packed.add(top_level.get('id'))
+
+        candidates = []
+        for path, file_info in self.files.items():
+            for element in file_info['tree'].getroot():
+                if isinstance(element.tag, str) and element.get('id') is not None and \
+                   element is not network and element is not sim:
+                    candidates.append(element)
+
+        found = True
+        while found:
+            found = False
+            for element in candidates:
+                if element.get('id') in packed:
+                    continue
+                for descendant in element.iter():
+                    if isinstance(descendant.tag, str) and \
+                       any([name in packed for value in descendant.attrib.values() for name in REFERENCE.findall(value)]):
+                        packed.add(element.get('id'))
+                        found = True
+                        break
+        return packed
+
+    def write_pack(self, variant_values, pack_dir):
+        """
+        Write the files for one simulation containing all of the variants in
+        variant_values (a list of dicts of attribute values) to pack_dir.
+        Returns the name of its LEMS file, and for each variant a dict of the
+        quantities saved for it to the quantities in the unpacked simulation.
+        """
+        from copy import deepcopy
+
+        (sim_path, sim), (network_path, network) = self.get_simulation()
+
+        parameters = set()
+        for values in variant_values:
+            parameters.update(values.keys())
+        packed = sorted(self.get_packed_components(parameters))
+        network_children = [e for e in network if isinstance(e.tag, str)]
+        renamed = packed + [e.get('id') for e in network_children if e.get('id') is not None]
+
+        additions = {}
+        new_network_children = []
+        renames_by_variant = []
+        for index, values in enumerate(variant_values):
+            renames = dict([(name, "%s_v%i"%(name, index)) for name in renamed])
+            for name in renames.values():
+                if name in self.components:
+                    raise ValueError("Cannot pack variants into one simulation, as there is already a component with id %s"%name)
+            renames_by_variant.append(renames)
+
+            changes = []
+            for (component_id, attribute), value in values.items():
+                path, element = self.get_component(component_id)
+                changes.append((element, attribute, value))
+            originals = [(element, attribute, element.get(attribute)) for element, attribute, value in changes]
+            try:
+                for element, attribute, value in changes:
+                    element.set(attribute, value)
+                for component_id in packed:
+                    path, element = self.get_component(component_id)
+                    copy = deepcopy(element)
+                    rename_all_references(copy, renames)
+                    additions.setdefault(path, []).append((element, copy))
+                for element in network_children:
+                    copy = deepcopy(element)
+                    rename_all_references(copy, renames)
+                    new_network_children.append(copy)
+            finally:
+                for element, attribute, original in originals:
+                    element.set(attribute, original)
+
+        # All of the columns of all of the variants are saved in one file
+        original_output_files = list(sim.iter('{*}OutputFile'))
+        if len(original_output_files) == 0:
+            raise ValueError("No OutputFile in the Simulation in %s, so there are no results to unpack"%self.lems_file)
+        output_file = etree.Element(original_output_files[0].tag)
+        output_file.set('id', 'of_pack')
+        output_file.set('fileName', os.path.join(pack_dir, 'pack.dat'))
+        quantities = [{} for values in variant_values]
+        for original_output_file in original_output_files:
+            for column in original_output_file.iter('{*}OutputColumn'):
+                for index, renames in enumerate(renames_by_variant):
+                    packed_quantity = rename_references(column.get('quantity'), renames)
+                    new_column = etree.SubElement(output_file, column.tag)
+                    new_column.set('id', 'c%i'%len(output_file))
+                    new_column.set('quantity', packed_quantity)
+                    quantities[index][packed_quantity] = column.get('quantity')
+
+        old_sim_children = list(sim)
+        old_network_children = list(network)
+        inserted = []
+        try:
+            sim[:] = [e for e in old_sim_children if not isinstance(e.tag, str) or
+                      etree.QName(e).localname not in ('Display', 'OutputFile', 'EventOutputFile')] + [output_file]
+            network[:] = new_network_children
+            for path in additions:
+                for element, copy in additions[path]:
+                    # Copies go after the original (and earlier copies), so they follow what they refer to
+                    last = element
+                    while last.getnext() is not None and last.getnext() in inserted:
+                        last = last.getnext()
+                    last.addnext(copy)
+                    inserted.append(copy)
+            modified = dict([(path, []) for path in list(additions.keys()) + [sim_path, network_path]])
+            lems_file = self._write_copies(modified, pack_dir)
+        finally:
+            for copy in inserted:
+                copy.getparent().remove(copy)
+            network[:] = old_network_children
+            sim[:] = old_sim_children
+
+        return lems_file, quantities
+
+    def get_pack_size(self, max_memory=pynml.default_java_max_memory, max_workers=None, java_memory_budget=None):
+        """
+        The number of variants to pack into each simulation: as many as fit
+        (roughly) in max_memory, but with the variants spread over at least
+        as many simulations as can run at once (see pynml.get_max_parallel_runs).
+        This is 1 if the parameters can't be packed (see get_packed_components).
+        """
+        if self.files is None:
+            self._load_files()
+        try:
+            self.get_packed_components(self.parameters)
+        except ValueError as e:
+            pynml.print_comment("Running each variant in its own simulation: %s"%e, True)
+            return 1
+
+        sim_info = pynml.get_lems_simulation_info(self.lems_file)
+        steps = get_time_in_ms(sim_info['duration']) / get_time_in_ms(sim_info['dt'])
+        columns = sum([len(of['columns']) - 1 for of in sim_info['output_files']])
+        bytes_per_variant = BYTES_PER_PACKED_VARIANT + steps * columns * BYTES_PER_RECORDED_VALUE
+        by_memory = int(PACK_MEMORY_FRACTION * pynml.get_memory_in_mb(max_memory) * 1024 * 1024 // bytes_per_variant)
+
+        num_variants = len(set([self.get_variant_id(self.get_variant_values(v)) for v in self.variants]))
+        workers = pynml.get_max_parallel_runs(max_workers, max_memory, java_memory_budget)
+        by_workers = -(-num_variants // workers)
+        return max(1, min(by_memory, by_workers, MAX_PACK_SIZE))
+
+    def generate(self):
+        """
+        Write the files for all of the variants (only once for variants with
+        the same values). Returns a list with the values (as strings),
+        variant id and LEMS file of each variant.
+        """
+        generated = {}
+        variants = []
+        for variant in self.variants:
+            values = self.get_variant_values(variant)
+            variant_id = self.get_variant_id(values)
+            if variant_id not in generated:
+                generated[variant_id] = self.write_variant(values, os.path.join(self.sweep_dir, variant_id))
+            variants.append((values, variant_id, generated[variant_id]))
+
+        pynml.print_comment("Generated %i LEMS files for %i variants in %s"%(len(generated), len(self.variants), self.sweep_dir), True)
+        return variants
+
+    def generate_packs(self, pack_size):
+        """
+        Write the files for all of the variants, packed into simulations of
+        up to pack_size variants each (see write_pack). Returns a list with the
+        values (as strings), variant id, LEMS file and quantities of each variant.
+        """
+        unique = []
+        variant_values = {}
+        for variant in self.variants:
+            values = self.get_variant_values(variant)
+            variant_id = self.get_variant_id(values)
+            if variant_id not in variant_values:
+                variant_values[variant_id] = values
+                unique.append(variant_id)
+
+        generated = {}
+        for start in range(0, len(unique), pack_size):
+            variant_ids = unique[start:start+pack_size]
+            pack_id = "p_%s"%hashlib.sha1(';'.join(variant_ids).encode('utf-8')).hexdigest()[:12]
+            lems_file, quantities = self.write_pack([variant_values[v] for v in variant_ids],
+                                                    os.path.join(self.sweep_dir, pack_id))
+            for variant_id, variant_quantities in zip(variant_ids, quantities):
+                generated[variant_id] = (lems_file, variant_quantities)
+
+        variants = []
+        for variant in self.variants:
+            values = self.get_variant_values(variant)
+            variant_id = self.get_variant_id(values)
+            lems_file, quantities = generated[variant_id]
+            variants.append((values, variant_id, lems_file, quantities))
+
+        pynml.print_comment("Generated %i LEMS files for %i variants (up to %i per simulation) in %s"%(
+            len(set([v[2] for v in variants])), len(self.variants), pack_size, self.sweep_dir), True)
+        return variants
+
+    def run(self, max_workers=None, max_memory=pynml.default_java_max_memory, java_memory_budget=None,
+            use_cache=False, analysis=None, verbose=False, pack_size=1):
+        """
+        Generate and run all of the variants (see pynml.run_lems_batch for the
+        options). If analysis is given, it is called with the saved data of
+        each successful variant (as returned by pynml.reload_saved_data)
+        and should return a dict of values to add as columns of the results.
+
+        Up to pack_size variants are run in each simulation (see write_pack);
+        with pack_size='auto' this is chosen from max_memory (see get_pack_size).
+
+        Returns a SweepResults.
+        """
+        if pack_size == 'auto':
+            pack_size = self.get_pack_size(max_memory, max_workers, java_memory_budget)
+
+        if pack_size == 1:
+            variants = [(values, variant_id, lems_file, None) for values, variant_id, lems_file in self.generate()]
+        else:
+            variants = self.generate_packs(pack_size)
+
+        lems_files = []
+        variants_in_file = {}
+        for values, variant_id, lems_file, quantities in variants:
+            if lems_file not in lems_files:
+                lems_files.append(lems_file)
+                variants_in_file[lems_file] = []
+            if (variant_id, quantities) not in variants_in_file[lems_file]:
+                variants_in_file[lems_file].append((variant_id, quantities))
+
+        analysed = {}
+
+        def analyse(job_result):
+            if job_result['success']:
+                try:
+                    for variant_id, quantities in variants_in_file[job_result['lems_file']]:
+                        results = job_result['results']
+                        if quantities is not None:
+                            results = unpack_results(results, quantities)
+                        analysed[variant_id] = analysis(results)
+                except Exception as e:
+                    job_result['success'] = False
+                    job_result['error'] = "Analysis failed: %s: %s"%(e.__class__.__name__, e)
+            # Only the analysed values are kept, not all of the data
+            job_result['results'] = None
+
+        batch_results = pynml.run_lems_batch(lems_files,
+                                             simulator=self.simulator,
+                                             max_workers=max_workers,
+                                             max_memory=max_memory,
+                                             java_memory_budget=java_memory_budget,
+                                             load_saved_data=analysis is not None,
+                                             callback=analyse if analysis is not None else None,
+                                             verbose=verbose,
+                                             use_cache=use_cache)
+        run_info = {}
+        for job_result in batch_results:
+            run_info[job_result['lems_file']] = job_result
+
+        columns = [get_parameter_name(p) for p in self.parameters] + ['variant_id', 'lems_file', 'success', 'error', 'wall_time']
+        rows = []
+        for values, variant_id, lems_file, quantities in variants:
+            job_result = run_info[lems_file]
+            row = {'variant_id': variant_id,
+                   'lems_file': lems_file,
+                   'success': job_result['success'],
+                   'error': job_result['error'],
+                   'wall_time': job_result['wall_time'],
+                   'packed_quantities': quantities}
+            for parameter, value in values.items():
+                row[get_parameter_name(parameter)] = value
+            for name, value in analysed.get(variant_id, {}).items():
+                if name not in columns:
+                    columns.append(name)
+                row[name] = value
+            rows.append(row)
+
+        return SweepResults(columns, rows)
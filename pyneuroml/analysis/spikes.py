@@ -0,0 +1,105 @@
+"""
+
+Spike detection and firing rate analysis for many traces at once.
+
+Voltages are given as a 2D numpy array with a row per time point and a column
+per cell (or a 1D array for a single cell), with the times of the rows in t.
+Spikes are detected as upward crossings of threshold.
+
+"""
+
+import numpy as np
+
+
+def get_threshold_crossings(t, v, threshold=0):
+    """
+    Find the upward crossings of threshold in all traces. Returns two arrays:
+    the cell (column) index of each crossing and its time, interpolated
+    linearly between time points. These are ordered by cell, then time.
+    """
+    t = np.asarray(t, dtype=float)
+    v = np.asarray(v, dtype=float)
+    if v.ndim == 1:
+        v = v[:, np.newaxis]
+
+    above = v >= threshold
+    # Transposed so that crossings are ordered by cell, then time
+    cells, rows = np.nonzero((~above[:-1] & above[1:]).T)
+
+    v0 = v[rows, cells]
+    v1 = v[rows+1, cells]
+    t0 = t[rows]
+    t1 = t[rows+1]
+    times = t0 + (threshold - v0) * (t1 - t0) / (v1 - v0)
+
+    return cells, times
+
+
+def get_spike_times(t, v, threshold=0):
+    """
+    List with an array of spike times for each cell
+    """
+    v = np.asarray(v)
+    num_cells = 1 if v.ndim == 1 else v.shape[1]
+    cells, times = get_threshold_crossings(t, v, threshold)
+
+    return np.split(times, np.searchsorted(cells, np.arange(1, num_cells)))
+
+
+def get_spike_counts(t, v, threshold=0, start=None, end=None):
+    """
+    Number of spikes of each cell, only counting those in [start, end) if given
+    """
+    v = np.asarray(v)
+    num_cells = 1 if v.ndim == 1 else v.shape[1]
+    cells, times = get_threshold_crossings(t, v, threshold)
+
+    in_window = np.ones(len(times), dtype=bool)
+    if start is not None:
+        in_window &= times >= start
+    if end is not None:
+        in_window &= times < end
+
+    return np.bincount(cells[in_window], minlength=num_cells)
+
+
+def get_mean_frequencies(t, v, start, end, threshold=0):
+    """
+    Mean firing frequency of each cell between start and end, in spikes per
+    unit of time of t (i.e. Hz if t is in seconds)
+    """
+    return get_spike_counts(t, v, threshold, start, end) / float(end - start)
+
+
+def get_isi_statistics(t, v, threshold=0):
+    """
+    Statistics of the interspike intervals of each cell. Returns a dict with
+    arrays for: number (of intervals), mean, std, min and max (nan for cells
+    with fewer than 2 spikes)
+    """
+    v = np.asarray(v)
+    num_cells = 1 if v.ndim == 1 else v.shape[1]
+    cells, times = get_threshold_crossings(t, v, threshold)
+
+    same_cell = cells[1:] == cells[:-1]
+    isi_cells = cells[1:][same_cell]
+    isis = np.diff(times)[same_cell]
+
+    number = np.bincount(isi_cells, minlength=num_cells)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(isi_cells, weights=isis, minlength=num_cells) / number
+        mean_sq = np.bincount(isi_cells, weights=isis**2, minlength=num_cells) / number
+        std = np.sqrt(np.maximum(mean_sq - mean**2, 0))
+
+    min_isi = np.full(num_cells, np.inf)
+    max_isi = np.full(num_cells, -np.inf)
+    np.minimum.at(min_isi, isi_cells, isis)
+    np.maximum.at(max_isi, isi_cells, isis)
+    min_isi[number == 0] = np.nan
+    max_isi[number == 0] = np.nan
+
+    return {'number': number,
+            'mean': mean,
+            'std': std,
+            'min': min_isi,
+            'max': max_isi}
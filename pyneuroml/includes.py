@@ -0,0 +1,126 @@
+"""
+
+Resolution of the files included by LEMS (<Include file=...>) and NeuroML
+(<include href=...>) files, through the whole graph of includes.
+
+Only the include elements (children of the root element) are read from each
+file, with a streaming lxml parse, and the list of these is cached for each
+file (keyed on its path, modification time and size), so that files included
+by many models (e.g. shared channel files) are only scanned once. The least
+recently used entries are dropped when the cache holds more than
+max_cached_files files.
+
+"""
+
+from __future__ import absolute_import
+import itertools
+import os
+import threading
+
+from lxml import etree
+
+INCLUDE_ATTRIBUTES = {'Include': 'file', 'include': 'href'}
+
+max_cached_files = 1000
+
+include_cache = {}
+_use_counter = itertools.count()
+# get_includes may be called from several threads (e.g. run_lems_batch)
+include_cache_lock = threading.Lock()
+
+
+def scan_includes(file_name):
+    """
+    The files included by file_name, as given in the file, read without
+    building the whole document
+    """
+    includes = []
+    depth = 0
+    for event, element in etree.iterparse(file_name, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                attribute = INCLUDE_ATTRIBUTES.get(etree.QName(element).localname)
+                if attribute and element.get(attribute):
+                    includes.append(element.get(attribute))
+        else:
+            depth -= 1
+            if depth == 1:
+                # Only the root element & the current child are kept in memory
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+    return includes
+
+
+def get_includes(file_name):
+    """
+    The files included by file_name, as given in the file. Cached: the file
+    is only scanned again if it has changed.
+    """
+    path = os.path.realpath(file_name)
+    stat = os.stat(path)
+    with include_cache_lock:
+        cached = include_cache.get(path)
+        if cached is not None and cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+            cached['last_used'] = next(_use_counter)
+            return cached['includes']
+
+    # Scanned outside the lock, so that other threads are not held up
+    cached = {'mtime': stat.st_mtime,
+              'size': stat.st_size,
+              'includes': scan_includes(path)}
+
+    with include_cache_lock:
+        cached['last_used'] = next(_use_counter)
+        include_cache[path] = cached
+        while len(include_cache) > max_cached_files:
+            oldest = min(include_cache.keys(), key=lambda p: include_cache[p]['last_used'])
+            del include_cache[oldest]
+
+    return cached['includes']
+
+
+def resolve_include(file_name, included):
+    """
+    The path of a file included by file_name: relative to the directory of
+    file_name, or as given if that is not found (e.g. Cells.xml, which
+    jNeuroML provides)
+    """
+    path = os.path.normpath(os.path.join(os.path.dirname(file_name), included))
+    if not os.path.isfile(path):
+        return included
+    return path
+
+
+def get_included_files(file_name, allow_cycles=True):
+    """
+    Get all of the files (recursively) included by a LEMS or NeuroML file, each
+    once, in the order they are first found (depth first). Included files
+    which cannot be found (or read) are returned as given, and not followed.
+
+    A file which (indirectly) includes itself is only followed once, or if
+    allow_cycles is False, a ValueError is raised showing the cycle.
+    """
+    found = []
+    seen = set()
+
+    def visit(path, stack):
+        try:
+            includes = get_includes(path)
+        except (IOError, OSError, etree.XMLSyntaxError):
+            return
+        for included in includes:
+            included_path = resolve_include(path, included)
+            real_included = os.path.realpath(included_path)
+            if real_included in stack and not allow_cycles:
+                cycle = stack[stack.index(real_included):] + [real_included]
+                raise ValueError("Cycle of includes: %s"%' -> '.join(cycle))
+            if included_path not in seen:
+                seen.add(included_path)
+                found.append(included_path)
+                if os.path.isfile(included_path):
+                    visit(included_path, stack + [real_included])
+
+    visit(file_name, [os.path.realpath(file_name)])
+    return found
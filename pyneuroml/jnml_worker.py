@@ -0,0 +1,221 @@
+"""
+
+Long lived jNeuroML process which can be reused for many calls to pynml.run_jneuroml,
+so that the cost of starting the JVM is only paid once.
+
+Use pynml.enable_jneuroml_worker() to switch this on.
+
+"""
+
+from __future__ import absolute_import
+import atexit
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+WORKER_SOURCE = "%s/JNeuroMLWorker.java"%(os.path.dirname(os.path.realpath(__file__)))
+
+MARKER = "##PYNEUROML_WORKER##"
+
+default_idle_timeout = 600
+health_check_timeout = 30
+# Seconds between checks that the worker is still alive while waiting for a run
+alive_check_interval = 1
+
+
+class JNeuroMLWorkerError(Exception):
+    pass
+
+
+class JNeuroMLWorker(object):
+    """
+    A jNeuroML process (see JNeuroMLWorker.java) which accepts jnml arguments
+    on stdin. It is restarted if it has crashed, exited after being idle, fails
+    a health check or if the current working directory has changed.
+    """
+
+    def __init__(self, jar, max_memory, idle_timeout=default_idle_timeout):
+        self.jar = jar
+        self.max_memory = max_memory
+        self.idle_timeout = idle_timeout
+        self.process = None
+        self.cwd = None
+        self.lines = None
+        self.lock = threading.Lock()
+
+
+    def start(self):
+        command = ["java", "-Xmx%s"%self.max_memory, "-cp", self.jar, WORKER_SOURCE, str(self.idle_timeout)]
+        self.cwd = os.getcwd()
+        try:
+            self.process = subprocess.Popen(command, cwd=self.cwd, stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE, universal_newlines=True)
+        except OSError as e:
+            self.process = None
+            raise JNeuroMLWorkerError("Could not start jNeuroML worker: %s"%e)
+
+        self.lines = queue.Queue()
+        reader = threading.Thread(target=_read_lines, args=(self.process.stdout, self.lines))
+        reader.daemon = True
+        reader.start()
+
+        output = self._read_until(["READY"], health_check_timeout)
+        if output is None:
+            self.stop()
+            raise JNeuroMLWorkerError("jNeuroML worker did not start (Java 11+ with the jdk.compiler module is required)")
+
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+
+    def ping(self):
+        if not self.is_alive():
+            return False
+        try:
+            self._send("PING")
+        except (IOError, OSError):
+            return False
+        return self._read_until(["PONG"], health_check_timeout) is not None
+
+
+    def stop(self):
+        if self.process is not None:
+            if self.is_alive():
+                try:
+                    self._send("QUIT")
+                    self.process.wait()
+                except (IOError, OSError):
+                    self.process.kill()
+            self.process = None
+
+
+    def ensure_running(self):
+        if self.is_alive() and self.cwd == os.getcwd() and self.ping():
+            return
+        if self.process is not None:
+            self.kill()
+        self.start()
+
+
+    def kill(self):
+        if self.is_alive():
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
+    def run(self, args, timeout=None):
+        """
+        Run jNeuroML with the list of arguments args. Returns a tuple with the
+        exit status & the output. If there is no reply after timeout seconds
+        (if given), the worker is killed and JNeuroMLWorkerError is raised.
+        """
+        with self.lock:
+            self.ensure_running()
+            self._send("RUN\t%s"%"\t".join(args))
+            output = []
+            status = self._read_until(["DONE"], timeout, output, check_alive=True)
+            if status is None:
+                if self.is_alive():
+                    self.kill()
+                    raise JNeuroMLWorkerError("No reply from jNeuroML worker after %s seconds; it has been killed"%timeout)
+                # The process exited while running (e.g. System.exit in jNeuroML)
+                status = self.process.wait()
+                self.process = None
+            else:
+                status = int(status.split()[-1])
+
+            return status, "\n".join(output)
+
+
+    def _send(self, line):
+        self.process.stdin.write(line+"\n")
+        self.process.stdin.flush()
+
+
+    def _read_until(self, replies, timeout, output=None, check_alive=False):
+        """
+        Read lines until one of the marked replies arrives (returned), adding
+        other lines to output. Returns None on end of stream or timeout, or if
+        check_alive and the process has exited (its output may be held open
+        by processes it started, e.g. NEURON).
+        """
+        start = time.time()
+        while True:
+            wait = timeout
+            if timeout is not None:
+                wait = timeout - (time.time() - start)
+                if wait <= 0:
+                    return None
+            if check_alive:
+                wait = alive_check_interval if wait is None else min(wait, alive_check_interval)
+            try:
+                line = self.lines.get(timeout=wait)
+            except queue.Empty:
+                if check_alive and not self.is_alive():
+                    return None
+                continue
+            if line is None:
+                return None
+            line = line.rstrip("\n")
+            # The marker follows jNeuroML's output, which may not end with a new line
+            index = line.find(MARKER)
+            if index >= 0:
+                if index > 0 and output is not None:
+                    output.append(line[:index])
+                reply = line[index+len(MARKER):].strip()
+                if reply.split()[0] in replies:
+                    return reply
+            elif output is not None:
+                output.append(line)
+
+
+def _read_lines(stream, lines):
+    for line in iter(stream.readline, ''):
+        lines.put(line)
+    lines.put(None)
+
+
+workers = {}
+
+
+def get_worker(jar, max_memory, idle_timeout=default_idle_timeout):
+    """
+    Get the shared worker for this jar/memory setting
+    """
+    key = (jar, max_memory)
+    if key not in workers:
+        workers[key] = JNeuroMLWorker(jar, max_memory, idle_timeout)
+    workers[key].idle_timeout = idle_timeout
+    return workers[key]
+
+
+def stop_workers():
+    for worker in workers.values():
+        worker.stop()
+    workers.clear()
+
+atexit.register(stop_workers)
+
+
+def run_jneuroml(jar, pre_args, target_file, post_args, max_memory, idle_timeout=default_idle_timeout, timeout=None):
+    """
+    Run jNeuroML in the (shared) worker for this jar/memory setting. Raises
+    subprocess.CalledProcessError on failure, like subprocess.check_output, and
+    JNeuroMLWorkerError if the worker could not be started or gave no reply
+    within timeout seconds (if given).
+    """
+    args = shlex.split(pre_args) + [target_file] + shlex.split(post_args)
+    worker = get_worker(jar, max_memory, idle_timeout)
+    status, output = worker.run(args, timeout)
+    if status != 0:
+        raise subprocess.CalledProcessError(status, "jNeuroML worker: %s"%" ".join(args), output)
+    return output
@@ -3,21 +3,43 @@
 Helper class for generating LEMS xml files for simulations
 """
     
-import airspeed
 import os.path
 
 from pyneuroml import __version__
-from pyneuroml.pynml import read_neuroml2_file
-from pyneuroml.pynml import read_lems_file
+from pyneuroml.includes import get_included_files
+from pyneuroml.pynml import get_airspeed_template
+from pyneuroml.pynml import get_next_hex_color
+
+BACKENDS = ['airspeed', 'lxml']
+
+# Included in every LEMS file generated (see LEMS_TEMPLATE.xml)
+CORE_INCLUDE_FILES = ['Cells.xml', 'Networks.xml', 'Simulation.xml']
+
+# Recordings with more columns than this are split over a number of files
+DEFAULT_MAX_COLUMNS_PER_OUTPUT_FILE = 1000
 
 class LEMSSimulation():
     
     TEMPLATE_FILE = "%s/LEMS_TEMPLATE.xml"%(os.path.dirname(__file__))
     
-    lems_info = {}
     
-    
-    def __init__(self, sim_id, duration, dt, target=None, comment="\n\n        This LEMS file has been automatically generated using PyNeuroML v%s\n\n    "%__version__):
+    def __init__(self, sim_id, duration, dt, target=None, comment="\n\n        This LEMS file has been automatically generated using PyNeuroML v%s\n\n    "%__version__, 
+                 backend='airspeed', max_columns_per_output_file=DEFAULT_MAX_COLUMNS_PER_OUTPUT_FILE):
+        """
+        backend is used to generate the XML: 'airspeed' merges the data with the
+        Velocity template LEMS_TEMPLATE.xml, 'lxml' builds the same elements 
+        directly, which is faster for generating large numbers of files.
+        
+        Columns added to an output file beyond max_columns_per_output_file
+        (if not None) go in further output files, with ids & file names 
+        ending _1, _2... (see add_columns_to_output_file)
+        """
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend: %s (should be one of %s)"%(backend, BACKENDS))
+        self.backend = backend
+        self.max_columns_per_output_file = max_columns_per_output_file
+        
+        self.lems_info = {}
         self.lems_info['sim_id'] = sim_id
         self.lems_info['duration'] = duration
         self.lems_info['dt'] = dt
@@ -27,6 +49,10 @@ class LEMSSimulation():
         self.lems_info['displays'] = []
         self.lems_info['output_files'] = []
         
+        # Displays by id, and the output files (split if too wide) for each id
+        self.display_index = {}
+        self.output_file_index = {}
+        
         if target:
             self.lems_info['target'] = target
         
@@ -36,24 +62,40 @@ class LEMSSimulation():
         
         
     def include_neuroml2_file(self, nml2_file_name, include_included=True):
-        self.lems_info['include_files'].append(nml2_file_name)
-        if include_included:
-            cell = read_neuroml2_file(nml2_file_name)
-            for include in cell.includes:
-                self.lems_info['include_files'].append(include.href)
+        self._include_file(nml2_file_name, include_included)
         
         
     def include_lems_file(self, lems_file_name, include_included=True):
-        self.lems_info['include_files'].append(lems_file_name)
+        self._include_file(lems_file_name, include_included)
+        
+        
+    def _include_file(self, file_name, include_included):
+        """
+        Include file_name and, if include_included, all of the files it 
+        (recursively) includes (see includes.get_included_files), relative to 
+        the directory of file_name. Files already included are not added again.
+        """
+        include_files = self.lems_info['include_files']
+        to_include = [file_name]
         if include_included:
-            model = read_lems_file(lems_file_name)
-            for inc in model.included_files:
-                self.lems_info['include_files'].append(inc)
+            base_dir = os.path.dirname(os.path.abspath(file_name))
+            for included in get_included_files(file_name):
+                if os.path.isfile(included):
+                    included = os.path.relpath(os.path.abspath(included), base_dir)
+                if included not in CORE_INCLUDE_FILES:
+                    to_include.append(included)
+                
+        for include_file in to_include:
+            if include_file not in include_files:
+                include_files.append(include_file)
         
         
     def create_display(self, id, title, ymin, ymax, timeScale="1ms"):
+        if id in self.display_index:
+            raise ValueError("There is already a display with id %s"%id)
         disp = {}
         self.lems_info['displays'].append(disp)
+        self.display_index[id] = disp
         disp['id'] = id
         disp['title'] = title
         disp['ymin'] = ymin
@@ -63,48 +105,151 @@ class LEMSSimulation():
         
         
     def create_output_file(self, id, file_name):
+        if id in self.output_file_index:
+            raise ValueError("There is already an output file with id %s"%id)
+        self.output_file_index[id] = [self._add_output_file(id, file_name)]
+        
+        
+    def _add_output_file(self, id, file_name):
         of = {}
         self.lems_info['output_files'].append(of)
         of['id'] = id
         of['file_name'] = file_name
         of['columns'] = []
+        return of
+        
+        
+    def get_display(self, display_id):
+        if display_id not in self.display_index:
+            raise ValueError("No display with id %s"%display_id)
+        return self.display_index[display_id]
+        
+        
+    def get_output_files(self, output_file_id):
+        """
+        The output files for output_file_id: more than one if its columns have
+        been split over a number of files
+        """
+        if output_file_id not in self.output_file_index:
+            raise ValueError("No output file with id %s"%output_file_id)
+        return self.output_file_index[output_file_id]
         
         
     def add_line_to_display(self, display_id, line_id, quantity, scale, color, timeScale="1ms"):
-        disp = None
-        for d in self.lems_info['displays']:
-            if d['id'] == display_id:
-                disp = d
-                
-        line = {}
-        disp['lines'].append(line)
-        line['id'] = line_id
-        line['quantity'] = quantity
-        line['scale'] = scale
-        line['color'] = color
-        line['time_scale'] = timeScale
+        self.add_lines_to_display(display_id, [quantity], scale, [color], [line_id], timeScale)
+        
+        
+    def add_lines_to_display(self, display_id, quantities, scale, colors=None, line_ids=None, timeScale="1ms"):
+        """
+        Add a line to a display for each of quantities, with ids line_ids 
+        (default: <display_id>_<index>) and colors (default: random colors)
+        """
+        disp = self.get_display(display_id)
+        lines = disp['lines']
+        if line_ids is None:
+            line_ids = ["%s_%i"%(display_id, i) for i in range(len(lines), len(lines)+len(quantities))]
+        if colors is None:
+            colors = [get_next_hex_color() for quantity in quantities]
+        
+        for line_id, quantity, color in zip(line_ids, quantities, colors):
+            lines.append({'id': line_id, 
+                          'quantity': quantity, 
+                          'scale': scale, 
+                          'color': color, 
+                          'time_scale': timeScale})
         
         
     def add_column_to_output_file(self, output_file_id, column_id, quantity):
-        of = None
-        for o in self.lems_info['output_files']:
-            if o['id'] == output_file_id:
-                of = o
-                
-        column = {}
-        of['columns'].append(column)
-        column['id'] = column_id
-        column['quantity'] = quantity
+        self.add_columns_to_output_file(output_file_id, [quantity], [column_id])
+        
+        
+    def add_columns_to_output_file(self, output_file_id, quantities, column_ids=None):
+        """
+        Add a column to an output file for each of quantities, with ids 
+        column_ids (default: <output_file_id>_<index>). If the file would then
+        have more than max_columns_per_output_file columns, the rest go in new
+        output files: for e.g. Volts_file, saving to v.dat, these are 
+        Volts_file_1 saving to v_1.dat, Volts_file_2 to v_2.dat...
+        """
+        output_files = self.get_output_files(output_file_id)
+        if column_ids is None:
+            num_columns = sum([len(of['columns']) for of in output_files])
+            column_ids = ["%s_%i"%(output_file_id, i) for i in range(num_columns, num_columns+len(quantities))]
+        
+        max_columns = self.max_columns_per_output_file
+        of = output_files[-1]
+        for column_id, quantity in zip(column_ids, quantities):
+            if max_columns is not None and len(of['columns']) >= max_columns:
+                name, ext = os.path.splitext(output_files[0]['file_name'])
+                of = self._add_output_file("%s_%i"%(output_file_id, len(output_files)), 
+                                           "%s_%i%s"%(name, len(output_files), ext))
+                output_files.append(of)
+            of['columns'].append({'id': column_id, 'quantity': quantity})
         
     
     def to_xml(self):
+        if not self.lems_info.get('target'):
+            raise ValueError("No target set for simulation %s (see assign_simulation_target)"%self.lems_info['sim_id'])
+        
+        if self.backend == 'lxml':
+            return self.to_xml_with_lxml()
+        
         templfile = self.TEMPLATE_FILE
         if not os.path.isfile(templfile):
             templfile = '.' + templfile
-        with open(templfile) as f:
-            templ = airspeed.Template(f.read())
+        templ = get_airspeed_template(templfile)
         return templ.merge(self.lems_info)
     
+    
+    def to_xml_with_lxml(self):
+        """
+        Generate the same LEMS as LEMS_TEMPLATE.xml, building it with lxml
+        """
+        from lxml import etree
+        
+        def add_element(parent, tag, attributes):
+            # Set in order, as keyword arguments are unordered in older Pythons
+            element = etree.SubElement(parent, tag)
+            for name, value in attributes:
+                element.set(name, str(value))
+            return element
+        
+        info = self.lems_info
+        
+        lems = etree.Element('Lems')
+        if info['comment']:
+            lems.append(etree.Comment(' %s '%info['comment']))
+        add_element(lems, 'Target', [('component', info['sim_id'])])
+        for include_file in CORE_INCLUDE_FILES + info['include_files']:
+            add_element(lems, 'Include', [('file', include_file)])
+            
+        sim = add_element(lems, 'Simulation', [('id', info['sim_id']), 
+                                               ('length', "%sms"%info['duration']), 
+                                               ('step', "%sms"%info['dt']), 
+                                               ('target', info['target'])])
+        start = -0.1 * info['duration']
+        end = 1.1 * info['duration']
+        for display in info['displays']:
+            disp = add_element(sim, 'Display', [('id', display['id']), 
+                                                ('title', display['title']), 
+                                                ('timeScale', display['time_scale']),
+                                                ('xmin', start), 
+                                                ('xmax', end), 
+                                                ('ymin', display['ymin']), 
+                                                ('ymax', display['ymax'])])
+            for line in display['lines']:
+                add_element(disp, 'Line', [('id', line['id']), 
+                                           ('quantity', line['quantity']), 
+                                           ('scale', line['scale']), 
+                                           ('color', line['color']), 
+                                           ('timeScale', line['time_scale'])])
+        for output_file in info['output_files']:
+            of = add_element(sim, 'OutputFile', [('id', output_file['id']), ('fileName', output_file['file_name'])])
+            for column in output_file['columns']:
+                add_element(of, 'OutputColumn', [('id', column['id']), ('quantity', column['quantity'])])
+                
+        return etree.tostring(lems, pretty_print=True).decode()
+    
 
     def save_to_file(self, file_name=None):
         if file_name==None:
@@ -6,13 +6,14 @@ Will use some some utilities from https://github.com/OpenSourceBrain/NEURONShowc
 
 '''
 
+import os
+
 from pyneuroml.pynml import validate_neuroml1
 from pyneuroml.pynml import validate_neuroml2
 
 def export_to_neuroml2(hoc_or_python_file, nml2_file_name, includeBiophysicalProperties=True, separateCellFiles=False, validate=True):
     
-    from neuron import *
-    from nrn import *
+    from neuron import h
     
     if hoc_or_python_file is not None:
         if hoc_or_python_file.endswith(".py"):
@@ -20,7 +21,7 @@ def export_to_neuroml2(hoc_or_python_file, nml2_file_name, includeBiophysicalPro
         else:
             h.load_file(hoc_or_python_file)
 
-    print "Loaded NEURON file: %s"%hoc_or_python_file
+    print("Loaded NEURON file: %s"%hoc_or_python_file)
 
     h.load_file("mview.hoc")
     
@@ -48,12 +49,11 @@ def export_to_neuroml1(hoc_file, nml1_file_name, level=1, validate=True):
         print("Only options for Levels in NeuroMLv1.8.1 are 1 or 2")
         return None
     
-    from neuron import *
-    from nrn import *
+    from neuron import h
     
     h.load_file(hoc_file)
 
-    print "Loaded NEURON file: %s"%hoc_file
+    print("Loaded NEURON file: %s"%hoc_file)
 
     h.load_file("mview.hoc")
 
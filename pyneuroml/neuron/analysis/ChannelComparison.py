@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+
+#
+#
+#   A script which compares the steady states (inf) and time courses (tau) of
+#   the gates of channels in mod files (analysed in NEURON as in HHanalyse.py)
+#   with those of the NeuroML 2 versions of the channels (as analysed by
+#   NML2ChannelAnalysis.py), on the same voltages and temperature
+#
+#
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from pyneuroml import pynml
+from pyneuroml.neuron.nmodl import parse_mod_file
+
+
+def process_args():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description="A script which compares the inf/tau curves of channels in mod files (analysed with NEURON) with those of the NeuroML 2 versions of the channels")
+
+    parser.add_argument('channelFiles',
+                        type=str,
+                        nargs='+',
+                        metavar='<NeuroML 2 Channel file>',
+                        help='Name of the NeuroML 2 file(s) containing the channels')
+
+    parser.add_argument('-modDir',
+                        type=str,
+                        metavar='<directory>',
+                        default='.',
+                        help='Directory with the mod files of the channels (compiled there with nrnivmodl)')
+
+    parser.add_argument('-map',
+                        type=str,
+                        nargs='+',
+                        metavar='<channel id=mechanism>',
+                        default=[],
+                        help='Names of the NEURON mechanisms (SUFFIX) for NeuroML channels with different ids')
+
+    parser.add_argument('-minV',
+                        type=int,
+                        metavar='<min v>',
+                        default=-100,
+                        help='Minimum voltage to test (integer, mV)')
+
+    parser.add_argument('-maxV',
+                        type=int,
+                        metavar='<max v>',
+                        default=100,
+                        help='Maximum voltage to test (integer, mV)')
+
+    parser.add_argument('-stepV',
+                        type=int,
+                        metavar='<step v>',
+                        default=10,
+                        help='Voltage step to use (integer, mV)')
+
+    parser.add_argument('-temperature',
+                        type=float,
+                        metavar='<temperature>',
+                        default=6.3,
+                        help='Temperature (float, celsius)')
+
+    parser.add_argument('-dt',
+                        type=float,
+                        metavar='<time step>',
+                        default=0.01,
+                        help='Timestep for NEURON simulations, dt, in ms')
+
+    parser.add_argument('-tauMethod',
+                        choices=['slope', 'fit'],
+                        default='fit',
+                        help="How to get tau from the NEURON simulations (see pynml-modchananalysis)")
+
+    parser.add_argument('-simulate',
+                        action='store_true',
+                        default=False,
+                        help="Always simulate the NeuroML channels with jNeuroML, rather than calculating inf/tau of standard HH gates directly")
+
+    parser.add_argument('-processes',
+                        type=int,
+                        metavar='<number of processes>',
+                        default=1,
+                        help='Number of channels to compare in parallel')
+
+    parser.add_argument('-timeout',
+                        type=float,
+                        metavar='<seconds>',
+                        default=None,
+                        help='Mark a channel as failed if its comparison has not finished after this time')
+
+    parser.add_argument('-summary',
+                        type=str,
+                        metavar='<file name>',
+                        default='channel_comparison.dat',
+                        help='File to write the table of errors and timings to')
+
+    return parser.parse_args()
+
+
+def get_channel_gates(channel_file, channel_id):
+    from pyneuroml.analysis.NML2ChannelAnalysis import get_template_gates
+    summary = pynml.get_neuroml_summary(channel_file)
+    return get_template_gates(summary['channels'][channel_id])
+
+
+def get_neuroml_values(channel_file, ion_channel, volts, temperature, simulate=False):
+    """
+    Get inf and tau (ms) of all gates of a NeuroML channel at volts (mV),
+    calculated directly for standard HH gates (see hh_rates.py), otherwise by
+    running the LEMS file generated by NML2ChannelAnalysis with jNeuroML and
+    interpolating the values on the voltage ramp. Returns a dict with gate id
+    as key and a dict with inf & tau arrays as value.
+    """
+    from pyneuroml.analysis.hh_rates import evaluate_channel_gates, UnsupportedGateError
+    from pyneuroml.analysis.NML2ChannelAnalysis import generate_lems_channel_analyser
+
+    volts = np.asarray(volts, dtype=float)
+
+    if not simulate:
+        try:
+            values = evaluate_channel_gates(ion_channel, volts / 1000.0, temperature)
+            for g in values:
+                values[g]['tau'] = values[g]['tau'] * 1000.0
+            return values
+        except UnsupportedGateError as e:
+            print("Cannot calculate rates of %s directly (%s), it will be simulated"%(ion_channel.id, e))
+
+    gates = get_channel_gates(channel_file, ion_channel.id)
+    if len(gates) == 0:
+        raise UnsupportedGateError("no gates of %s can be recorded in the LEMS simulation"%ion_channel.id)
+
+    # Same settings as the defaults of pynml-channelanalysis
+    duration = 100
+    lems_content = generate_lems_channel_analyser(channel_file, ion_channel.id, int(volts[0]), 20, int(volts[-1]),
+                                                  10, 80, -70, duration, 0, gates, temperature, 5e-5)
+    lems_file = "LEMS_Test_%s.xml"%ion_channel.id
+    lf = open(lems_file, 'w')
+    lf.write(lems_content)
+    lf.close()
+
+    results = pynml.run_lems_with_jneuroml(lems_file, nogui=True, load_saved_data=True, plot=False, verbose=False)
+
+    # Only the samples on the voltage ramp of rampCell0 in the template (no
+    # delay, ramping for twice duration), sorted by voltage for np.interp
+    t = np.asarray(results['t']) * 1000.0
+    ramp = (t >= 0) & (t <= 2 * duration)
+    ramp_v = np.asarray(results["rampCellPop0[0]/v"])[ramp] * 1000.0
+    order = np.argsort(ramp_v, kind='mergesort')
+    ramp_v = ramp_v[order]
+
+    values = {}
+    for g in gates:
+        inf = np.asarray(results["rampCellPop0[0]/test/%s/%s/inf"%(ion_channel.id, g)])[ramp][order]
+        tau = np.asarray(results["rampCellPop0[0]/test/%s/%s/tau"%(ion_channel.id, g)])[ramp][order] * 1000.0
+        values[g] = {'inf': np.interp(volts, ramp_v, inf),
+                     'tau': np.interp(volts, ramp_v, tau)}
+    return values
+
+
+def get_neuron_values(mod_dir, mechanism, states, volts, dt, temperature, tau_method='fit'):
+    """
+    Get inf and tau (ms) of the states of a NEURON mechanism at volts (mV), from
+    voltage clamps as in pynml-modchananalysis -batched
+    """
+    from pyneuroml.neuron.analysis.HHanalyse import load_mechanisms, setup_neuron, analyse_channel
+
+    load_mechanisms(mod_dir, mechanism)
+    h = setup_neuron(temperature)
+    steadyStateVals, timeCourseVals = analyse_channel(h, mechanism, states, volts, dt, batched=True, tauMethod=tau_method)
+
+    values = {}
+    for s in states:
+        values[s] = {'inf': np.array(steadyStateVals[s], dtype=float),
+                     'tau': np.array(timeCourseVals[s], dtype=float)}
+    return values
+
+
+def get_error_metrics(reference, values):
+    """
+    Maximum absolute, RMS and maximum relative (to reference) differences
+    between two arrays, ignoring points where either is nan
+    """
+    reference = np.asarray(reference, dtype=float)
+    values = np.asarray(values, dtype=float)
+    ok = np.isfinite(reference) & np.isfinite(values)
+    if not np.any(ok):
+        return {'max_abs': np.nan, 'rms': np.nan, 'max_rel': np.nan, 'points': 0}
+
+    diff = np.abs(values[ok] - reference[ok])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rel = np.where(reference[ok] != 0, diff / np.abs(reference[ok]), np.where(diff == 0, 0, np.inf))
+
+    return {'max_abs': float(diff.max()),
+            'rms': float(np.sqrt(np.mean(diff**2))),
+            'max_rel': float(rel.max()),
+            'points': int(ok.sum())}
+
+
+def compare_channel(job):
+    """
+    Compare the NeuroML and NEURON versions of a single channel. Run in a
+    separate process for each channel by compare_channels.
+    """
+    import neuroml.loaders as loaders
+    
+    channel_file, channel_id, mod_dir, mechanism, mod_file, volts, dt, temperature, tau_method, simulate = job
+
+    result = {'channel_id': channel_id,
+              'channel_file': channel_file,
+              'mechanism': mechanism,
+              'mod_file': mod_file,
+              'success': False,
+              'error': None,
+              'neuroml_time': 0,
+              'neuron_time': 0,
+              'gates': {}}
+    try:
+        doc = loaders.NeuroMLLoader.load(channel_file)
+        ion_channel = None
+        for c in list(doc.ion_channel_hhs) + list(doc.ion_channel):
+            if c.id == channel_id:
+                ion_channel = c
+
+        start = time.time()
+        neuroml_values = get_neuroml_values(channel_file, ion_channel, volts, temperature, simulate)
+        result['neuroml_time'] = time.time() - start
+
+        states = parse_mod_file(mod_file)['states']
+        start = time.time()
+        neuron_values = get_neuron_values(mod_dir, mechanism, states, volts, dt, temperature, tau_method)
+        result['neuron_time'] = time.time() - start
+
+        for g in sorted(neuroml_values.keys()):
+            if g not in neuron_values:
+                result['gates'][g] = {'error': "No STATE %s in %s"%(g, mod_file)}
+                continue
+            result['gates'][g] = {'inf': get_error_metrics(neuroml_values[g]['inf'], neuron_values[g]['inf']),
+                                  'tau': get_error_metrics(neuroml_values[g]['tau'], neuron_values[g]['tau']),
+                                  'error': None}
+        result['success'] = True
+    except Exception as e:
+        result['error'] = "%s: %s"%(e.__class__.__name__, e)
+
+    return result
+
+
+def find_channel_pairs(channel_files, mod_dir, mapping=None):
+    """
+    Find the NeuroML channels in channel_files and the mod files in mod_dir with
+    SUFFIX equal to the channel id (or the name given for it in mapping).
+    Returns a list of (channel file, channel id, mechanism, mod file or None)
+    """
+    import glob
+
+    if mapping is None:
+        mapping = {}
+
+    mod_files = {}
+    for mod_file in sorted(glob.glob(os.path.join(mod_dir, '*.mod'))):
+        suffix = parse_mod_file(mod_file)['suffix']
+        if suffix is not None and suffix not in mod_files:
+            mod_files[suffix] = mod_file
+
+    pairs = []
+    for channel_file in channel_files:
+        summary = pynml.get_neuroml_summary(channel_file)
+        for channel_id, name in summary['components']:
+            if name in ('ionChannelHH', 'ionChannel'):
+                mechanism = mapping.get(channel_id, channel_id)
+                pairs.append((channel_file, channel_id, mechanism, mod_files.get(mechanism)))
+    return pairs
+
+
+def compare_channels(channel_files, mod_dir, volts, dt, temperature, mapping=None, tau_method='fit',
+                     simulate=False, processes=1, timeout=None):
+    """
+    Compare all of the channels in channel_files with their mod file versions
+    in mod_dir (see find_channel_pairs), each in its own process, using up to
+    processes at once. Returns a list with a dict of the errors and timings for
+    each channel.
+    """
+    results = []
+    jobs = []
+    for channel_file, channel_id, mechanism, mod_file in find_channel_pairs(channel_files, mod_dir, mapping):
+        if mod_file is None:
+            print("No mod file with SUFFIX %s found in %s for channel %s"%(mechanism, mod_dir, channel_id))
+            results.append({'channel_id': channel_id, 'channel_file': channel_file, 'mechanism': mechanism,
+                            'mod_file': None, 'success': False, 'error': "No mod file found",
+                            'neuroml_time': 0, 'neuron_time': 0, 'gates': {}})
+        else:
+            jobs.append((channel_file, channel_id, mod_dir, mechanism, mod_file, volts, dt, temperature, tau_method, simulate))
+
+    print("Comparing %i channels with %i processes"%(len(jobs), processes))
+
+    from pyneuroml.neuron.analysis.HHanalyse import run_in_separate_processes
+
+    def failed_result(job, error, taken):
+        return {'channel_id': job[1], 'channel_file': job[0], 'mechanism': job[3], 'mod_file': job[4],
+                'success': False, 'error': error, 'neuroml_time': 0, 'neuron_time': 0, 'gates': {}}
+
+    results += run_in_separate_processes(compare_channel, jobs, processes, timeout, failed_result)
+
+    return results
+
+
+def write_comparison_summary(results, file_name):
+    """
+    Write a table with the errors (NEURON values - NeuroML values, tau in ms)
+    and timings of each gate
+    """
+    columns = ['channel', 'mechanism', 'gate', 'status',
+               'inf max abs', 'inf rms', 'tau max abs', 'tau rms', 'tau max rel',
+               'neuroml time (s)', 'neuron time (s)']
+    lines = ["# %s"%'\t'.join(columns)]
+    for result in results:
+        timings = "%.3f\t%.3f"%(result['neuroml_time'], result['neuron_time'])
+        if not result['success']:
+            lines.append("%s\t%s\t-\tfailed: %s\t-\t-\t-\t-\t-\t%s"%(result['channel_id'], result['mechanism'], result['error'], timings))
+        for g in sorted(result['gates'].keys()):
+            gate = result['gates'][g]
+            if gate['error']:
+                lines.append("%s\t%s\t%s\tfailed: %s\t-\t-\t-\t-\t-\t%s"%(result['channel_id'], result['mechanism'], g, gate['error'], timings))
+            else:
+                lines.append("%s\t%s\t%s\tok\t%g\t%g\t%g\t%g\t%g\t%s"%(result['channel_id'], result['mechanism'], g,
+                                                                   gate['inf']['max_abs'], gate['inf']['rms'],
+                                                                   gate['tau']['max_abs'], gate['tau']['rms'],
+                                                                   gate['tau']['max_rel'], timings))
+    summary = open(file_name, 'w')
+    summary.write('\n'.join(lines)+'\n')
+    summary.close()
+
+    print('\n'.join(lines))
+    print("Written comparison to: %s"%file_name)
+
+
+def main():
+
+    args = process_args()
+
+    mapping = {}
+    for m in args.map:
+        channel_id, mechanism = m.split('=')
+        mapping[channel_id] = mechanism
+
+    volts = range(args.minV,args.maxV+args.stepV,args.stepV)
+
+    results = compare_channels(args.channelFiles, args.modDir, volts, args.dt, args.temperature,
+                               mapping=mapping, tau_method=args.tauMethod, simulate=args.simulate,
+                               processes=args.processes, timeout=args.timeout)
+
+    write_comparison_summary(results, args.summary)
+
+
+if __name__ == '__main__':
+    main()
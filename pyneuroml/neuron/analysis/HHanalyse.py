@@ -8,15 +8,14 @@
 #
 
 import argparse
-
-import neuron
-print("\n\n") 
-
-import matplotlib.pyplot as pylab
+import glob
+import multiprocessing
+import os
+import time
 
 from pyneuroml.analysis.NML2ChannelAnalysis import get_state_color
+from pyneuroml.neuron.nmodl import parse_mod_file
 
-from pylab import *
 from math import log
 
 
@@ -26,7 +25,7 @@ def process_args():
     """
     parser = argparse.ArgumentParser(description="A script which can be run in (Python enabled) NEURON to analyse the rate variables contained in a mod file")
 
-    parser.add_argument('channel', type=str, metavar='<channel name>', 
+    parser.add_argument('channel', type=str, metavar='<channel name>', nargs='?',
                         help='Name of the channel as used by NEURON (i.e. in SUFFIX statement)')
                         
     parser.add_argument('-v',
@@ -70,30 +69,202 @@ def process_args():
                         default=6.3,
                         help='Temperature (float, celsius)')
                         
+    parser.add_argument('-batched',
+                        action='store_true',
+                        default=False,
+                        help="Run the voltage clamps at all holding potentials in a single simulation, recording states with Vectors")
+                        
+    parser.add_argument('-tauMethod',
+                        choices=['slope', 'fit'],
+                        default='slope',
+                        help="How to get tau with -batched: time for slope to fall to 1/e of initial slope (needs a small dt), or fit of an exponential to the recorded states")
+                        
     parser.add_argument('-modFile', 
                         type=str,
                         metavar='<name of mod file>',
                         help='Name of the mod file containing the channel')
+                        
+    parser.add_argument('-modDir', 
+                        type=str,
+                        metavar='<directory>',
+                        help='Analyse all of the mechanisms in a directory of mod files (compiled there with nrnivmodl), instead of a single channel')
+                        
+    parser.add_argument('-processes', 
+                        type=int,
+                        metavar='<number of processes>',
+                        default=1,
+                        help='Number of mechanisms to analyse in parallel with -modDir')
+                        
+    parser.add_argument('-timeout', 
+                        type=float,
+                        metavar='<seconds>',
+                        default=None,
+                        help='With -modDir, mark a mechanism as failed if its result has not been received after this time')
 
     
-    return parser.parse_args()
-
+    args = parser.parse_args()
     
+    if args.channel is None and args.modDir is None:
+        parser.error("Either a channel name or -modDir must be given")
+    
+    if args.tauMethod == 'fit' and not args.batched:
+        parser.error("-tauMethod fit can only be used with -batched")
+    
+    return args
 
-def main():
+    
 
-    args = process_args()
+def run_batched_voltage_clamps(h, chanToTest, states, volts, dt, v0, preHold, postHoldStep, postHoldMax, 
+                               tolerance=1e-5, verbose=False, tauMethod='slope'):
+    """
+    Clamp a separate section for each of the holding potentials in volts, all 
+    in a single NEURON run, recording the states with Vectors. The run stops 
+    when all states have reached steady state (or after postHoldMax ms).
+    
+    With tauMethod 'fit' the time constants are fitted to the recorded traces 
+    (see fit_time_constants), otherwise the 1/e slope method is used.
+    
+    Returns the recorded times, a 2D numpy array of the voltages (a row per 
+    holding potential), a dict with a 2D numpy array for each state, and dicts 
+    with the steady state and time course values for each state.
+    """
+    import numpy as np
+    
+    sections = []
+    clamps = []
+    vVecs = []
+    rateVecs = {}
+    for s in states:
+        rateVecs[s] = []
         
-    verbose = args.v
+    for vh in volts:
+        sec = h.Section()
+        sec.L=10
+        sec.nseg=1
+        for seg in sec :seg.diam = 5
+        sec.insert("pas")
+        sec(0.5).g_pas = 0.001
+        sec(0.5).e_pas = -65
+        sec.insert(str(chanToTest))
+        sections.append(sec)
+        
+        clampobj = h.SEClamp(sec(0.5))
+        clampobj.dur1=preHold
+        clampobj.amp1=v0
+        clampobj.dur2=postHoldMax
+        clampobj.amp2=vh
+        clampobj.rs=0.001
+        clamps.append(clampobj)
+        
+        vVec = h.Vector()
+        vVec.record(sec(0.5)._ref_v)
+        vVecs.append(vVec)
+        for s in states:
+            rateVec = h.Vector()
+            rateVec.record(getattr(sec(0.5), "_ref_%s_%s"%(s, chanToTest)))
+            rateVecs[s].append(rateVec)
+            
+    tVec = h.Vector()
+    tVec.record(h._ref_t)
     
-    ## Get name of channel mechanism to test
+    tstopMax = preHold + postHoldMax
+    h.tstop = tstopMax
+    h.dt = dt
+    if dt == -1:
+        h.cvode.active(1)
+        h.cvode.atol(0.0001)
+        
+    print("Starting simulation with channel %s of max time: %f, with %i holding potentials"%(chanToTest, tstopMax, len(volts)))
+    h.finitialize(v0)
+    
+    lastCheckVals = None
+    while h.t < tstopMax:
+        h.continuerun(min(max(h.t, preHold) + postHoldStep, tstopMax))
+        
+        checkVals = np.array([[getattr(sec(0.5), "%s_%s"%(s, chanToTest)) for s in states] for sec in sections])
+        if lastCheckVals is not None and np.all(np.abs(lastCheckVals-checkVals) <= tolerance*np.abs(checkVals)):
+            if verbose: 
+                print("  All states at steady state at time: %s"%h.t)
+            break
+        lastCheckVals = checkVals
+        
+    tRec = np.array(tVec)
+    vRecs = np.array([np.array(vVec) for vVec in vVecs])
+    rateRecs = {}
+    steadyStateVals = {}
+    timeCourseVals = {}
+    timeToCheckTau = preHold + (10*h.dt)
+    
+    for s in states:
+        rateRecs[s] = np.array([np.array(rateVec) for rateVec in rateVecs[s]])
+        steadyStateVals[s] = rateRecs[s][:, -1]
+        if tauMethod == 'fit':
+            timeCourseVals[s] = fit_time_constants(tRec, rateRecs[s], preHold)
+        else:
+            timeCourseVals[s] = get_taus_from_slopes(tRec, rateRecs[s], timeToCheckTau)
+        
+    return tRec, vRecs, rateRecs, steadyStateVals, timeCourseVals
 
-    chanToTest = args.channel
-    if verbose: 
-        print("Going to test channel: "+ chanToTest)
 
-    ## Create the standard vars h, p for accessing hoc from Python & vice versa
+def get_taus_from_slopes(t, traces, timeToCheckTau):
+    """
+    For each trace (row of traces) find the time after timeToCheckTau at which
+    its slope has fallen to 1/e of its slope at timeToCheckTau (nan if it doesn't)
+    """
+    import numpy as np
+    
+    slopes = np.diff(traces, axis=1) / np.diff(t)
+    slopeTimes = t[1:]
+    i0 = np.searchsorted(slopeTimes, timeToCheckTau)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fractOfInit = slopes[:, i0+1:] / slopes[:, i0:i0+1]
+    fallen = fractOfInit < 0.367879441
+    
+    taus = slopeTimes[i0+1:][np.argmax(fallen, axis=1)] - timeToCheckTau
+    taus[~np.any(fallen, axis=1)] = np.nan
+    
+    return taus
+
+
+def fit_time_constants(t, traces, tStart, minFract=0.01, maxFract=0.9):
+    """
+    Fit the time constant of an exponential approach to steady state for each 
+    trace (row of traces) after tStart, by a least squares fit of a straight 
+    line to log(|x - x_inf|), where x_inf is the final value of the trace. Only 
+    points where |x - x_inf| is between minFract and maxFract of its value at 
+    tStart are used. Gives nan if there are fewer than 2 such points.
+    """
+    import numpy as np
+    
+    i0 = np.searchsorted(t, tStart)
+    times = t[i0:] - t[i0]
+    dist = np.abs(traces[:, i0:] - traces[:, -1:])
+    dist0 = dist[:, :1]
+    
+    use = (dist > minFract*dist0) & (dist <= maxFract*dist0) & (dist0 > 0)
+    weights = use.astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        logDist = np.where(use, np.log(np.where(use, dist, 1)), 0)
+        
+        n = weights.sum(axis=1)
+        meanT = (weights*times).sum(axis=1) / n
+        meanLog = (weights*logDist).sum(axis=1) / n
+        dT = (times - meanT[:, np.newaxis]) * weights
+        slope = (dT*(logDist - meanLog[:, np.newaxis])).sum(axis=1) / (dT*dT).sum(axis=1)
+        taus = -1.0 / slope
+        
+    taus[n < 2] = np.nan
+    
+    return taus
+
 
+def setup_neuron(temperature):
+    """
+    Start NEURON, returning hoc object h with stdrun.hoc loaded and celsius set
+    """
+    import neuron
+    
     print("Starting NEURON in Python mode...")
     h = neuron.h
     h.load_file('stdrun.hoc')
@@ -102,61 +273,20 @@ def main():
     p = new PythonObject()
     ''')
 
+    h.celsius = temperature
 
-    h.celsius = args.temperature
-        
-    ## Create a section, set size & insert pas, passive channel mechanism
-
-    sec = h.Section()
-
-    secname = sec.name()
-    sec.L=10
-    sec.nseg=1
-    for seg in sec :seg.diam = 5
-
-    sec.insert("pas")
-    sec(0.5).g_pas = 0.001
-    sec(0.5).e_pas = -65
-
-
-    ## insert channel into section
-
-    sec.insert(str(chanToTest))
-
-
-    ## Read state variables from mod file
-
-    modFileName = chanToTest+".mod"
-    if args.modFile:
-        modFileName = args.modFile
-    modFile = open(modFileName, 'r')
-    inState = 0
-    states = []
-    for line in modFile:
-        if line.count('STATE') > 0:
-            inState = 1
-
-        if inState==1:
-            if line.count('}') > 0:
-                inState = 0
-            chopped = line.split()
-            for el in chopped:
-                if el != '{' and el != '}' and el != 'STATE': 
-                    if el.startswith('{'): states.append(el[1:])
-                    elif el.endswith('}'): states.append(el[:-1])
-                    else: states.append(el)
-
-    if verbose: 
-        print("States found in mod file: " + str(states))
+    return h
 
 
+def analyse_channel(h, chanToTest, states, volts, dt, batched=False, tauMethod='slope', verbose=False, plotTraces=False):
+    """
+    Insert mechanism chanToTest in a section and voltage clamp it at each of the 
+    holding potentials in volts (mV), returning dicts with lists of the steady 
+    state and time course (ms) values of each of the states.
+    """
+        
     ## Settings for the voltage clamp test
 
-    minV = args.minV
-    maxV = args.maxV
-    interval = args.stepV
-    volts = range(minV,maxV+interval,interval)
-
     v0 = -0.5                           # Pre holding potential
     preHold = 50                       # and duration
     postHoldStep = 10                  # Post step holding time between steady state checks
@@ -172,9 +302,9 @@ def main():
         timeCourseVals[s] = []
 
 
-
-
-    if verbose: 
+    if plotTraces: 
+        import matplotlib.pyplot as pylab
+        
         figV = pylab.figure()
         figV.canvas.set_window_title("Membrane potentials for %s at %s degC"%(chanToTest,h.celsius))
         plV = figV.add_subplot(111, autoscale_on=True)
@@ -184,129 +314,171 @@ def main():
         plR = figR.add_subplot(111, autoscale_on=True)
 
 
-    for vh in volts:
-
-        tstopMax = preHold + postHoldMax
-
-        h('tstop = '+str(tstopMax))
-        h.dt = args.dt
+    if batched:
         
-        if h.dt == -1:
-            h.cvode.active(1)
-            h.cvode.atol(0.0001)
+        tRec, vRecs, rateRecs, ssVals, tcVals = run_batched_voltage_clamps(h, chanToTest, states, volts, dt, v0, 
+                                                                           preHold, postHoldStep, postHoldMax, 
+                                                                           verbose=verbose, tauMethod=tauMethod)
+        for s in states:
+            steadyStateVals[s] = list(ssVals[s])
+            timeCourseVals[s] = list(tcVals[s])
             
-        # Alternatively use a SEClamp obj
-        clampobj = h.SEClamp(.5)
-        clampobj.dur1=preHold
-        clampobj.amp1=v0
-        clampobj.dur2=postHoldMax
-        clampobj.amp2=vh
-        clampobj.rs=0.001
+        if plotTraces: 
+            for i in range(len(volts)):
+                plV.plot(tRec, vRecs[i], solid_joinstyle ='round', solid_capstyle ='round', color='#000000', linestyle='-', marker='None')
+                for s in states:
+                    plR.plot(tRec, rateRecs[s][i], solid_joinstyle ='round', solid_capstyle ='round', color=get_state_color(s), linestyle='-', marker='None')
+                    
+    else:
+        
+        ## Create a section, set size & insert pas, passive channel mechanism
+        ## (run_batched_voltage_clamps creates its own sections)
 
+        sec = h.Section()
 
-        tRec = []
-        vRec = []
-        rateRec = {}
-        for s in states:
-            rateRec[s] = []
-
-        print("Starting simulation with channel %s of max time: %f, with holding potential: %f"%(chanToTest, tstopMax, vh))
-        #h.cvode.active(1)
-        h.finitialize(v0)
-        tolerance = 1e-5
-        lastCheckTime = -1
-        lastCheckVal = {}
-        initSlopeVal = {}
-        foundTau = []
-        foundInf = []
+        secname = sec.name()
+        sec.L=10
+        sec.nseg=1
+        for seg in sec :seg.diam = 5
 
-        for s in states:
-            lastCheckVal[s]=-1e-9
-            initSlopeVal[s]=1e9
+        sec.insert("pas")
+        sec(0.5).g_pas = 0.001
+        sec(0.5).e_pas = -65
+
+
+        ## insert channel into section
 
+        sec.insert(str(chanToTest))
 
-        while (h.t <= tstopMax) and (len(foundInf) < len(states) or len(foundTau) < len(states)):
 
-            h.fadvance()
-            tRec.append(h.t)
-            vRec.append(sec(0.5).v)
-            vverbose = verbose and False
-            if vverbose: 
-                print("--- Time: %s; dt: %s; voltage %f; found Tau %s; found Inf %s"%(h.t, h.dt, vh, foundTau, foundInf))
+        for vh in volts:
+
+            tstopMax = preHold + postHoldMax
+
+            h('tstop = '+str(tstopMax))
+            h.dt = dt
+        
+            if h.dt == -1:
+                h.cvode.active(1)
+                h.cvode.atol(0.0001)
+            
+            # Alternatively use a SEClamp obj
+            clampobj = h.SEClamp(.5)
+            clampobj.dur1=preHold
+            clampobj.amp1=v0
+            clampobj.dur2=postHoldMax
+            clampobj.amp2=vh
+            clampobj.rs=0.001
+
+
+            tRec = []
+            vRec = []
+            rateRec = {}
+            for s in states:
+                rateRec[s] = []
+
+            print("Starting simulation with channel %s of max time: %f, with holding potential: %f"%(chanToTest, tstopMax, vh))
+            #h.cvode.active(1)
+            h.finitialize(v0)
+            tolerance = 1e-5
+            lastCheckTime = -1
+            lastCheckVal = {}
+            initSlopeVal = {}
+            foundTau = []
+            foundInf = []
+
             for s in states:
-                rateVal = eval("sec(0.5)."+s+"_"+chanToTest)
-                rateRec[s].append(float(rateVal))
+                lastCheckVal[s]=-1e-9
+                initSlopeVal[s]=1e9
+
+
+            while (h.t <= tstopMax) and (len(foundInf) < len(states) or len(foundTau) < len(states)):
+
+                h.fadvance()
+                tRec.append(h.t)
+                vRec.append(sec(0.5).v)
+                vverbose = verbose and False
+                if vverbose: 
+                    print("--- Time: %s; dt: %s; voltage %f; found Tau %s; found Inf %s"%(h.t, h.dt, vh, foundTau, foundInf))
+                for s in states:
+                    rateVal = eval("sec(0.5)."+s+"_"+chanToTest)
+                    rateRec[s].append(float(rateVal))
                 
-                if s not in foundTau:
-                    if(h.t >= preHold):
-                        slope = (rateRec[s][-1] - rateRec[s][-2])/h.dt
-                        if initSlopeVal[s] == 0:
-                            print("\n**************************************\n*  Error! Initial slope of curve for state %s is 0\n*  Consider using a smaller dt (currently %s) with option: -dt\n**************************************\n"%(s, h.dt))
-                        fractOfInit = slope/initSlopeVal[s]
-                        if vverbose: 
-                            print("        Slope of %s: %s (%s -> %s); init slope: %s; fractOfInit: %s; rateVal: %s"%(s, slope, rateRec[s][-2], rateRec[s][-1], initSlopeVal[s], fractOfInit, rateVal))
-                        
-                        if initSlopeVal[s]==1e9 and h.t >= timeToCheckTau:
-                            initSlopeVal[s] = slope
+                    if s not in foundTau:
+                        if(h.t >= preHold):
+                            slope = (rateRec[s][-1] - rateRec[s][-2])/h.dt
+                            if initSlopeVal[s] == 0:
+                                print("\n**************************************\n*  Error! Initial slope of curve for state %s is 0\n*  Consider using a smaller dt (currently %s) with option: -dt\n**************************************\n"%(s, h.dt))
+                            fractOfInit = slope/initSlopeVal[s]
                             if vverbose: 
-                                print("        Init slope of %s: %s at val: %s; timeToCheckTau: %s"%(s, slope, rateVal, timeToCheckTau))
-                        elif initSlopeVal[s]!=1e9:
-
-                            if fractOfInit < 0.367879441:
-                                tau =  (h.t-timeToCheckTau)  #/ (-1*log(fractOfInit))
-                                if vverbose:  
-                                    print("        Found! Slope %s: %s, init: %s; at val: %s; time diff %s; fractOfInit: %s; log %s; tau %s"%(s, slope, initSlopeVal[s], rateVal, h.t-timeToCheckTau, fractOfInit, log(fractOfInit), tau))
-                                foundTau.append(s)
-                                timeCourseVals[s].append(tau)
-                            else:
+                                print("        Slope of %s: %s (%s -> %s); init slope: %s; fractOfInit: %s; rateVal: %s"%(s, slope, rateRec[s][-2], rateRec[s][-1], initSlopeVal[s], fractOfInit, rateVal))
+                        
+                            if initSlopeVal[s]==1e9 and h.t >= timeToCheckTau:
+                                initSlopeVal[s] = slope
                                 if vverbose: 
-                                    print("        Not yet fallen by 1/e: %s"% fractOfInit)
+                                    print("        Init slope of %s: %s at val: %s; timeToCheckTau: %s"%(s, slope, rateVal, timeToCheckTau))
+                            elif initSlopeVal[s]!=1e9:
 
+                                if fractOfInit < 0.367879441:
+                                    tau =  (h.t-timeToCheckTau)  #/ (-1*log(fractOfInit))
+                                    if vverbose:  
+                                        print("        Found! Slope %s: %s, init: %s; at val: %s; time diff %s; fractOfInit: %s; log %s; tau %s"%(s, slope, initSlopeVal[s], rateVal, h.t-timeToCheckTau, fractOfInit, log(fractOfInit), tau))
+                                    foundTau.append(s)
+                                    timeCourseVals[s].append(tau)
+                                else:
+                                    if vverbose: 
+                                        print("        Not yet fallen by 1/e: %s"% fractOfInit)
 
 
 
-            if h.t >= preHold and h.t >= lastCheckTime+postHoldStep:
-                if verbose:
-                    print("  - Time: %s; dt: %s; voltage %f; found Tau %s; found Inf %s"%(h.t, h.dt, vh, foundTau, foundInf))
+
+                if h.t >= preHold and h.t >= lastCheckTime+postHoldStep:
+                    if verbose:
+                        print("  - Time: %s; dt: %s; voltage %f; found Tau %s; found Inf %s"%(h.t, h.dt, vh, foundTau, foundInf))
                     
-                lastCheckTime = h.t
+                    lastCheckTime = h.t
 
-                for s in states:
-                    val = eval("sec(0.5)."+s+"_"+chanToTest)
+                    for s in states:
+                        val = eval("sec(0.5)."+s+"_"+chanToTest)
 
-                    if s not in foundInf:
-                        if abs((lastCheckVal[s]-val)/val) > tolerance:
-                            if verbose: 
-                                print("  State %s has failed at %f; lastCheckVal[s] = %f; fract = %f; tolerance = %f"%(s, val, lastCheckVal[s], ((lastCheckVal[s]-val)/val), tolerance))
-                        else:
-                            if verbose: print("  State %s has passed at %f; lastCheckVal[s] = %f; fract = %f; tolerance = %f"%(s, val, lastCheckVal[s], ((lastCheckVal[s]-val)/val), tolerance))
-                            foundInf.append(s)
+                        if s not in foundInf:
+                            if abs((lastCheckVal[s]-val)/val) > tolerance:
+                                if verbose: 
+                                    print("  State %s has failed at %f; lastCheckVal[s] = %f; fract = %f; tolerance = %f"%(s, val, lastCheckVal[s], ((lastCheckVal[s]-val)/val), tolerance))
+                            else:
+                                if verbose: print("  State %s has passed at %f; lastCheckVal[s] = %f; fract = %f; tolerance = %f"%(s, val, lastCheckVal[s], ((lastCheckVal[s]-val)/val), tolerance))
+                                foundInf.append(s)
 
-                        lastCheckVal[s] = val
+                            lastCheckVal[s] = val
 
 
-        if verbose: 
-            print("Finished run,  t: %f, v: %f, vh: %f, initSlopeVal: %s, timeCourseVals: %s ---  "%(h.t, sec(0.5).v, vh, str(initSlopeVal), str(timeCourseVals)))
+            if verbose: 
+                print("Finished run,  t: %f, v: %f, vh: %f, initSlopeVal: %s, timeCourseVals: %s ---  "%(h.t, sec(0.5).v, vh, str(initSlopeVal), str(timeCourseVals)))
 
-        if verbose: plV.plot(tRec, vRec, solid_joinstyle ='round', solid_capstyle ='round', color='#000000', linestyle='-', marker='None')
+            if plotTraces: plV.plot(tRec, vRec, solid_joinstyle ='round', solid_capstyle ='round', color='#000000', linestyle='-', marker='None')
 
-        for s in states:
-            col=get_state_color(s)
-            if verbose: plR.plot(tRec, rateRec[s], solid_joinstyle ='round', solid_capstyle ='round', color=col, linestyle='-', marker='None')
+            for s in states:
+                col=get_state_color(s)
+                if plotTraces: plR.plot(tRec, rateRec[s], solid_joinstyle ='round', solid_capstyle ='round', color=col, linestyle='-', marker='None')
 
-        for s in states:
-            val = eval("sec(0.5)."+s+"_"+chanToTest)
-            steadyStateVals[s].append(val)
+            for s in states:
+                val = eval("sec(0.5)."+s+"_"+chanToTest)
+                steadyStateVals[s].append(val)
+
+    return steadyStateVals, timeCourseVals
 
 
+def plot_channel_values(chanToTest, states, volts, steadyStateVals, timeCourseVals, temperature):
 
+    import matplotlib.pyplot as pylab
+    
     figRates = pylab.figure()
     plRates = figRates.add_subplot(111, autoscale_on=True)
-    figRates.canvas.set_window_title("Steady state(s) of activation variables in %s at %s degC"%(chanToTest,h.celsius))
+    figRates.canvas.set_window_title("Steady state(s) of activation variables in %s at %s degC"%(chanToTest,temperature))
     pylab.grid('on')
 
     figTau = pylab.figure()
-    figTau.canvas.set_window_title("Time course(s) of activation variables in %s at %s degC"%(chanToTest,h.celsius))
+    figTau.canvas.set_window_title("Time course(s) of activation variables in %s at %s degC"%(chanToTest,temperature))
     plTau = figTau.add_subplot(111, autoscale_on=True)
     pylab.grid('on')
 
@@ -323,6 +495,12 @@ def main():
         plTau.legend()
 
 
+def write_channel_values(chanToTest, states, volts, steadyStateVals, timeCourseVals):
+    """
+    Write <channel>.<state>.inf.dat & .tau.dat files, returning their names
+    """
+    file_names = []
+    
     for s in states:
         file_name = "%s.%s.inf.dat"%(chanToTest, s)
         file = open(file_name, 'w')
@@ -330,6 +508,7 @@ def main():
             file.write("%f\t%f\n"%(volts[i], steadyStateVals[s][i]))
         file.close()
         print("Written info to file: %s"%file_name)
+        file_names.append(file_name)
 
         file_name = "%s.%s.tau.dat"%(chanToTest, s)
         file = open(file_name, 'w')
@@ -337,13 +516,251 @@ def main():
             file.write("%f\t%f\n"%(volts[i], timeCourseVals[s][i]))
         file.close()
         print("Written info to file: %s"%file_name)
+        file_names.append(file_name)
+        
+    return file_names
+
+
+def find_mechanisms(modDir):
+    """
+    Parse all the mod files in modDir, returning a list of (mechanism name, mod
+    file, states, reason to skip it or None)
+    """
+    mechanisms = []
+    found = []
+    for mod_file in sorted(glob.glob(os.path.join(modDir, '*.mod'))):
+        info = parse_mod_file(mod_file)
+        suffix = info['suffix']
+        skip = None
+        if info['mechanism_type'] != 'SUFFIX':
+            skip = "not a density mechanism (%s)"%info['mechanism_type']
+        elif len(info['states']) == 0:
+            skip = "no STATE variables"
+        elif suffix in found:
+            skip = "duplicate SUFFIX %s"%suffix
+        else:
+            found.append(suffix)
+        mechanisms.append((suffix, mod_file, info['states'], skip))
+    return mechanisms
+
+
+def load_mechanisms(modDir, chanToTest):
+    """
+    Load the compiled mechanisms in modDir, unless chanToTest is already 
+    present (e.g. loaded from the current directory when neuron was imported)
+    """
+    import neuron
+    
+    mechType = neuron.h.MechanismType(0)
+    name = neuron.h.ref('')
+    for i in range(int(mechType.count())):
+        mechType.select(i)
+        mechType.selected(name)
+        if name[0] == chanToTest:
+            return
+        
+    if not neuron.load_mechanisms(modDir):
+        raise Exception("Could not load compiled mechanisms from %s (has nrnivmodl been run there?)"%modDir)
+
+
+def analyse_mechanism(job):
+    """
+    Analyse a single mechanism from the compiled mod files in a directory. Run
+    in a separate process for each mechanism by analyse_mod_dir.
+    """
+    modDir, chanToTest, modFile, states, volts, dt, temperature, batched, tauMethod, verbose = job
+    
+    result = {'mechanism': chanToTest,
+              'mod_file': modFile,
+              'states': states,
+              'success': False,
+              'skipped': False,
+              'error': None,
+              'time': 0,
+              'files': []}
+              
+    start = time.time()
+    try:
+        load_mechanisms(modDir, chanToTest)
+        h = setup_neuron(temperature)
+        steadyStateVals, timeCourseVals = analyse_channel(h, chanToTest, states, volts, dt, 
+                                                          batched=batched, tauMethod=tauMethod, verbose=verbose)
+        result['files'] = write_channel_values(chanToTest, states, volts, steadyStateVals, timeCourseVals)
+        result['success'] = True
+    except Exception as e:
+        result['error'] = "%s: %s"%(e.__class__.__name__, e)
+    result['time'] = time.time() - start
+    
+    return result
+
+
+def _run_job(function, job, connection):
+    
+    connection.send(function(job))
+    connection.close()
+
+
+def run_in_separate_processes(function, jobs, processes=1, timeout=None, failed_result=None, callback=None):
+    """
+    Call function(job) for each of jobs, each in a new process (so e.g. a
+    mechanism which crashes NEURON does not stop the others), with up to 
+    processes running at once. Returns the results in the order of jobs.
+    
+    If a process exits without a result (e.g. it crashed) or runs for more 
+    than timeout seconds (if given), it is killed and its result is 
+    failed_result(job, error, seconds taken). callback(job, result), if given,
+    is called as each result becomes available.
+    """
+    results = [None] * len(jobs)
+    waiting = list(range(len(jobs)))
+    running = []
+    
+    def finish(index, result):
+        results[index] = result
+        if callback is not None:
+            callback(jobs[index], result)
+    
+    while waiting or running:
+        while waiting and len(running) < processes:
+            index = waiting.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_run_job, args=(function, jobs[index], sender))
+            process.start()
+            sender.close()
+            running.append((index, process, receiver, time.time()))
+            
+        still_running = []
+        for index, process, receiver, start in running:
+            taken = time.time() - start
+            error = None
+            # Polled again if the process has exited, as it may have sent its 
+            # result & exited between the two checks
+            if receiver.poll() or (not process.is_alive() and receiver.poll()):
+                try:
+                    finish(index, receiver.recv())
+                except EOFError:
+                    error = "Process exited without a result"
+                process.join()
+                if error is not None:
+                    error = "Process exited with code %s without a result"%process.exitcode
+            elif not process.is_alive():
+                process.join()
+                error = "Process exited with code %s without a result"%process.exitcode
+            elif timeout is not None and taken > timeout:
+                process.terminate()
+                process.join()
+                error = "No result after %s seconds"%timeout
+            else:
+                still_running.append((index, process, receiver, start))
+                continue
+            receiver.close()
+            if error is not None:
+                finish(index, failed_result(jobs[index], error, taken))
+        running = still_running
+        
+        if running:
+            time.sleep(0.05)
+            
+    return results
+
+
+def analyse_mod_dir(modDir, volts, dt, temperature, batched=False, tauMethod='slope', processes=1, timeout=None, verbose=False):
+    """
+    Analyse all of the (density) mechanisms in a directory of compiled mod 
+    files, each in its own NEURON process, using up to processes at once.
+    Writes the .inf.dat/.tau.dat files for each mechanism and a summary, 
+    <modDir name>.summary.dat, returning the list of results.
+    """
+    mechanisms = find_mechanisms(modDir)
+    
+    results = []
+    jobs = []
+    for chanToTest, modFile, states, skip in mechanisms:
+        if skip:
+            print("Skipping %s: %s"%(modFile, skip))
+            results.append({'mechanism': chanToTest, 'mod_file': modFile, 'states': states,
+                            'success': False, 'skipped': True, 'error': skip, 'time': 0, 'files': []})
+        else:
+            jobs.append((modDir, chanToTest, modFile, states, volts, dt, temperature, batched, tauMethod, verbose))
+            
+    print("Analysing %i mechanisms from %s with %i processes"%(len(jobs), modDir, processes))
+    
+    def failed_result(job, error, taken):
+        return {'mechanism': job[1], 'mod_file': job[2], 'states': job[3], 'success': False, 'skipped': False,
+                'error': error, 'time': taken, 'files': []}
+    
+    def report(job, result):
+        print("Finished %s (%s) in %.2f seconds%s"%(result['mechanism'], result['mod_file'], result['time'], 
+                                                 '' if result['success'] else ': %s'%result['error']))
+    
+    results += run_in_separate_processes(analyse_mechanism, jobs, processes, timeout, failed_result, report)
+    
+    summary_file_name = "%s.summary.dat"%os.path.basename(os.path.normpath(os.path.abspath(modDir)))
+    summary = open(summary_file_name, 'w')
+    summary.write("# mechanism\tmod file\tstatus\tstates\ttime (s)\terror\n")
+    for result in sorted(results, key=lambda r: r['mod_file']):
+        summary.write("%s\t%s\t%s\t%s\t%.3f\t%s\n"%(result['mechanism'], 
+                                                      os.path.basename(result['mod_file']), 
+                                                      'ok' if result['success'] else ('skipped' if result['skipped'] else 'failed'),
+                                                      ','.join(result['states']),
+                                                      result['time'],
+                                                      result['error'] if result['error'] else ''))
+    summary.close()
+    
+    num_ok = len([r for r in results if r['success']])
+    print("Analysed %i of %i mechanisms successfully; written summary to: %s"%(num_ok, len(results), summary_file_name))
+    
+    return results
+
+
+def main():
+
+    args = process_args()
+        
+    verbose = args.v
+    
+    volts = range(args.minV,args.maxV+args.stepV,args.stepV)
+    
+    if args.modDir:
+        analyse_mod_dir(args.modDir, volts, args.dt, args.temperature, batched=args.batched, tauMethod=args.tauMethod, 
+                        processes=args.processes, timeout=args.timeout, verbose=verbose)
+        print("Done!")
+        return
+    
+    ## Get name of channel mechanism to test
+
+    chanToTest = args.channel
+    if verbose: 
+        print("Going to test channel: "+ chanToTest)
+
+    h = setup_neuron(args.temperature)
+
+
+    ## Read state variables from mod file
+
+    modFileName = chanToTest+".mod"
+    if args.modFile:
+        modFileName = args.modFile
+    states = parse_mod_file(modFileName)['states']
+
+    if verbose: 
+        print("States found in mod file: " + str(states))
+
+
+    steadyStateVals, timeCourseVals = analyse_channel(h, chanToTest, states, volts, args.dt, batched=args.batched, 
+                                                      tauMethod=args.tauMethod, verbose=verbose, plotTraces=verbose)
+
+    plot_channel_values(chanToTest, states, volts, steadyStateVals, timeCourseVals, h.celsius)
+
+    write_channel_values(chanToTest, states, volts, steadyStateVals, timeCourseVals)
         
         
     if not args.nogui:
+        import matplotlib.pyplot as pylab
         pylab.show()
 
     print("Done!")
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
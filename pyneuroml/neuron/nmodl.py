@@ -0,0 +1,179 @@
+'''
+
+A lightweight parser for the declaration blocks of NMODL (NEURON mod) files
+
+'''
+
+import hashlib
+import re
+
+NEURON_KEYWORDS = ['SUFFIX', 'POINT_PROCESS', 'ARTIFICIAL_CELL', 'USEION', 'READ', 'WRITE', 'VALENCE',
+                   'RANGE', 'GLOBAL', 'NONSPECIFIC_CURRENT', 'ELECTRODE_CURRENT', 'POINTER',
+                   'BBCOREPOINTER', 'EXTERNAL', 'THREADSAFE', 'REPRESENTS']
+
+TOKEN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*(?:\[\s*\d+\s*\])?|=|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+NUMBER = re.compile(r'^[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?$')
+
+parsed_mod_files = {}
+
+
+def strip_comments(text):
+    """
+    Remove COMMENT...ENDCOMMENT and VERBATIM...ENDVERBATIM blocks and : or ?
+    comments from the text of a mod file
+    """
+    text = re.sub(r'(?ms)^\s*COMMENT\b.*?^\s*ENDCOMMENT\b', '', text)
+    text = re.sub(r'(?ms)^\s*VERBATIM\b.*?^\s*ENDVERBATIM\b', '', text)
+    text = re.sub(r'[:?][^\n]*', '', text)
+    return text
+
+
+def get_blocks(text, block_name):
+    """
+    Get the contents of all blocks (e.g. STATE { ... }) of type block_name,
+    matching nested braces. Only block_name at the start of a line starts a
+    block, not e.g. "NEURON" in the TITLE.
+    """
+    blocks = []
+    for match in re.finditer(r'(?m)^\s*%s\b[^{}]*\{'%block_name, text):
+        depth = 1
+        i = match.end()
+        while i < len(text) and depth > 0:
+            if text[i] == '{':
+                depth += 1
+            elif text[i] == '}':
+                depth -= 1
+            i += 1
+        blocks.append(text[match.end():i-1])
+    return blocks
+
+
+def tokenize(block):
+    """
+    Split a declaration block into names, numbers and =, ignoring units in
+    brackets, limits in <...> and commas
+    """
+    block = re.sub(r'\([^()]*\)', ' ', block)
+    block = re.sub(r'<[^<>]*>', ' ', block)
+    return TOKEN.findall(block)
+
+
+def strip_size(name):
+    return re.sub(r'\[.*\]', '', name)
+
+
+def parse_declarations(block):
+    """
+    Parse the declarations in a PARAMETER, ASSIGNED or STATE block, returning a
+    list of (name, value) with value None if not given
+    """
+    declarations = []
+    tokens = tokenize(block)
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token in ('FROM', 'TO', 'WITH', 'START'):
+            i += 2
+            continue
+        if NUMBER.match(token) or token == '=':
+            i += 1
+            continue
+        value = None
+        if i+1 < len(tokens) and tokens[i+1] == '=':
+            if i+2 < len(tokens) and NUMBER.match(tokens[i+2]):
+                value = float(tokens[i+2])
+            i += 3
+        else:
+            i += 1
+        declarations.append((strip_size(token), value))
+    return declarations
+
+
+def parse_neuron_block(block, info):
+
+    current = None
+    ion = None
+    for token in tokenize(block):
+        if token in NEURON_KEYWORDS:
+            current = token
+            continue
+        if current in ('SUFFIX', 'POINT_PROCESS', 'ARTIFICIAL_CELL'):
+            info['suffix'] = token
+            info['mechanism_type'] = current
+            current = None
+        elif current == 'USEION':
+            ion = token
+            info['ions'][ion] = {'read': [], 'write': [], 'valence': None}
+        elif current in ('READ', 'WRITE') and ion is not None:
+            info['ions'][ion][current.lower()].append(token)
+        elif current == 'VALENCE' and ion is not None:
+            info['ions'][ion]['valence'] = float(token)
+        elif current == 'RANGE':
+            info['range'].append(token)
+        elif current == 'GLOBAL':
+            info['global'].append(token)
+        elif current == 'NONSPECIFIC_CURRENT':
+            info['nonspecific_currents'].append(token)
+        elif current == 'ELECTRODE_CURRENT':
+            info['electrode_currents'].append(token)
+        elif current in ('POINTER', 'BBCOREPOINTER'):
+            info['pointers'].append(token)
+
+
+def parse_mod_text(text):
+    """
+    Parse the text of a mod file, returning a dict with: suffix, mechanism_type
+    (SUFFIX, POINT_PROCESS or ARTIFICIAL_CELL), ions (dict of ion name to dict
+    with read, write and valence), range, global, nonspecific_currents,
+    electrode_currents, pointers, states, parameters (dict of name to default
+    value, or None), parameter_names (in order) and assigned
+    """
+    text = strip_comments(text)
+
+    info = {'suffix': None,
+            'mechanism_type': None,
+            'ions': {},
+            'range': [],
+            'global': [],
+            'nonspecific_currents': [],
+            'electrode_currents': [],
+            'pointers': [],
+            'states': [],
+            'parameters': {},
+            'parameter_names': [],
+            'assigned': []}
+
+    for block in get_blocks(text, 'NEURON'):
+        parse_neuron_block(block, info)
+
+    for block in get_blocks(text, 'STATE'):
+        for name, value in parse_declarations(block):
+            info['states'].append(name)
+
+    for block in get_blocks(text, 'PARAMETER'):
+        for name, value in parse_declarations(block):
+            info['parameters'][name] = value
+            info['parameter_names'].append(name)
+
+    for block in get_blocks(text, 'ASSIGNED'):
+        for name, value in parse_declarations(block):
+            info['assigned'].append(name)
+
+    return info
+
+
+def parse_mod_file(mod_file_name):
+    """
+    Parse a mod file (see parse_mod_text). Results are cached on the contents
+    of the file, so it is only parsed again if it has changed. The returned
+    dict should not be modified.
+    """
+    with open(mod_file_name, 'rb') as f:
+        contents = f.read()
+    key = hashlib.sha1(contents).hexdigest()
+
+    if key not in parsed_mod_files:
+        parsed_mod_files[key] = parse_mod_text(contents.decode('latin-1'))
+
+    return parsed_mod_files[key]
@@ -13,25 +13,23 @@ import subprocess
 
 from . import __version__
 
-import neuroml.loaders as loaders
-import neuroml.writers as writers
-
-import lems.model.model as lems_model
-
 import random
 
 verbose = False
 
 default_java_max_memory = "400M"
 
+use_jneuroml_worker = False
+jneuroml_worker_idle_timeout = 600
+
 def parse_arguments():
     """Parse command line arguments"""
     import argparse
 
     parser = argparse.ArgumentParser(description='pyNeuroML v%s: Python utilities for NeuroML2'%__version__)
 
-    parser.add_argument('target_file', metavar='target_file', type=str,
-                        help='The LEMS/NeuroML2 file to process')
+    parser.add_argument('target_file', metavar='target_file', type=str, nargs='*',
+                        help='The LEMS/NeuroML2 file to process (or a number of LEMS files with -batch)')
 
     ##parser.add_argument('-sim', choices=('pylems', 'jlems'),
     ##                     help='Simulator to use')
@@ -47,11 +45,49 @@ def parse_arguments():
                         
     parser.add_argument('-verbose', action='store_true',
                         help='Verbose output')
+                        
+    parser.add_argument('-neuron', action='store_true',
+                        help='Convert the LEMS file to NEURON format and run it (i.e. use jNeuroML_NEURON)')
+                        
+    parser.add_argument('-dat2npy', action='store_true',
+                        help='Convert the data files (either given directly or the OutputFiles of a LEMS file) to .npy format')
+                        
+    parser.add_argument('-batch', action='store_true',
+                        help='Run all of the LEMS files given, in parallel, without GUI')
+                        
+    parser.add_argument('-max_workers', metavar='max_workers', type=int,
+                        help='Maximum number of simulations to run at once with -batch (default: number of CPUs)')
+                        
+    parser.add_argument('-java_memory_budget', metavar='java_memory_budget', type=str,
+                        help='Total memory which may be used by the simulations running at once with -batch, e.g. 16G')
+
+    parser.add_argument('-timings', action='store_true',
+                        help='Print the time taken by each phase of the jNeuroML run (JVM start, model load, simulate, write)')
+                        
+    parser.add_argument('-summary', action='store_true',
+                        help='Print a summary of the NeuroML2 file(s) (components, includes, channels & their gates, populations), without loading them fully')
+                        
+    parser.add_argument('-cache', action='store_true',
+                        help='Reuse the saved results of an identical simulation from the result cache if present, or add them to it')
+                        
+    parser.add_argument('-cache-stats', action='store_true',
+                        help='Print information on the result cache')
+                        
+    parser.add_argument('-cache-clear', action='store_true',
+                        help='Remove all results from the result cache')
 
     ##parser.add_argument('-outputdir', nargs=1,
     ##                    help='Directory to write output scripts to')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    
+    if len(args.target_file) == 0 and not (args.cache_stats or args.cache_clear):
+        parser.error("A target_file is required")
+        
+    if len(args.target_file) > 1 and not (args.batch or args.dat2npy or args.summary):
+        parser.error("Only one target_file can be given, unless -batch, -dat2npy or -summary is used")
+
+    return args
 
 
 def validate_neuroml1(nml1_file_name):
@@ -73,12 +109,41 @@ def validate_neuroml2(nml2_file_name):
 
 def read_neuroml2_file(nml2_file_name):
     
+    import neuroml.loaders as loaders
+    
     return loaders.NeuroMLLoader.load(nml2_file_name)
 
 
+def read_neuroml2_components(nml2_file_name, component_ids):
+    """
+    Read a NeuroMLDocument containing only the top level components of
+    nml2_file_name with ids in component_ids (e.g. the channels in a large
+    file of cells), read with a streaming parse, so that the other elements
+    are neither kept in memory nor built as libNeuroML objects.
+    """
+    from lxml import etree
+    import neuroml.nml.nml as nml
+
+    root = None
+    depth = 0
+    for event, element in etree.iterparse(nml2_file_name, events=('start', 'end')):
+        if event == 'start':
+            if depth == 0:
+                root = element
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1 and element.get('id') not in component_ids:
+                root.remove(element)
+
+    return nml.parseString(etree.tostring(root), silence=True)
+
+
 
 def write_neuroml2_file(nml2_doc, nml2_file_name, validate=True):
     
+    import neuroml.writers as writers
+    
     writers.NeuroMLWriter.write(nml2_doc,nml2_file_name)
     
     if validate:
@@ -88,6 +153,8 @@ def write_neuroml2_file(nml2_doc, nml2_file_name, validate=True):
         
 def read_lems_file(lems_file_name):
     
+    import lems.model.model as lems_model
+    
     model = lems_model.Model(include_includes=False)
 
     model.import_from_file(lems_file_name)
@@ -104,80 +171,566 @@ def write_lems_file(lems_model, lems_file_name, validate=False):
         validate_lems(lems_file_name)
 
 
-def run_lems_with_jneuroml(lems_file_name, max_memory=default_java_max_memory, nogui=False, load_saved_data=False, plot=False, verbose=True):           
+def run_lems_with_jneuroml(lems_file_name, max_memory=default_java_max_memory, nogui=False, load_saved_data=False, plot=False, verbose=True, use_cache=False,
+                           return_report=False, output_callback=None):           
+    """
+    Run a LEMS file with jNeuroML, returning the saved data if load_saved_data.
+    If return_report, a RunReport (see run_report.py), with the saved data as
+    its results, is returned instead.
+    """
     print_comment("Loading LEMS file: %s and running with jNeuroML"%lems_file_name, True)
     
     post_args = ""
     gui = " -nogui" if nogui else ""
     post_args += gui
     
-    run_jneuroml("", lems_file_name, post_args, max_memory, verbose)
-    
-    if load_saved_data:
-        return reload_saved_data(lems_file_name, plot, 'jNeuroML')
+    return _run_lems(lems_file_name, 'jNeuroML', post_args, max_memory, load_saved_data, plot, verbose, use_cache,
+                     return_report, output_callback)
 
 
-def run_lems_with_jneuroml_neuron(lems_file_name, max_memory=default_java_max_memory, nogui=False, load_saved_data=False, plot=False):           
+def run_lems_with_jneuroml_neuron(lems_file_name, max_memory=default_java_max_memory, nogui=False, load_saved_data=False, plot=False, use_cache=False,
+                                  return_report=False, output_callback=None):           
+    """
+    Run a LEMS file with jNeuroML_NEURON (see run_lems_with_jneuroml)
+    """
     print_comment("Loading LEMS file: %s and running with jNeuroML_NEURON"%lems_file_name, True)
     
     post_args = " -neuron -run"
     gui = " -nogui" if nogui else ""
     post_args += gui
     
-    run_jneuroml("", lems_file_name, post_args, max_memory)
+    return _run_lems(lems_file_name, 'jNeuroML_NEURON', post_args, max_memory, load_saved_data, plot, True, use_cache,
+                     return_report, output_callback)
     
+    
+def _run_lems(lems_file_name, simulator, post_args, max_memory, load_saved_data, plot, verbose, use_cache, 
+              return_report, output_callback):
+    
+    import time
+    from .run_report import RunReport
+    
+    if use_cache and fetch_cached_results(lems_file_name, simulator):
+        report = RunReport(target_file=lems_file_name)
+        report.cached = True
+        report.finish(0)
+    else:
+        report = run_jneuroml("", lems_file_name, post_args, max_memory, verbose, output_callback=output_callback)
+        if use_cache:
+            store_results_in_cache(lems_file_name, simulator)
+            
     if load_saved_data:
-        return reload_saved_data(lems_file_name, plot, 'jNeuroML_NEURON')
+        start = time.time()
+        report.results = reload_saved_data(lems_file_name, plot, simulator)
+        report.reload_time = time.time() - start
+        
+    if return_report:
+        return report
+    return report.results
+    
+    
+def get_result_cache():
+    """
+    The cache of simulation results (see result_cache.py). Its location can be 
+    set with the environment variable PYNEUROML_CACHE_DIR
+    """
+    from .result_cache import ResultCache
+    
+    return ResultCache()
+    
+    
+def fetch_cached_results(lems_file_name, simulator):
+    """
+    If the results of running lems_file_name with simulator are in the result 
+    cache, put its output files in place and return True
+    """
+    from .result_cache import get_cache_key
+    
+    key = get_cache_key(lems_file_name, simulator, get_path_to_jnml_jar())
+    output_files = [of['file_name'] for of in get_lems_output_files(lems_file_name)]
+    
+    if get_result_cache().fetch(key, output_files):
+        print_comment("Using cached results for %s with %s (%s)"%(lems_file_name, simulator, key), True)
+        return True
+    return False
+    
     
+def store_results_in_cache(lems_file_name, simulator):
     
-def reload_saved_data(lems_file_name, plot=False, simulator=None): 
+    from .result_cache import get_cache_key
+    
+    key = get_cache_key(lems_file_name, simulator, get_path_to_jnml_jar())
+    output_files = [of['file_name'] for of in get_lems_output_files(lems_file_name)]
+    
+    get_result_cache().store(key, output_files, lems_file_name, simulator)
+    
+    
+def run_lems_batch(lems_files, simulator="jNeuroML", max_workers=None, max_memory=default_java_max_memory, 
+                   java_memory_budget=None, nogui=True, load_saved_data=False, callback=None, verbose=False, 
+                   use_cache=False):
+    """
+    Run a number of LEMS files in parallel, each in its own jNeuroML process.
+    
+    At most max_workers (default: number of CPUs) simulations run at once, and
+    if java_memory_budget (e.g. "16G") is given, no more than will fit in it
+    using max_memory each. A failed simulation does not stop the others.
+    
+    Returns a list with a dict for each simulation, in the order they finished
+    (with keys: lems_file, simulator, success, wall_time (s), error, results,
+    the reloaded data if load_saved_data, and report, the RunReport of the 
+    run). Each is also passed to callback
+    (if given) as soon as that simulation has finished.
+    
+    Note: if the jNeuroML worker is enabled (see enable_jneuroml_worker) the
+    simulations will share it and will run one at a time.
+    """
+    from multiprocessing.pool import ThreadPool
+    
+    if simulator not in ("jNeuroML", "jNeuroML_NEURON"):
+        raise ValueError("Unsupported simulator for batch: %s"%simulator)
+    
+    max_workers = get_max_parallel_runs(max_workers, max_memory, java_memory_budget)
+        
+    print_comment("Running %i LEMS files with %s, at most %i at once"%(len(lems_files), simulator, max_workers), True)
+    
+    jobs = [(lems_file, simulator, max_memory, nogui, load_saved_data, verbose, use_cache) for lems_file in lems_files]
+    
+    pool = ThreadPool(max_workers)
+    batch_results = []
+    try:
+        for job_result in pool.imap_unordered(_run_batch_job, jobs):
+            batch_results.append(job_result)
+            if job_result['success']:
+                print_comment("Finished %s in %.3f s (%i/%i)"%(job_result['lems_file'], job_result['wall_time'], 
+                                                             len(batch_results), len(jobs)), True)
+            else:
+                print_comment("Failed %s after %.3f s (%i/%i): %s"%(job_result['lems_file'], job_result['wall_time'], 
+                                                                  len(batch_results), len(jobs), job_result['error']), True)
+            if callback:
+                callback(job_result)
+    finally:
+        pool.close()
+        pool.join()
+        
+    return batch_results
+        
+        
+def get_max_parallel_runs(max_workers=None, max_memory=default_java_max_memory, java_memory_budget=None):
+    """
+    Number of jNeuroML processes to run at once: max_workers (default: number 
+    of CPUs), but no more than will fit in java_memory_budget (if given) 
+    using max_memory each
+    """
+    if max_workers is None:
+        import multiprocessing
+        max_workers = multiprocessing.cpu_count()
+        
+    if java_memory_budget is not None:
+        max_by_memory = int(get_memory_in_mb(java_memory_budget) // get_memory_in_mb(max_memory))
+        if max_by_memory < 1:
+            raise ValueError("Java memory budget %s is less than the memory for one simulation (%s)"%(java_memory_budget, max_memory))
+        max_workers = min(max_workers, max_by_memory)
+        
+    return max(1, max_workers)
+        
+        
+def _run_batch_job(job):
+    
+    import time
+    
+    lems_file, simulator, max_memory, nogui, load_saved_data, verbose, use_cache = job
+    job_result = {'lems_file': lems_file, 
+                  'simulator': simulator, 
+                  'success': False, 
+                  'error': None, 
+                  'results': None,
+                  'report': None}
+    start = time.time()
+    try:
+        if simulator == "jNeuroML":
+            report = run_lems_with_jneuroml(lems_file, max_memory, nogui, load_saved_data, 
+                                            verbose=verbose, use_cache=use_cache, return_report=True)
+        elif simulator == "jNeuroML_NEURON":
+            report = run_lems_with_jneuroml_neuron(lems_file, max_memory, nogui, load_saved_data, 
+                                                   use_cache=use_cache, return_report=True)
+        job_result['results'] = report.results
+        job_result['report'] = report
+        job_result['success'] = True
+    except Exception as e:
+        job_result['error'] = "%s: %s"%(e.__class__.__name__, e)
+    job_result['wall_time'] = time.time() - start
+    
+    return job_result
+    
+    
+def get_memory_in_mb(memory):
+    """
+    Convert a Java memory setting (e.g. 400M, 4G, 524288k) to megabytes
+    """
+    units = {'k': 1.0/1024, 'm': 1, 'g': 1024, 't': 1024*1024}
+    memory = str(memory).strip().lower()
+    if memory[-1] in units:
+        return float(memory[:-1]) * units[memory[-1]]
+    return float(memory) / (1024*1024)
+    
+    
+def load_dat_file(file_name, num_columns=None):
+    """
+    Load a (whitespace separated) data file, as written by jNeuroML for an 
+    OutputFile, in one go into a 2D numpy array with a row per time point
+    """
+    import numpy as np
+    
+    if num_columns is None:
+        with open(file_name) as f:
+            num_columns = len(f.readline().split())
+            
+    data = np.fromfile(file_name, sep=' ')
+    
+    if num_columns == 0 or data.size % num_columns != 0:
+        raise ValueError("Could not read %s as a data file with %i columns"%(file_name, num_columns))
+        
+    return data.reshape((-1, num_columns))
+        
+        
+lems_simulation_info_cache = {}
+
+
+def get_lems_simulation_info(lems_file_name):
+    """
+    Get the main information about the Simulation in a LEMS file: a dict with
+    keys id, target, duration, dt (as strings with units, as in the file) and
+    output_files (see get_lems_output_files).
+    
+    This is cached for each file (keyed on its path, modification time and 
+    contents), so the file is only parsed again if it has changed. The returned
+    dict should not be modified.
+    """
+    import hashlib
+    
+    path = os.path.realpath(lems_file_name)
+    stat = os.stat(path)
+    cached = lems_simulation_info_cache.get(path)
+    
+    if cached is not None and cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+        return cached['info']
+        
+    with open(path, 'rb') as f:
+        contents = f.read()
+    sha1 = hashlib.sha1(contents).hexdigest()
+    
+    if cached is None or cached['sha1'] != sha1:
+        info = parse_lems_simulation_info(contents, lems_file_name)
+    else:
+        info = cached['info']
+        
+    lems_simulation_info_cache[path] = {'mtime': stat.st_mtime, 
+                                        'size': stat.st_size, 
+                                        'sha1': sha1, 
+                                        'info': info}
+    return info
+    
+    
+def parse_lems_simulation_info(contents, lems_file_name=''):
+    """
+    Extract the information for get_lems_simulation_info from the contents of 
+    a LEMS file. Elements are matched on their names whatever the namespace 
+    (if any), and either as e.g. <Simulation .../> or <Component type="Simulation" .../>
+    """
     
     # Could use pylems to parse this...
 
-    results = {}
+    from lxml import etree
+    root = etree.fromstring(contents)
     
-    if plot:
-        import matplotlib.pyplot as pylab
+    def is_a(element, type_name):
+        if not isinstance(element.tag, str):
+            return False    # e.g. comments
+        name = etree.QName(element).localname
+        return name == type_name or (name == 'Component' and element.attrib.get('type') == type_name)
+    
+    target = None
+    sims = []
+    for element in root:
+        if is_a(element, 'Target'):
+            target = element.attrib.get('component')
+        elif is_a(element, 'Simulation'):
+            sims.append(element)
+            
+    if len(sims) == 0:
+        raise ValueError("No Simulation found in LEMS file: %s"%lems_file_name)
+    
+    sim = sims[0]
+    for s in sims:
+        if s.attrib.get('id') == target:
+            sim = s
+    
+    output_files = []
+    for of in sim:
+        if is_a(of, 'OutputFile'):
+            cols = []
+            cols.append('t')
+            for col in of:
+                if is_a(col, 'OutputColumn'):
+                    cols.append(col.attrib['quantity'])
+                
+            output_files.append({'id': of.attrib.get('id'), 
+                                 'file_name': of.attrib['fileName'], 
+                                 'columns': cols})
+        
+    return {'id': sim.attrib.get('id'),
+            'target': sim.attrib.get('target'),
+            'duration': sim.attrib.get('length'),
+            'dt': sim.attrib.get('step'),
+            'output_files': output_files}
+    
+    
+def get_lems_output_files(lems_file_name):
+    """
+    Get the OutputFiles of the Simulation in a LEMS file, as a list of dicts 
+    with keys id, file_name and columns (t followed by the quantity of each
+    OutputColumn)
+    """
+    
+    return get_lems_simulation_info(lems_file_name)['output_files']
+    
+    
+neuroml_summary_cache = {}
+
+CHANNEL_ELEMENTS = ['ionChannel', 'ionChannelHH', 'ionChannelKS', 'ionChannelPassive']
+
 
+def get_neuroml_summary(nml2_file_name):
+    """
+    Get a summary of a NeuroML 2 file, read with a streaming parse so that no
+    elements are kept in memory (rather than building the whole document, as 
+    read_neuroml2_file does). Returns a dict with:
+    
+        id: the id of the document
+        components: list of (id, element name) of the top level components
+        includes: list of the files included (as given in the file)
+        channels: dict of channel id to a dict with type (element name), 
+                  gates (list of (id, element name), e.g. (m, gateHHrates)) 
+                  and notes (text or None)
+        networks: list of network ids
+        populations: dict of population id to a dict with network, component
+                     and size (from the size attribute, or number of instances)
+    
+    This is cached for each file (keyed on its path, modification time and 
+    size). The returned dict should not be modified.
+    """
+    path = os.path.realpath(nml2_file_name)
+    stat = os.stat(path)
+    cached = neuroml_summary_cache.get(path)
+    
+    if cached is not None and cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+        return cached['summary']
+        
+    summary = parse_neuroml_summary(path)
+    neuroml_summary_cache[path] = {'mtime': stat.st_mtime, 
+                                   'size': stat.st_size, 
+                                   'summary': summary}
+    return summary
+    
+    
+def parse_neuroml_summary(nml2_file_name):
+    """
+    Generate the summary for get_neuroml_summary (without caching)
+    """
     from lxml import etree
-    tree = etree.parse(lems_file_name)
-    sim = tree.getroot().find('Simulation')
-    ns_prefix = ''
-    
-    possible_prefixes = ['{http://www.neuroml.org/lems/0.7.2}']
-    if sim is None:
-        #print tree.getroot().nsmap
-        #print tree.getroot().getchildren()
-        for pre in possible_prefixes:
-            for comp in tree.getroot().findall(pre+'Component'):
-                if comp.attrib['type'] == 'Simulation':
-                    ns_prefix = pre
-                    sim = comp
-    
-    for of in sim.findall(ns_prefix+'OutputFile'):
-        results['t'] = []
-        file_name = of.attrib['fileName']
-        print_comment("Loading saved data from %s%s"%(file_name, ' (%s)'%simulator if simulator else ''), True)
-
-        cols = []
-        cols.append('t')
-        for col in of.findall(ns_prefix+'OutputColumn'):
-            quantity = col.attrib['quantity']
-            results[quantity] = []
-            cols.append(quantity)
+    
+    summary_reader = NeuroMLSummaryReader()
+    etree.parse(nml2_file_name, etree.XMLParser(target=summary_reader, huge_tree=True))
+    return summary_reader.summary
+    
+    
+class NeuroMLSummaryReader(object):
+    """
+    lxml parser target which builds the summary for get_neuroml_summary from 
+    the start/end of each element, without building any tree. (This is a few 
+    times faster than iterparse, which creates and then clears each element.)
+    """
+    
+    def __init__(self):
+        
+        self.summary = {'id': None,
+                        'components': [],
+                        'includes': [],
+                        'channels': {},
+                        'networks': [],
+                        'populations': {}}
+        # (element name, id) of the current element & its ancestors
+        self.stack = []
+        self.instance_counts = {}
+        self.notes = None
+        
+    def start(self, tag, attrib):
+        
+        name = tag.rpartition('}')[2]
+        element_id = attrib.get('id')
+        depth = len(self.stack)
+        parent = self.stack[-1] if depth > 0 else (None, None)
+        self.stack.append((name, element_id))
+        
+        if depth > 3:
+            return
+        summary = self.summary
+        if depth == 0:
+            summary['id'] = element_id
+        elif depth == 1:
+            if name == 'include':
+                summary['includes'].append(attrib.get('href'))
+            elif element_id is not None:
+                summary['components'].append((element_id, name))
+            if name in CHANNEL_ELEMENTS:
+                summary['channels'][element_id] = {'type': name, 'gates': [], 'notes': None}
+            elif name == 'network':
+                summary['networks'].append(element_id)
+        elif parent[0] in CHANNEL_ELEMENTS and depth == 2:
+            if name.startswith('gate'):
+                summary['channels'][parent[1]]['gates'].append((element_id, name))
+            elif name == 'notes':
+                self.notes = []
+        elif parent[0] == 'network' and depth == 2 and name == 'population':
+            size = attrib.get('size')
+            summary['populations'][element_id] = {'network': parent[1], 
+                                                  'component': attrib.get('component'), 
+                                                  'size': int(size) if size is not None else None}
+        elif parent[0] == 'population' and depth == 3 and name == 'instance':
+            self.instance_counts[parent[1]] = self.instance_counts.get(parent[1], 0) + 1
             
-        for line in open(file_name):
-            values = line.split()
+    def end(self, tag):
+        
+        self.stack.pop()
+        if self.notes is not None and len(self.stack) == 2:
+            self.summary['channels'][self.stack[-1][1]]['notes'] = ''.join(self.notes)
+            self.notes = None
             
-            for vi in range(len(values)):
-               results[cols[vi]].append(float(values[vi]))
-               
+    def data(self, data):
+        
+        if self.notes is not None:
+            self.notes.append(data)
+            
+    def close(self):
+        
+        for population_id, population in self.summary['populations'].items():
+            if population['size'] is None:
+                population['size'] = self.instance_counts.get(population_id, 0)
+    
+    
+def format_neuroml_summary(summary, nml2_file_name=''):
+    
+    info = "NeuroML document %s (%s):"%(summary['id'], nml2_file_name)
+    info += "\n  Includes: %s"%', '.join(summary['includes']) if summary['includes'] else ''
+    counts = {}
+    for component_id, name in summary['components']:
+        counts[name] = counts.get(name, 0) + 1
+    info += "\n  Components: %s"%', '.join(["%s: %i"%(name, counts[name]) for name in sorted(counts.keys())])
+    for channel_id in sorted(summary['channels'].keys()):
+        channel = summary['channels'][channel_id]
+        info += "\n  Channel %s (%s), gates: %s"%(channel_id, channel['type'], ', '.join(["%s (%s)"%gate for gate in channel['gates']]))
+    for population_id in sorted(summary['populations'].keys()):
+        population = summary['populations'][population_id]
+        info += "\n  Population %s in %s: %i x %s"%(population_id, population['network'], 
+                                                    population['size'], population['component'])
+    return info
+    
+    
+def get_npy_file_name(dat_file_name):
+    
+    return dat_file_name+'.npy'
+    
+    
+def convert_dat_file_to_npy(dat_file_name, num_columns=None, npy_file_name=None):
+    """
+    Save the data in a (text) data file in binary .npy format, with the values 
+    for each column stored contiguously, so that single columns can be read 
+    efficiently from a memory mapped file (see load_npy_file)
+    """
+    import numpy as np
+    
+    if npy_file_name is None:
+        npy_file_name = get_npy_file_name(dat_file_name)
+        
+    data = load_dat_file(dat_file_name, num_columns)
+    np.save(npy_file_name, np.asfortranarray(data))
+    print_comment("Converted %s (%i rows, %i columns) to %s"%(dat_file_name, data.shape[0], data.shape[1], npy_file_name), True)
+    
+    return npy_file_name
+    
+    
+def convert_saved_data_to_npy(lems_file_name):
+    """
+    Convert all of the data files saved for the OutputFiles in a LEMS file to 
+    .npy format. These will be used in preference by reload_saved_data.
+    """
+    npy_file_names = []
+    for of in get_lems_output_files(lems_file_name):
+        npy_file_names.append(convert_dat_file_to_npy(of['file_name'], len(of['columns'])))
+        
+    return npy_file_names
+    
+    
+def npy_file_is_up_to_date(dat_file_name):
+    
+    npy_file_name = get_npy_file_name(dat_file_name)
+    
+    return os.path.isfile(npy_file_name) and (not os.path.isfile(dat_file_name) or \
+                                              os.path.getmtime(npy_file_name) >= os.path.getmtime(dat_file_name))
+    
+    
+def load_npy_file(npy_file_name):
+    """
+    Memory map a .npy data file; only the parts of the file for columns 
+    which are used are read from disk
+    """
+    import numpy as np
+    
+    return np.load(npy_file_name, mmap_mode='r')
+    
+    
+def reload_saved_data(lems_file_name, plot=False, simulator=None, as_lists=False, quantities=None): 
+    """
+    Reload the data saved in the OutputFiles of a LEMS Simulation into a dict
+    with the quantity of each OutputColumn (and t) as keys.
+    
+    The values are (views of the columns of a single 2D) numpy arrays, or lists
+    of floats if as_lists is True. If there is an up to date .npy version of an
+    output file (see convert_saved_data_to_npy) this is memory mapped, rather 
+    than parsing the text file. A list of quantities can be given to only load 
+    these (and t).
+    """
 
+    results = {}
+    
+    if plot:
+        import matplotlib.pyplot as pylab
+    
+    for of in get_lems_output_files(lems_file_name):
+        file_name = of['file_name']
+        cols = of['columns']
+        
+        if quantities is not None:
+            if not [q for q in cols if q in quantities]:
+                continue
+            
+        npy_file_name = get_npy_file_name(file_name)
+        if npy_file_is_up_to_date(file_name):
+            print_comment("Loading saved data from %s%s"%(npy_file_name, ' (%s)'%simulator if simulator else ''), True)
+            data = load_npy_file(npy_file_name)
+        else:
+            print_comment("Loading saved data from %s%s"%(file_name, ' (%s)'%simulator if simulator else ''), True)
+            data = load_dat_file(file_name, len(cols))
+        
+        for vi in range(len(cols)):
+            if quantities is None or cols[vi] == 't' or cols[vi] in quantities:
+                results[cols[vi]] = data[:, vi].tolist() if as_lists else data[:, vi]
+               
         if plot:
             fig = pylab.figure()
             fig.canvas.set_window_title("Data loaded from %s%s"%(file_name, ' (%s)'%simulator if simulator else ''))
             
-            for key in cols:
+            # Only the columns loaded, if quantities were given
+            for key in [c for c in cols if c in results]:
 
                 pylab.xlabel('Time (ms)')
                 pylab.ylabel('(SI units...)')
@@ -199,10 +752,86 @@ def reload_saved_data(lems_file_name, plot=False, simulator=None):
     return results
                 
             
+def iter_saved_data(lems_file_name, chunk_rows=100000, quantities=None, simulator=None):
+    """
+    Iterate over the data saved in the OutputFiles of a LEMS Simulation in 
+    blocks of (at most) chunk_rows time points, so that only one block needs
+    to be in memory at a time. 
+    
+    Each block is a dict like the one returned by reload_saved_data, with 
+    numpy arrays for t and each quantity (or just the quantities given).
+    """
+    import numpy as np
+    from itertools import islice
+    
+    readers = []
+    try:
+        for of in get_lems_output_files(lems_file_name):
+            file_name = of['file_name']
+            cols = of['columns']
+            
+            if quantities is not None and not [q for q in cols if q in quantities]:
+                continue
+                
+            if npy_file_is_up_to_date(file_name):
+                print_comment("Iterating over saved data in %s%s"%(get_npy_file_name(file_name), ' (%s)'%simulator if simulator else ''), True)
+                readers.append((cols, load_npy_file(get_npy_file_name(file_name)), None))
+            else:
+                print_comment("Iterating over saved data in %s%s"%(file_name, ' (%s)'%simulator if simulator else ''), True)
+                readers.append((cols, None, open(file_name)))
+                
+        start = 0
+        while readers:
+            block = {}
+            for cols, npy_data, dat_file in readers:
+                if npy_data is not None:
+                    data = npy_data[start:start+chunk_rows]
+                else:
+                    data = np.fromstring(''.join(islice(dat_file, chunk_rows)), sep=' ').reshape((-1, len(cols)))
+                    
+                if data.shape[0] == 0:
+                    return
+                    
+                for vi in range(len(cols)):
+                    if quantities is None or cols[vi] == 't' or cols[vi] in quantities:
+                        block[cols[vi]] = data[:, vi]
+                        
+            start += chunk_rows
+            yield block
+            
+    finally:
+        for cols, npy_data, dat_file in readers:
+            if dat_file is not None:
+                dat_file.close()
+                
+            
 def get_next_hex_color():
     
     return "#%06x" % random.randint(0,0xFFFFFF)
 
+
+airspeed_templates = {}
+
+
+def get_airspeed_template(template_file):
+    """
+    Compiled airspeed Template for template_file. These are cached, so the file
+    is only read and compiled again if it has changed.
+    """
+    import airspeed
+    
+    key = os.path.realpath(template_file)
+    mtime = os.path.getmtime(key)
+    
+    cached = airspeed_templates.get(key)
+    if cached is None or cached[0] != mtime:
+        with open(key) as f:
+            cached = (mtime, airspeed.Template(f.read()))
+        airspeed_templates[key] = cached
+        
+    return cached[1]
+    
+    
 def evaluate_arguments(args):
     
     global verbose 
@@ -211,28 +840,138 @@ def evaluate_arguments(args):
     pre_args = ""
     post_args = ""
         
+    if args.cache_clear:
+        result_cache = get_result_cache()
+        result_cache.clear()
+        print_comment("Cleared result cache: %s"%result_cache.cache_dir, True)
+        
+    if args.cache_stats:
+        stats = get_result_cache().get_stats()
+        for key in sorted(stats.keys()):
+            print_comment("%s: %s"%(key, stats[key]), True)
+            
+    if len(args.target_file) == 0:
+        return
+        
+    if args.summary:
+        for target_file in args.target_file:
+            print_comment(format_neuroml_summary(get_neuroml_summary(target_file), target_file), True)
+        return
+        
+    if args.dat2npy:
+        for target_file in args.target_file:
+            if target_file.endswith('.xml'):
+                convert_saved_data_to_npy(target_file)
+            else:
+                convert_dat_file_to_npy(target_file)
+        return
+        
+    if args.batch:
+        simulator = "jNeuroML_NEURON" if args.neuron else "jNeuroML"
+        batch_results = run_lems_batch(args.target_file, 
+                                       simulator=simulator, 
+                                       max_workers=args.max_workers,
+                                       max_memory=args.java_max_memory,
+                                       java_memory_budget=args.java_memory_budget,
+                                       verbose=verbose,
+                                       use_cache=args.cache)
+        failed = [r for r in batch_results if not r['success']]
+        print_comment("Batch finished: %i succeeded, %i failed"%(len(batch_results)-len(failed), len(failed)), True)
+        if failed:
+            exit(1)
+        return
+        
+    if args.cache and not args.validate:
+        if args.neuron:
+            report = run_lems_with_jneuroml_neuron(args.target_file[0], args.java_max_memory, nogui=args.nogui==True, 
+                                                   use_cache=True, return_report=True)
+        else:
+            report = run_lems_with_jneuroml(args.target_file[0], args.java_max_memory, nogui=args.nogui==True, 
+                                            use_cache=True, return_report=True)
+        if args.timings:
+            print_comment(str(report), True)
+        return
+        
+    if args.neuron:
+        post_args += " -neuron -run"
+        
     gui = " -nogui" if args.nogui==True else ""
     post_args += gui
     
     if args.validate:
         pre_args += " -validate"
         
-    run_jneuroml(pre_args, args.target_file, post_args, args.java_max_memory)
+    report = run_jneuroml(pre_args, args.target_file[0], post_args, args.java_max_memory)
+    
+    if args.timings:
+        print_comment(str(report), True)
     
         
-def run_jneuroml(pre_args, target_file, post_args, max_memory=default_java_max_memory, verbose=True):    
-       
-    exec_dir = "." 
+def enable_jneuroml_worker(idle_timeout=jneuroml_worker_idle_timeout):
+    """
+    Reuse a long lived jNeuroML process for subsequent calls to run_jneuroml
+    (see jnml_worker.py), rather than starting a new JVM each time. The
+    process exits after idle_timeout seconds without use, and is restarted
+    when next needed.
+    """
+    global use_jneuroml_worker, jneuroml_worker_idle_timeout
+    use_jneuroml_worker = True
+    jneuroml_worker_idle_timeout = idle_timeout
+    
+    
+def disable_jneuroml_worker():
+    
+    global use_jneuroml_worker
+    use_jneuroml_worker = False
+    
+    from . import jnml_worker
+    jnml_worker.stop_workers()
+    
+    
+def get_path_to_jnml_jar():
     
     script_dir = os.path.dirname(os.path.realpath(__file__))
 
-    jar = os.path.join(script_dir, "lib/jNeuroML-0.7.1-jar-with-dependencies.jar")
+    return os.path.join(script_dir, "lib/jNeuroML-0.7.1-jar-with-dependencies.jar")
+    
+        
+def run_jneuroml(pre_args, target_file, post_args, max_memory=default_java_max_memory, verbose=True, 
+                 output_callback=None, stderr_callback=None):    
+    """
+    Run jNeuroML on target_file, returning a RunReport (see run_report.py). 
+    Each line of output is passed to output_callback as it arrives (or printed
+    if verbose), and each line on stderr to stderr_callback (or sys.stderr).
+    """
+    from .run_report import RunReport
+       
+    exec_dir = "." 
+    
+    jar = get_path_to_jnml_jar()
     
+    if output_callback is None:
+        output_callback = lambda line: print_comment(line, verbose)
+    
+    if use_jneuroml_worker:
+        from . import jnml_worker
+        try:
+            report = RunReport("jNeuroML worker: %s %s %s"%(pre_args, target_file, post_args), target_file)
+            output = jnml_worker.run_jneuroml(jar, pre_args, target_file, post_args, 
+                                              max_memory, jneuroml_worker_idle_timeout)
+            # The worker only returns the output when finished, so the phases can't be timed
+            for line in output.splitlines():
+                report.add_line(line, timed=False)
+                output_callback(line)
+            report.finish(0)
+            return report
+        except jnml_worker.JNeuroMLWorkerError as e:
+            print_comment("%s; running jNeuroML in a new process instead"%e, True)
 
-    output = execute_command_in_dir("java -Xmx%s -jar  %s %s %s %s" %
-                                        (max_memory, jar, pre_args, target_file, post_args), exec_dir)
-                                            
-    print_comment(output, verbose)
+    command = "java -Xmx%s -jar  %s %s %s %s" % (max_memory, jar, pre_args, target_file, post_args)
+    report = RunReport(command, target_file)
+    
+    execute_command_in_dir(command, exec_dir, output_callback, stderr_callback, report)
+    
+    return report
 
     
     
@@ -246,25 +985,61 @@ def print_comment(text, print_it=verbose):
 
 
 
-def execute_command_in_dir(command, directory):
+def execute_command_in_dir(command, directory, output_callback=None, stderr_callback=None, report=None):
     
-    """Execute a command in specific working directory"""
+    """Execute a command in specific working directory, returning its output.
+    
+    Each line of output is passed to output_callback (if given) as soon as it 
+    arrives, and each line on stderr to stderr_callback (or written to 
+    sys.stderr). The lines are also added to report (a RunReport), if given.
+    Raises subprocess.CalledProcessError if the command fails."""
+    
+    import sys
+    import threading
     
     if os.name == 'nt':
         directory = os.path.normpath(directory)
         
     print_comment("Executing: (%s) in dir: %s" % (command, directory))
     
-    try:
-        return_string = subprocess.check_output(command, cwd=directory, shell=True)
-
-        return return_string
+    process = subprocess.Popen(command, cwd=directory, shell=True,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    
+    def read_stderr():
+        for line in iter(process.stderr.readline, b''):
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            if report is not None:
+                report.add_line(line, stderr=True)
+            if stderr_callback is not None:
+                stderr_callback(line)
+            else:
+                sys.stderr.write(line+'\n')
+                
+    stderr_thread = threading.Thread(target=read_stderr)
+    stderr_thread.daemon = True
+    stderr_thread.start()
+    
+    lines = []
+    for line in iter(process.stdout.readline, b''):
+        line = line.decode('utf-8', 'replace').rstrip('\r\n')
+        lines.append(line)
+        if report is not None:
+            report.add_line(line)
+        if output_callback is not None:
+            output_callback(line)
+            
+    stderr_thread.join()
+    returncode = process.wait()
+    if report is not None:
+        report.finish(returncode)
+        
+    output = '\n'.join(lines)
+    if returncode != 0:
+        error = subprocess.CalledProcessError(returncode, command)
+        error.output = output
+        raise error
     
-    except AttributeError:
-        # For python 2.6...
-        return_string = subprocess.Popen(command, cwd=directory, shell=True,
-                                     stdout=subprocess.PIPE).communicate()[0]
-        return return_string
+    return output
                               
 
 def main():
@@ -0,0 +1,251 @@
+"""
+
+Asynchronous (asyncio) versions of the functions in pynml for running LEMS
+files with jNeuroML, so that many simulations can be supervised from a single
+event loop without a thread for each.
+
+The jNeuroML processes are started with asyncio.create_subprocess_exec, and
+their stdout/stderr can be streamed line by line to callbacks. If a run is
+cancelled, or takes longer than its timeout, its JVM is killed.
+
+Note: requires Python 3.5+, unlike the rest of pyNeuroML. The jNeuroML worker
+(see pynml.enable_jneuroml_worker) is not used here: each run has its own JVM.
+
+"""
+
+import asyncio
+import os
+import shlex
+import signal
+import subprocess
+import time
+
+from pyneuroml import pynml
+from pyneuroml.pynml import default_java_max_memory, print_comment
+from pyneuroml.run_report import RunReport
+
+
+async def _read_lines(stream, report, stderr, callback, verbose):
+
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        line = line.decode('utf-8', 'replace').rstrip('\r\n')
+        report.add_line(line, stderr)
+        if callback is not None:
+            result = callback(line)
+            if asyncio.iscoroutine(result):
+                await result
+        elif verbose:
+            print_comment(line, True)
+
+
+def _kill_process(process):
+    """
+    Kill a process started by run_jneuroml_async, with any processes it
+    started (e.g. if java is a wrapper script), which would otherwise keep
+    its output pipes open
+    """
+    if os.name == 'posix':
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+            return
+        except OSError:
+            pass
+    try:
+        process.kill()
+    except ProcessLookupError:
+        pass
+
+
+async def run_jneuroml_async(pre_args, target_file, post_args, max_memory=default_java_max_memory, verbose=True,
+                             timeout=None, stdout_callback=None, stderr_callback=None, semaphore=None):
+    """
+    Run jNeuroML on target_file as a subprocess, returning a RunReport (see
+    run_report.py).
+
+    Each line of stdout/stderr is passed to stdout_callback/stderr_callback (a
+    function or coroutine function) if given, otherwise printed if verbose.
+    At most semaphore (an asyncio.Semaphore, if given) runs happen at once.
+
+    Raises subprocess.CalledProcessError if jNeuroML fails, and
+    asyncio.TimeoutError if it runs for more than timeout seconds. The JVM is
+    killed on a timeout, or if the task running this is cancelled.
+    """
+    if semaphore is not None:
+        async with semaphore:
+            return await run_jneuroml_async(pre_args, target_file, post_args, max_memory, verbose,
+                                            timeout, stdout_callback, stderr_callback)
+
+    command = ["java", "-Xmx%s"%max_memory, "-jar", pynml.get_path_to_jnml_jar()] + \
+              shlex.split(pre_args) + [target_file] + shlex.split(post_args)
+
+    print_comment("Executing: (%s) asynchronously" % ' '.join(command))
+    report = RunReport(' '.join(command), target_file)
+
+    process = await asyncio.create_subprocess_exec(*command,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE,
+                                                   start_new_session=(os.name == 'posix'))
+    tasks = [asyncio.ensure_future(_read_lines(process.stdout, report, False, stdout_callback, verbose)),
+             asyncio.ensure_future(_read_lines(process.stderr, report, True, stderr_callback, verbose)),
+             asyncio.ensure_future(process.wait())]
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+        if pending:
+            raise asyncio.TimeoutError()
+    finally:
+        if process.returncode is None:
+            print_comment("Killing jNeuroML process for %s (pid %s)"%(target_file, process.pid), True)
+            _kill_process(process)
+            await process.wait()
+        # Cancelled & awaited here, so none is left running or with an exception never retrieved
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        report.finish(process.returncode)
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, report.command,
+                                            output=report.get_output(), stderr=report.get_errors())
+    return report
+
+
+async def _run_lems_async(lems_file_name, simulator, post_args, max_memory, load_saved_data, verbose, use_cache,
+                          timeout, stdout_callback, stderr_callback, semaphore, return_report):
+
+    loop = asyncio.get_event_loop()
+
+    # Reading/writing the cache and reloading data are done in the default
+    # executor, so that they don't hold up the event loop
+    if use_cache and await loop.run_in_executor(None, pynml.fetch_cached_results, lems_file_name, simulator):
+        report = RunReport(target_file=lems_file_name)
+        report.cached = True
+        report.finish(0)
+    else:
+        report = await run_jneuroml_async("", lems_file_name, post_args, max_memory, verbose, timeout,
+                                          stdout_callback, stderr_callback, semaphore)
+        if use_cache:
+            await loop.run_in_executor(None, pynml.store_results_in_cache, lems_file_name, simulator)
+
+    if load_saved_data:
+        start = time.time()
+        report.results = await loop.run_in_executor(None, pynml.reload_saved_data, lems_file_name, False, simulator)
+        report.reload_time = time.time() - start
+
+    if return_report:
+        return report
+    return report.results
+
+
+async def run_lems_with_jneuroml_async(lems_file_name, max_memory=default_java_max_memory, nogui=False,
+                                       load_saved_data=False, verbose=True, use_cache=False, timeout=None,
+                                       stdout_callback=None, stderr_callback=None, semaphore=None,
+                                       return_report=False):
+    """
+    Asynchronous version of pynml.run_lems_with_jneuroml (with the options of
+    run_jneuroml_async). Returns the reloaded data if load_saved_data, or the
+    RunReport if return_report.
+    """
+    print_comment("Loading LEMS file: %s and running with jNeuroML"%lems_file_name, True)
+
+    post_args = " -nogui" if nogui else ""
+
+    return await _run_lems_async(lems_file_name, 'jNeuroML', post_args, max_memory, load_saved_data, verbose,
+                                 use_cache, timeout, stdout_callback, stderr_callback, semaphore, return_report)
+
+
+async def run_lems_with_jneuroml_neuron_async(lems_file_name, max_memory=default_java_max_memory, nogui=False,
+                                              load_saved_data=False, verbose=True, use_cache=False, timeout=None,
+                                              stdout_callback=None, stderr_callback=None, semaphore=None,
+                                              return_report=False):
+    """
+    Asynchronous version of pynml.run_lems_with_jneuroml_neuron (see
+    run_lems_with_jneuroml_async)
+    """
+    print_comment("Loading LEMS file: %s and running with jNeuroML_NEURON"%lems_file_name, True)
+
+    post_args = " -neuron -run"
+    post_args += " -nogui" if nogui else ""
+
+    return await _run_lems_async(lems_file_name, 'jNeuroML_NEURON', post_args, max_memory, load_saved_data, verbose,
+                                 use_cache, timeout, stdout_callback, stderr_callback, semaphore, return_report)
+
+
+async def _run_batch_job_async(lems_file, simulator, max_memory, nogui, load_saved_data, verbose, use_cache,
+                               timeout, semaphore):
+
+    job_result = {'lems_file': lems_file,
+                  'simulator': simulator,
+                  'success': False,
+                  'error': None,
+                  'results': None,
+                  'report': None}
+    async with semaphore:
+        start = time.time()
+        try:
+            if simulator == "jNeuroML":
+                run = run_lems_with_jneuroml_async
+            else:
+                run = run_lems_with_jneuroml_neuron_async
+            report = await run(lems_file, max_memory, nogui, load_saved_data, verbose=verbose,
+                               use_cache=use_cache, timeout=timeout, return_report=True)
+            job_result['results'] = report.results
+            job_result['report'] = report
+            job_result['success'] = True
+        except asyncio.TimeoutError:
+            job_result['error'] = "TimeoutError: still running after %s s"%timeout
+        except Exception as e:
+            job_result['error'] = "%s: %s"%(e.__class__.__name__, e)
+        job_result['wall_time'] = time.time() - start
+
+    return job_result
+
+
+async def run_lems_batch_async(lems_files, simulator="jNeuroML", max_workers=None, max_memory=default_java_max_memory,
+                               java_memory_budget=None, nogui=True, load_saved_data=False, callback=None,
+                               verbose=False, use_cache=False, timeout=None):
+    """
+    Asynchronous version of pynml.run_lems_batch: runs a number of LEMS files,
+    at most max_workers (see pynml.get_max_parallel_runs) at once, each with a
+    timeout (if given). Returns the same list of dicts, in the order the
+    simulations finished, each also passed to callback (if given) as soon as
+    it is available. Cancelling this kills all of the running simulations.
+    """
+    if simulator not in ("jNeuroML", "jNeuroML_NEURON"):
+        raise ValueError("Unsupported simulator for batch: %s"%simulator)
+
+    max_workers = pynml.get_max_parallel_runs(max_workers, max_memory, java_memory_budget)
+
+    print_comment("Running %i LEMS files with %s, at most %i at once"%(len(lems_files), simulator, max_workers), True)
+
+    semaphore = asyncio.Semaphore(max_workers)
+    tasks = [asyncio.ensure_future(_run_batch_job_async(lems_file, simulator, max_memory, nogui, load_saved_data,
+                                                        verbose, use_cache, timeout, semaphore))
+             for lems_file in lems_files]
+
+    batch_results = []
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            job_result = await next_result
+            batch_results.append(job_result)
+            if job_result['success']:
+                print_comment("Finished %s in %.3f s (%i/%i)"%(job_result['lems_file'], job_result['wall_time'],
+                                                             len(batch_results), len(tasks)), True)
+            else:
+                print_comment("Failed %s after %.3f s (%i/%i): %s"%(job_result['lems_file'], job_result['wall_time'],
+                                                                  len(batch_results), len(tasks), job_result['error']), True)
+            if callback:
+                result = callback(job_result)
+                if asyncio.iscoroutine(result):
+                    await result
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return batch_results
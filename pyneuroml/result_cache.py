@@ -0,0 +1,241 @@
+"""
+
+An on disk cache of the files saved by simulations of LEMS files, so that a
+simulation which has already been run is not run again.
+
+Results are stored under a key generated from the contents of the LEMS file &
+all of the NeuroML/LEMS files it (recursively) includes, the simulator and the
+jNeuroML jar. The least recently used results are removed when the cache grows
+beyond its maximum size.
+
+"""
+
+from __future__ import absolute_import
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from .includes import get_included_files
+
+default_cache_dir = os.environ.get('PYNEUROML_CACHE_DIR',
+                                   os.path.join(os.path.expanduser('~'), '.pyneuroml', 'cache'))
+default_max_size = "2G"
+
+INFO_FILE = "info.json"
+STATS_FILE = "stats.json"
+
+# Serialises updates of the stats file by the threads of e.g. pynml.run_lems_batch
+stats_lock = threading.Lock()
+
+# Hashes of the contents of jars, by path, with their modification time & size
+jar_hashes = {}
+
+
+def replace_file(source, destination):
+    """
+    Move source to destination, replacing it if it exists. This is atomic with
+    os.replace (Python 3.3+); before that, os.rename can't replace a file on
+    Windows, so destination is removed first.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+        return
+    try:
+        os.rename(source, destination)
+    except OSError:
+        if not os.path.exists(destination):
+            raise
+        os.remove(destination)
+        os.rename(source, destination)
+
+
+def get_jar_hash(jar):
+    """
+    Hash of the contents of a jar, only read again if it has changed
+    """
+    path = os.path.realpath(jar)
+    stat = os.stat(path)
+    cached = jar_hashes.get(path)
+    if cached is None or cached[0] != stat.st_mtime or cached[1] != stat.st_size:
+        jar_hash = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024*1024), b''):
+                jar_hash.update(block)
+        cached = (stat.st_mtime, stat.st_size, jar_hash.hexdigest())
+        jar_hashes[path] = cached
+    return cached[2]
+
+
+def get_cache_key(lems_file_name, simulator, jar):
+    """
+    Generate the key for the results of running a LEMS file with simulator
+    """
+    key = hashlib.sha1()
+    key.update(("%s\n%s\n"%(simulator, os.path.basename(jar))).encode('utf-8'))
+    if os.path.isfile(jar):
+        key.update(("%s\n"%get_jar_hash(jar)).encode('utf-8'))
+
+    for file_name in [lems_file_name]+get_included_files(lems_file_name):
+        key.update(("%s\n"%os.path.basename(file_name)).encode('utf-8'))
+        if os.path.isfile(file_name):
+            with open(file_name, 'rb') as f:
+                key.update(hashlib.sha1(f.read()).hexdigest().encode('utf-8'))
+
+    return key.hexdigest()
+
+
+class ResultCache(object):
+
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir
+        self.max_size = max_size if max_size is not None else default_max_size
+
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+
+    def fetch(self, key, output_files):
+        """
+        Copy the cached versions of output_files (if present) to where they would
+        have been saved by the simulation. Returns whether they were found.
+        """
+        entry_dir = self.get_entry_dir(key)
+        info_file = os.path.join(entry_dir, INFO_FILE)
+        if not os.path.isfile(info_file):
+            self._update_stats('misses')
+            return False
+
+        with open(info_file) as f:
+            stored = json.load(f)['output_files']
+
+        if sorted(stored.keys()) != sorted(output_files):
+            self._update_stats('misses')
+            return False
+
+        for file_name in output_files:
+            dir_name = os.path.dirname(file_name)
+            if dir_name and not os.path.isdir(dir_name):
+                os.makedirs(dir_name)
+            shutil.copyfile(os.path.join(entry_dir, stored[file_name]), file_name)
+
+        # Used for least recently used eviction
+        os.utime(info_file, None)
+        self._update_stats('hits')
+        return True
+
+
+    def store(self, key, output_files, lems_file_name=None, simulator=None):
+        """
+        Add copies of the output_files saved by a simulation to the cache
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        stored = {}
+        for i, file_name in enumerate(output_files):
+            stored[file_name] = "%i_%s"%(i, os.path.basename(file_name))
+            shutil.copyfile(file_name, os.path.join(tmp_dir, stored[file_name]))
+
+        with open(os.path.join(tmp_dir, INFO_FILE), 'w') as f:
+            json.dump({'lems_file': lems_file_name,
+                       'simulator': simulator,
+                       'created': time.time(),
+                       'output_files': stored}, f, indent=2)
+
+        entry_dir = self.get_entry_dir(key)
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Stored at the same time by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+
+    def get_entries(self):
+        """
+        List of (key, size in bytes, last used time) for each cached result
+        """
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+
+        for key in os.listdir(self.cache_dir):
+            # Not those still being written by store
+            if key.startswith('.tmp_'):
+                continue
+            info_file = os.path.join(self.cache_dir, key, INFO_FILE)
+            if os.path.isfile(info_file):
+                entry_dir = self.get_entry_dir(key)
+                size = sum([os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir)])
+                entries.append((key, size, os.path.getmtime(info_file)))
+
+        return entries
+
+
+    def evict(self):
+        """
+        Remove the least recently used results until the cache is within its
+        maximum size
+        """
+        from pyneuroml.pynml import get_memory_in_mb
+
+        max_bytes = get_memory_in_mb(self.max_size) * 1024 * 1024
+        entries = sorted(self.get_entries(), key=lambda e: e[2])
+        total = sum([e[1] for e in entries])
+
+        while total > max_bytes and entries:
+            key, size, last_used = entries.pop(0)
+            shutil.rmtree(self.get_entry_dir(key), ignore_errors=True)
+            total -= size
+            self._update_stats('evictions')
+
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+
+    def get_stats(self):
+
+        entries = self.get_entries()
+        stats = {'cache_dir': self.cache_dir,
+                 'max_size': self.max_size,
+                 'entries': len(entries),
+                 'size_bytes': sum([e[1] for e in entries]),
+                 'hits': 0,
+                 'misses': 0,
+                 'evictions': 0}
+        stats.update(self._read_stats())
+
+        return stats
+
+
+    def _read_stats(self):
+        stats_file = os.path.join(self.cache_dir, STATS_FILE)
+        try:
+            with open(stats_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+    def _update_stats(self, counter):
+        with stats_lock:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            stats = self._read_stats()
+            stats[counter] = stats.get(counter, 0) + 1
+            # Written to a temporary file then moved, so the stats file is never left partly written
+            fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp_stats_')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(stats, f)
+            replace_file(tmp_file, os.path.join(self.cache_dir, STATS_FILE))
@@ -0,0 +1,114 @@
+"""
+
+A record of a run of jNeuroML: the command, its output (stdout & stderr
+separately, with the time each line arrived), return code, how long it took,
+and how long the results took to reload in Python.
+
+The time spent in each phase of the run (starting the JVM, loading the model,
+simulating, writing the results) is estimated from the times of the lines of
+jNeuroML output which mark the start of each phase (see PHASE_MARKERS). If a
+marker is not found, its phase is counted in the one before it.
+
+"""
+
+from __future__ import absolute_import
+import re
+import time
+
+# Phases of a jNeuroML run after the JVM has started (i.e. after the first line
+# of output), in order, with regular expressions for the output which starts them
+PHASE_MARKERS = [('load', re.compile(r'Reading from|Loading|Processing include|Parsing', re.IGNORECASE)),
+                 ('simulate', re.compile(r'Running simulation|Starting simulation|Running the simulation|Simulation (run|start)|Running with NEURON|Running (it|the file)', re.IGNORECASE)),
+                 ('write', re.compile(r'Finished \d+ steps|Written|Writing (data|to file)|Saved data|Closing', re.IGNORECASE))]
+
+JVM_START = 'jvm_start'
+
+
+class RunReport(object):
+
+    def __init__(self, command=None, target_file=None):
+
+        self.command = command
+        self.target_file = target_file
+        self.start_time = time.time()
+        self.end_time = None
+        self.returncode = None
+        # Lists of (seconds since start, or None if not known, line)
+        self.stdout = []
+        self.stderr = []
+        self.cached = False
+        self.reload_time = None
+        self.results = None
+
+    def add_line(self, line, stderr=False, timed=True):
+
+        entry = (time.time() - self.start_time if timed else None, line)
+        if stderr:
+            self.stderr.append(entry)
+        else:
+            self.stdout.append(entry)
+
+    def finish(self, returncode):
+
+        self.returncode = returncode
+        self.end_time = time.time()
+
+    def get_wall_time(self):
+
+        end_time = self.end_time if self.end_time is not None else time.time()
+        return end_time - self.start_time
+
+    def get_output(self):
+
+        return '\n'.join([line for t, line in self.stdout])
+
+    def get_errors(self):
+
+        return '\n'.join([line for t, line in self.stderr])
+
+    def get_phase_times(self):
+        """
+        List of (phase, seconds) for the phases of the run found in the output,
+        or an empty list if the times of the lines of output are not known
+        (e.g. for a run in the jNeuroML worker, or cached results)
+        """
+        lines = sorted(self.stdout + self.stderr, key=lambda entry: entry[0])
+        if len(lines) == 0 or any([t is None for t, line in lines]) or self.end_time is None:
+            return []
+
+        boundaries = [(JVM_START, 0), (PHASE_MARKERS[0][0], lines[0][0])]
+        next_marker = 0
+        for t, line in lines:
+            for i in range(next_marker, len(PHASE_MARKERS)):
+                if PHASE_MARKERS[i][1].search(line):
+                    if i > 0:
+                        boundaries.append((PHASE_MARKERS[i][0], t))
+                    next_marker = i + 1
+                    break
+
+        end = self.end_time - self.start_time
+        return [(phase, (boundaries[i+1][1] if i+1 < len(boundaries) else end) - t)
+                for i, (phase, t) in enumerate(boundaries)]
+
+    def get_timings(self):
+        """
+        Dict of seconds taken by each phase, plus the total (wall_time) and
+        reload (if the data were reloaded in Python)
+        """
+        timings = dict(self.get_phase_times())
+        timings['wall_time'] = self.get_wall_time()
+        if self.reload_time is not None:
+            timings['reload'] = self.reload_time
+        return timings
+
+    def __str__(self):
+
+        if self.cached:
+            info = "Used cached results for %s"%self.target_file
+        else:
+            info = "Ran %s in %.3f s (return code %s)"%(self.target_file, self.get_wall_time(), self.returncode)
+        for phase, seconds in self.get_phase_times():
+            info += "\n  %s: %.3f s"%(phase, seconds)
+        if self.reload_time is not None:
+            info += "\n  reload (Python): %.3f s"%self.reload_time
+        return info
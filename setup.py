@@ -12,10 +12,12 @@ setup(
     entry_points={
         'console_scripts': ['pynml                 = pyneuroml.pynml:main',
                             'pynml-channelanalysis = pyneuroml.analysis.NML2ChannelAnalysis:main',
-                            'pynml-modchananalysis = pyneuroml.neuron.analysis.HHanalyse:main']},
+                            'pynml-modchananalysis = pyneuroml.neuron.analysis.HHanalyse:main',
+                            'pynml-channelcomparison = pyneuroml.neuron.analysis.ChannelComparison:main']},
     package_data={
         'pyneuroml': [
             'lib/jNeuroML-0.7.1-jar-with-dependencies.jar',
+            'JNeuroMLWorker.java',
             'analysis/LEMS_Test_TEMPLATE.xml',
             'analysis/ChannelInfo_TEMPLATE.html',
             'lems/LEMS_TEMPLATE.xml',
@@ -31,7 +33,8 @@ setup(
         'pylems',
         'airspeed>=0.4.1',
         'libNeuroML>=0.2.5',
-        'matplotlib'],
+        'matplotlib',
+        'numpy'],
     dependency_links=[
       'https://github.com/purcell/airspeed.git',
       'git+https://github.com/NeuralEnsemble/libNeuroML.git@development#egg=libNeuroML-0.2.5'
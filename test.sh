@@ -5,6 +5,12 @@ set -e
 cd examples
 
 
+################################################
+##   Check that the pynml scripts start quickly (no unneeded imports)
+
+python check_import_times.py
+
+
 ################################################
 ##   Run some examples with jNeuroML
 